@@ -21,71 +21,176 @@ flags
   reaching this point, and so are not coded for at this time
 """
 
+# relative to the largest log10(backscatter) in the fit, how close backscatter
+# can be to the fitted threshold before the ray is fitted again with polyfit,
+# well above the differences between the two fits (~1e-11 for 1000 gates)
+CLOSE_FIT = 1e-6
+
+
 def flag2(ranges, flags, threshold = 9000):
     """
     Flag 2 if range is too big
+    ranges can be per gate, and are broadcast over the rays in flags
     """
-    flags = np.where(ranges > threshold, 2, flags)
+    flags = np.where(flag2_condition(ranges, threshold), 2, flags)
     return flags
 
 
+def flag2_condition(ranges, threshold = 9000):
+    """
+    Where range is too big
+    """
+    return np.ma.filled(ranges, 0) > threshold
+
+
 def flag3(intensity, backscatter, flags, min_backscatter = 1e-7, max_backscatter = 1e-3):
     """
     Flag 3 if signal below instrument threshold
+    Done for all rays at once, see flag3_condition
     """
-    for i in range(intensity.shape[0]):  # for each ray
-        # part 1
-        ix = np.where((intensity[i,:] > 1) & (intensity[i,:] < 1.015))
-        threshold = np.mean(intensity[i,ix]) + 1.5 * np.std(intensity[i,ix])
-        flags[i] = np.where(intensity[i,:] < threshold, 3, flags[i])
-        
-        # part 2
-        gates = backscatter.shape[1]
-        if np.mean(backscatter[i,-21:-1]) > 0:
-            ix = np.where(backscatter[i]<0)[0]
-            if (gates-2)-(ix[-1]) > 2:
-                X = list(range(ix[-1],gates-2))
-                Y = np.log10(backscatter[i,ix[-1]:gates-2])
-                XX = list(range(ix[-1],gates))
-                coeffs = P.polyfit(X,Y,2)
-                YY = P.polyval(XX,coeffs)
-                Y1 = np.zeros(gates)
-                Y1[ix[-1]:] = YY
-                tmp_backscat = backscatter[i]
-                tmp_flags = flags[i]
-                flags[i] = np.where(backscatter[i] < Y1*1.2, 3, flags[i])
-            
-    # part 3
-    flags = np.where(backscatter > max_backscatter, 3, flags)
-    flags = np.where(backscatter < min_backscatter, 3, flags)
+    flags = np.where(flag3_condition(intensity, backscatter, min_backscatter, max_backscatter), 3, flags)
     return flags
 
 
+def flag3_condition(intensity, backscatter, min_backscatter = 1e-7, max_backscatter = 1e-3):
+    """
+    Where signal is below instrument threshold, for (time, gate) arrays
+    part 1 - intensity below a per-ray noise threshold, mean + 1.5 std of
+             intensities between 1 and 1.015
+    part 2 - where the far gates have positive backscatter, backscatter
+             below 1.2 times a quadratic fit to log10(backscatter) from the
+             last negative gate. The per-ray fits are solved together as one
+             stacked least-squares problem, and rays close to the threshold
+             are fitted again with polyfit (see CLOSE_FIT). Rays with no
+             negative gate have nowhere to start the fit, and are skipped.
+    part 3 - backscatter outside min_backscatter and max_backscatter
+    """
+    missing = np.ma.getmaskarray(intensity) | np.ma.getmaskarray(backscatter)
+    # np.log10 of a masked array (as the processing scripts pass) fills
+    # backscatter <= 0 and masked gates with 1.0, and the original per-ray
+    # fit used those values, so the fit does too
+    log_fill = 1.0 if np.ma.isMaskedArray(backscatter) else np.nan
+    intensity = np.ma.getdata(intensity)
+    backscatter = np.ma.getdata(backscatter)
+    gates = backscatter.shape[1]
+
+    # part 1
+    noise = np.ma.masked_array(intensity, mask = missing | ~((intensity > 1) & (intensity < 1.015)))
+    threshold = (noise.mean(axis = 1) + 1.5 * noise.std(axis = 1)).filled(np.nan)
+    condition = intensity < threshold[:,np.newaxis]
+
+    # part 2
+    tail = np.ma.masked_array(backscatter, mask = missing)[:,-21:-1].mean(axis = 1)
+    negative = (backscatter < 0) & ~missing
+    last_negative = gates - 1 - np.argmax(negative[:,::-1], axis = 1)
+    rays = np.nonzero((tail.filled(0) > 0) & negative.any(axis = 1) & ((gates - 2) - last_negative > 2))[0]
+    if rays.size > 0:
+        gate_index = np.arange(gates)
+        start = last_negative[rays,np.newaxis]
+        window = ((gate_index >= start) & (gate_index < gates - 2)).astype(float)
+        # each ray's gates scaled to 0-1 over its own window, to keep the normal equations well conditioned
+        vander = ((gate_index - start) / (gates - 2 - start))[:,:,np.newaxis] ** np.arange(3)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            log_backscatter = np.where((backscatter[rays] > 0) & ~missing[rays], np.log10(backscatter[rays]), log_fill)
+            log_backscatter = np.where(window > 0, log_backscatter, 0)
+            lhs = np.einsum('rg,rgi,rgj->rij', window, vander, vander)
+            rhs = np.einsum('rg,rgi->ri', log_backscatter, vander)
+            coeffs = np.linalg.solve(lhs, rhs[:,:,np.newaxis])[:,:,0]
+            fitted = np.where(gate_index >= start, np.einsum('ri,rgi->rg', coeffs, vander), 0)
+            # rays with a gate too close to the threshold for rounding in the
+            # fit to be ruled out are fitted with polyfit as the original per-ray
+            # fit was, so they are flagged the same
+            scale = np.abs(log_backscatter).max(axis = 1, keepdims = True)
+            close = (np.abs(backscatter[rays] - fitted * 1.2) <= CLOSE_FIT * scale) & (gate_index >= start)
+            for i in np.flatnonzero(close.any(axis = 1)):
+                first = start[i,0]
+                ray_coeffs = P.polyfit(np.arange(first, gates - 2), log_backscatter[i,first:gates-2], 2)
+                fitted[i,first:] = P.polyval(np.arange(first, gates), ray_coeffs)
+            condition[rays] |= backscatter[rays] < fitted * 1.2
+
+    # part 3
+    condition |= (backscatter > max_backscatter) | (backscatter < min_backscatter)
+    return condition
+
+
 def flag4(velocity, flags, min_thresh = -19, max_thresh = 19):
     """
     Flag 4 if velocity is too big/small
     """
-    flags = np.where(velocity > max_thresh, 4, flags)
-    flags = np.where(velocity < min_thresh, 4, flags)
+    flags = np.where(flag4_condition(velocity, min_thresh, max_thresh), 4, flags)
     return flags
 
 
+def flag4_condition(velocity, min_thresh = -19, max_thresh = 19):
+    """
+    Where velocity is too big/small
+    """
+    velocity = np.ma.getdata(velocity)
+    return (velocity > max_thresh) | (velocity < min_thresh)
+
+
 def flag5(velocity, flags, min_thresh = -5, max_thresh = 5):
     """
     Flag 5 if velocity shear is too big/small
     """
-    shear = velocity[:,1:] - velocity[:,:-1]
-    flags[:,1:] = np.where(shear > max_thresh, 5, flags[:,1:])
-    flags[:,1:] = np.where(shear < min_thresh, 5, flags[:,1:])
+    flags[:,1:] = np.where(flag5_condition(velocity, min_thresh, max_thresh), 5, flags[:,1:])
     return flags
 
 
-def make_flags(ranges, velocity, intensity, backscatter):
+def flag5_condition(velocity, min_thresh = -5, max_thresh = 5):
+    """
+    Where velocity shear from the previous gate is too big/small, for every
+    gate but the first
+    """
+    # masked arrays keep the first operand's data where masked
+    shear = np.ma.getdata(velocity[:,1:] - velocity[:,:-1])
+    return (shear > max_thresh) | (shear < min_thresh)
+
+
+def fused_flags(ranges, velocity, intensity, backscatter, flags, range_threshold = 9000, min_backscatter = 1e-7, max_backscatter = 1e-3, min_velocity = -19, max_velocity = 19, min_shear = -5, max_shear = 5):
+    """
+    All flag checks for a (time, gate) chunk in one pass, written in place
+    into flags in the same order as flag2 to flag5, so later flags take
+    precedence. ranges are per gate.
+    """
+    flags[:,flag2_condition(ranges, range_threshold)] = 2
+    flags[flag3_condition(intensity, backscatter, min_backscatter, max_backscatter)] = 3
+    flags[flag4_condition(velocity, min_velocity, max_velocity)] = 4
+    flags[:,1:][flag5_condition(velocity, min_shear, max_shear)] = 5
+    return flags
+
+
+def make_flags(ranges, velocity, intensity, backscatter, chunk_size = 5000, angle_index = None, range_threshold = 9000, min_backscatter = 1e-7, max_backscatter = 1e-3, min_velocity = -19, max_velocity = 19, min_shear = -5, max_shear = 5):
+    """
+    Flags for (time, range, angle) arrays of velocity, intensity and
+    backscatter, and (range, angle) ranges, which are the same for every
+    ray. Flags are int8 to match the 'b' QC variables in the netCDF files.
+    Every check only uses data from the same ray, so rays are done
+    chunk_size at a time to bound memory without changing the result.
+    angle_index - angle of each ray, if each ray is only at one angle (e.g.
+                  Stare files with several pointing angles). Each angle is
+                  then only checked for its own rays, and the flags of the
+                  other rays at that angle are masked.
+    range_threshold, min_backscatter, max_backscatter, min_velocity,
+    max_velocity, min_shear, max_shear - thresholds of flag2 to flag5
+    """
+    thresholds = dict(range_threshold = range_threshold, min_backscatter = min_backscatter, max_backscatter = max_backscatter, min_velocity = min_velocity, max_velocity = max_velocity, min_shear = min_shear, max_shear = max_shear)
     # flag 1 for good data - start here, change with bad data
-    flags = np.ones_like(ranges)
+    flags = np.ones(velocity.shape, dtype = np.int8)
+    if angle_index is None:
+        for i in range(flags.shape[2]):
+            for start in range(0, flags.shape[0], chunk_size):
+                rows = slice(start, start + chunk_size)
+                fused_flags(ranges[:,i], velocity[rows,:,i], intensity[rows,:,i], backscatter[rows,:,i], flags[rows,:,i], **thresholds)
+        return flags
+
+    mask = np.ones(flags.shape, dtype = bool)
     for i in range(flags.shape[2]):
-        flags[:,:,i] = flag2(ranges[:,:,i], flags[:,:,i])
-        flags[:,:,i] = flag3(intensity[:,:,i], backscatter[:,:,i], flags[:,:,i])
-        flags[:,:,i] = flag4(velocity[:,:,i], flags[:,:,i])
-        flags[:,:,i] = flag5(velocity[:,:,i], flags[:,:,i])
-    return flags
\ No newline at end of file
+        angle_rays = np.flatnonzero(angle_index == i)
+        for start in range(0, len(angle_rays), chunk_size):
+            rows = angle_rays[start:start + chunk_size]
+            # the rays of an angle aren't contiguous, so are checked as a copy and put back
+            angle_flags = fused_flags(ranges[:,i], velocity[rows,:,i], intensity[rows,:,i], backscatter[rows,:,i], flags[rows,:,i], **thresholds)
+            flags[rows,:,i] = angle_flags
+            mask[rows,:,i] = False
+    return np.ma.masked_array(flags, mask = mask)
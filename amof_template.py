@@ -0,0 +1,188 @@
+"""
+Local store of the AMOF instrument and product definitions that
+create_netcdf.main reads from the AMF_CVs tsv files for every file it makes.
+
+tsv2dict.instrument_dict is parsed once, pickled into the template directory
+and then loaded from there, and kept in memory so each process only loads it
+once however many products and days it makes. Definitions fetched online
+are reused for TEMPLATE_MAX_AGE before being fetched again, and past that if
+there's no network. Definitions from local tsv files are made again when any
+of the files change.
+"""
+import os
+import time
+import pickle
+import hashlib
+import tempfile
+import warnings
+import numpy as np
+
+from ncas_amof_netcdf_template import create_netcdf, tsv2dict, values, __version__
+
+
+DEFAULT_TEMPLATE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ncas-lidar-dop-2', 'templates')
+TEMPLATE_MAX_AGE = 7 * 24 * 60 * 60
+# change when what is stored changes, so stored templates are made again
+TEMPLATE_VERSION = 1
+# type and fill value of packed variables, see EncodedVariables
+PACKED_TYPE = np.int16
+PACKED_FILL_VALUE = np.int16(-32767)
+
+# templates already loaded by this process
+_templates = {}
+
+
+def tsv_state(use_local_files):
+    """
+    Latest modification time and number of the tsv files in use_local_files,
+    for spotting changes to them.
+    """
+    mtimes = [os.stat(os.path.join(root, name)).st_mtime_ns for root, _, files in os.walk(use_local_files) for name in files if name.endswith('.tsv')]
+    return f'{max(mtimes, default = 0)}|{len(mtimes)}'
+
+
+
+def template_file(template_dir, instrument, loc = 'land', use_local_files = None, tag = 'latest'):
+    """
+    Path in template_dir of the stored definitions.
+    """
+    source = f'local|{os.path.abspath(use_local_files)}|{tsv_state(use_local_files)}' if use_local_files else f'online|{tag}'
+    key = f'{instrument}|{loc}|{source}|{__version__}|{TEMPLATE_VERSION}'
+    return os.path.join(template_dir, f'{hashlib.sha1(key.encode()).hexdigest()}.pkl')
+
+
+
+def vocabularies_release(use_local_files = None, tag = 'latest'):
+    """
+    amf_vocabularies_release global attribute, as create_netcdf.add_attributes
+    works it out.
+    """
+    if use_local_files:
+        return tsv2dict.tsv2dict_attrs(f"{use_local_files}/_common/global-attributes.tsv")["amf_vocabularies_release"]["Example"]
+    if tag == 'latest':
+        tag = values.get_latest_CVs_version()
+    return f"https://github.com/ncasuk/AMF_CVs/releases/tag/{tag}"
+
+
+
+def load_template(instrument, loc = 'land', use_local_files = None, tag = 'latest', template_dir = DEFAULT_TEMPLATE_DIR):
+    """
+    tsv2dict.instrument_dict for instrument, and the amf_vocabularies_release
+    global attribute (None if there isn't one), from memory or template_dir
+    if they have been read before. template_dir can be None to not store
+    them.
+    """
+    filename = template_file(template_dir or '.', instrument, loc, use_local_files, tag)
+    if filename in _templates:
+        return _templates[filename]
+    stored = None
+    if template_dir is not None:
+        try:
+            with open(filename, 'rb') as f:
+                stored = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+            # not stored yet, or a broken file that will be replaced
+            stored = None
+    if stored is None or (not use_local_files and time.time() - stored['saved'] > TEMPLATE_MAX_AGE):
+        try:
+            instrument_dict = tsv2dict.instrument_dict(instrument, loc = loc, use_local_files = use_local_files, tag = tag)
+            release = vocabularies_release(use_local_files, tag) if 'amf_vocabularies_release' in instrument_dict['common']['attributes'] else None
+            stored = {'saved': time.time(), 'instrument_dict': instrument_dict, 'release': release}
+        except Exception:
+            if stored is None:
+                raise
+            warnings.warn(f'Could not update AMOF definitions, using ones from {time.ctime(stored["saved"])}')
+        else:
+            if template_dir is not None:
+                save_template(filename, stored)
+    _templates[filename] = stored['instrument_dict'], stored['release']
+    return _templates[filename]
+
+
+
+def save_template(filename, stored):
+    """
+    Written to a temporary file first, so other processes never load a
+    partly written template.
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok = True)
+    fid, tmp_filename = tempfile.mkstemp(dir = os.path.dirname(filename), suffix = '.tmp')
+    try:
+        with os.fdopen(fid, 'wb') as f:
+            pickle.dump(stored, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+
+class EncodedVariables:
+    """
+    Stands in for the netCDF file in create_netcdf.add_variables, so the
+    variables in encoding are made with its createVariable keyword arguments
+    (chunksizes, zlib, complevel, shuffle). Variables with 'pack':
+    (scale_factor, add_offset) are stored as PACKED_TYPE. Attributes are
+    added as create_netcdf adds them.
+    """
+    def __init__(self, ncfile, encoding):
+        self.ncfile = ncfile
+        self.encoding = encoding
+        self.variables = ncfile.variables
+
+
+    def createVariable(self, varname, datatype, dimensions, **kwargs):
+        encoding = dict(self.encoding.get(varname, {}))
+        pack = encoding.pop('pack', None)
+        if pack is not None:
+            unpacked_type = np.dtype(datatype).type
+            datatype = PACKED_TYPE
+            kwargs['fill_value'] = PACKED_FILL_VALUE
+        var = self.ncfile.createVariable(varname, datatype, dimensions, **kwargs, **encoding)
+        if pack is not None:
+            var.scale_factor = unpacked_type(pack[0])
+            var.add_offset = unpacked_type(pack[1])
+        return var
+
+
+
+def make_netcdf(instrument, product, date, dimension_lengths = {}, loc = 'land', options = '', file_location = '.', use_local_files = None, tag = 'latest', template_dir = DEFAULT_TEMPLATE_DIR, variables = None, encoding = None):
+    """
+    create_netcdf.main(..., return_open = True) for one product, with the
+    definitions from load_template. Returns the open netCDF file.
+    variables - product variables to make, None for all of them. Leaving out
+                the ones that won't be filled means the file doesn't need
+                rewriting with remove_empty_variables afterwards.
+    encoding - {variable: createVariable keyword arguments} for chunking,
+               compressing or packing variables, see EncodedVariables and
+               lidar_util.get_variable_encoding
+    """
+    instrument_dict, release = load_template(instrument, loc = loc, use_local_files = use_local_files, tag = tag, template_dir = template_dir)
+    if product not in instrument_dict:
+        msg = f"No valid products specified, valid products are {[key for key in instrument_dict if key not in ['info', 'common']]}"
+        raise ValueError(msg)
+    if variables is not None:
+        product_dict = dict(instrument_dict[product], variables = {key: value for key, value in instrument_dict[product]['variables'].items() if key in variables})
+        instrument_dict = dict(instrument_dict, **{product: product_dict})
+
+    # fixed dimension lengths from the definitions, the rest from dimension_lengths, as in create_netcdf.main
+    dimlengths = {}
+    for key in ['common', product]:
+        for dim, dim_info in instrument_dict[key].get('dimensions', {}).items():
+            if dim not in dimlengths and (isinstance(dim_info['Length'], int) or '<' not in dim_info['Length']):
+                dimlengths[dim] = int(dim_info['Length'])
+    for key, value in dimension_lengths.items():
+        if key not in dimlengths:
+            dimlengths[key] = value
+
+    # tag is only used for amf_vocabularies_release, which is set from the template
+    if encoding:
+        # make the file without variables, then add them through EncodedVariables
+        no_variables = {key: dict(instrument_dict[key], variables = {}) for key in ['common', product]}
+        ncfile = create_netcdf.make_netcdf(instrument, product, date, dict(instrument_dict, **no_variables), loc = loc, dimension_lengths = dimlengths, options = options, file_location = file_location, use_local_files = None, tag = 'stored', return_open = True)
+        create_netcdf.add_variables(EncodedVariables(ncfile, encoding), instrument_dict, product)
+    else:
+        ncfile = create_netcdf.make_netcdf(instrument, product, date, instrument_dict, loc = loc, dimension_lengths = dimlengths, options = options, file_location = file_location, use_local_files = None, tag = 'stored', return_open = True)
+    if release is not None:
+        ncfile.setncattr('amf_vocabularies_release', release)
+    return ncfile
@@ -0,0 +1,97 @@
+"""
+Compare netCDF chunking, compression and packing settings (see
+lidar_util.get_encoding) on a synthetic day of Stare files: file size, time
+to write the file, and time to read radial velocity as a whole, as the time
+series at one gate and as profiles at single times.
+
+Write times include the QC and reading the raw files from a cache, which is
+the same for every setting. Read times are with the file in the OS page
+cache, so mostly show decompression and how many chunks are touched.
+
+python benchmarks/bench_encoding.py --rays 7200 --gates 200 -t /path/to/AMF_CVs/tsv
+"""
+import os
+import sys
+import glob
+import time
+import tempfile
+import numpy as np
+from netCDF4 import Dataset
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import process_lidar_stare
+import synthetic_hpl
+
+
+PACK = {'radial_velocity_of_scatterers_away_from_instrument': (0.001, 0.0), 'signal_to_noise_ratio_plus_1': (0.0001, 1.0), 'range': (0.5, 0.0)}
+SETTINGS = {
+    'default': {},
+    'zlib1': {'complevel': 1},
+    'zlib4': {'complevel': 4},
+    'zlib4-noshuffle': {'complevel': 4, 'shuffle': False},
+    'zlib4-time-series': {'complevel': 4, 'chunks': 'time-series'},
+    'zlib4-profile': {'complevel': 4, 'chunks': 'profile'},
+    'zlib4-time-series-packed': {'complevel': 4, 'chunks': 'time-series', 'pack': PACK},
+    'zlib4-profile-packed': {'complevel': 4, 'chunks': 'profile', 'pack': PACK},
+}
+VARIABLE = 'radial_velocity_of_scatterers_away_from_instrument'
+
+
+def time_reads(ncfile_path, profiles = 100, seed = 0):
+    """
+    Seconds to read VARIABLE whole, the time series at the middle gate, and
+    profiles at random times.
+    """
+    times = {}
+    with Dataset(ncfile_path) as ncfile:
+        variable = ncfile.variables[VARIABLE]
+        start = time.perf_counter()
+        variable[:]
+        times['full'] = time.perf_counter() - start
+        start = time.perf_counter()
+        variable[:, variable.shape[1] // 2, 0]
+        times['time_series'] = time.perf_counter() - start
+        rows = np.random.default_rng(seed).integers(0, variable.shape[0], profiles)
+        start = time.perf_counter()
+        for row in rows:
+            variable[row, :, 0]
+        times['profiles'] = time.perf_counter() - start
+    return times
+
+
+def write_file(lidar_files, ncfile_location, encoding, local_tsv_file_loc = None, cache_dir = None):
+    """
+    Make the Stare file with encoding, returns its path and the seconds taken.
+    """
+    for ncfile_path in glob.glob(f'{ncfile_location}/*.nc'):
+        os.remove(ncfile_path)
+    start = time.perf_counter()
+    process_lidar_stare.make_netcdf_aerosol_backscatter_radial_winds(lidar_files, ncfile_location = ncfile_location, local_tsv_file_loc = local_tsv_file_loc, cache_dir = cache_dir, encoding = encoding)
+    return glob.glob(f'{ncfile_location}/*.nc')[0], time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Benchmark netCDF chunking, compression and packing settings.')
+    parser.add_argument('--rays', type = int, help = 'Number of rays in each of the 4 Stare files. Default 7200 (6 hours at 3 s).', default = 7200)
+    parser.add_argument('--gates', type = int, help = 'Number of gates per ray. Default 200.', default = 200)
+    parser.add_argument('--profiles', type = int, help = 'Number of single time profiles to read. Default 100.', default = 100)
+    parser.add_argument('--settings', nargs = '*', help = f'Settings to compare. Options are {", ".join(SETTINGS)}, default is all of them.', default = list(SETTINGS), choices = list(SETTINGS))
+    parser.add_argument('-t','--tsv-location', type = str, help = "Path to local file location for AMF_CVs tsv files for 'offline' use. Default is None ('online' use).", default = None, dest = 'tsv_location')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        lidar_files = []
+        for i in range(4):
+            lidar_files.append(f'{tmpdir}/Stare_118_20230615_{i * 6:02d}.hpl')
+            synthetic_hpl.write_stare_file(lidar_files[-1], rays = args.rays, gates = args.gates, start_hour = i * 6 + 0.003, seed = i)
+        os.makedirs(f'{tmpdir}/nc')
+        # parse the raw files into the cache first, so every setting reads them the same way
+        write_file(lidar_files, f'{tmpdir}/nc', {}, args.tsv_location, f'{tmpdir}/cache')
+
+        print(f'{4 * args.rays} rays, {args.gates} gates, reading {VARIABLE}')
+        print(f'{"setting":<26} {"size MB":>8} {"write s":>8} {"full s":>8} {"gate s":>8} {f"{args.profiles} profiles s":>15}')
+        for setting in args.settings:
+            ncfile_path, write_time = write_file(lidar_files, f'{tmpdir}/nc', SETTINGS[setting], args.tsv_location, f'{tmpdir}/cache')
+            read_times = time_reads(ncfile_path, args.profiles)
+            print(f'{setting:<26} {os.path.getsize(ncfile_path) / 1e6:>8.1f} {write_time:>8.2f} {read_times["full"]:>8.3f} {read_times["time_series"]:>8.3f} {read_times["profiles"]:>15.3f}')
@@ -0,0 +1,56 @@
+"""
+Compare aerosol_backscatter_qc against the original per-ray QC on synthetic
+Stare data, and check the flags are identical.
+
+python benchmarks/bench_qc.py --rays 28800 --gates 200
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import aerosol_backscatter_qc
+import legacy_aerosol_backscatter_qc
+import synthetic_hpl
+
+
+def make_qc_inputs(rays, gates, angles = 2, gate_length = 30.0, seed = 0):
+    """
+    (time, gate, angle) masked arrays laid out as the processing scripts
+    make them. Only the first angle has data, the rest are masked.
+    """
+    rng = np.random.default_rng(seed)
+    doppler, intensity, backscatter = synthetic_hpl.make_ray_data(rng, rays, gates)
+    ranges = np.broadcast_to((np.arange(gates) + 0.5) * gate_length, (rays, gates))
+    arrays = []
+    for values in [ranges, doppler, intensity, backscatter]:
+        arr = np.ma.masked_all((rays, gates, angles))
+        arr.data[:] = -9999
+        arr[:,:,0] = values
+        arrays.append(arr)
+    return arrays
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Benchmark the QC against the original per-ray QC.')
+    parser.add_argument('--rays', type = int, help = 'Number of rays. Default 28800 (one day at 3 s).', default = 28800)
+    parser.add_argument('--gates', type = int, help = 'Number of gates per ray. Default 200.', default = 200)
+    args = parser.parse_args()
+
+    ranges, velocity, intensity, backscatter = make_qc_inputs(args.rays, args.gates)
+
+    start = time.perf_counter()
+    # ranges are the same for every ray, the current QC takes them per gate
+    new_flags = aerosol_backscatter_qc.make_flags(ranges[0], velocity, intensity, backscatter)
+    new_time = time.perf_counter() - start
+    print(f'aerosol_backscatter_qc.make_flags: {new_time:.2f} s')
+
+    start = time.perf_counter()
+    old_flags = legacy_aerosol_backscatter_qc.make_flags(ranges, velocity, intensity, backscatter)
+    old_time = time.perf_counter() - start
+    print(f'original make_flags:               {old_time:.2f} s ({old_time / new_time:.1f}x slower)')
+
+    assert np.array_equal(np.asarray(new_flags), np.asarray(old_flags)), 'Flags differ'
+    print('Flags match')
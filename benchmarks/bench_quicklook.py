@@ -0,0 +1,76 @@
+"""
+Time making a lidar_quicklook pyramid of a day of Stare rays, and reading a
+whole day for plotting from it against reading the full resolution
+variable. Random velocities and backscatter with random QC flags, in a
+netCDF file with just the variables the pyramid uses, stand in for the
+Stare file.
+
+python benchmarks/bench_quicklook.py --rays 28800 --gates 200 --pixels 1000
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from netCDF4 import Dataset
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import lidar_quicklook
+
+
+def write_day(path, unix_times, ranges, values, flags):
+    """
+    netCDF file at path with the variables lidar_quicklook uses.
+    """
+    with Dataset(path, 'w') as ncfile:
+        ncfile.createDimension('time', len(unix_times))
+        ncfile.createDimension('index_of_range', len(ranges))
+        ncfile.createDimension('index_of_angle', 1)
+        ncfile.createVariable('time', 'f8', ('time',))[:] = unix_times
+        ncfile.createVariable('range', 'f4', ('time', 'index_of_range', 'index_of_angle'))[:] = np.broadcast_to(ranges[:,np.newaxis], (len(unix_times), len(ranges), 1))
+        for name, flag_name in lidar_quicklook.VARIABLES.items():
+            ncfile.createVariable(name, 'f4', ('time', 'index_of_range', 'index_of_angle')).units = 'm s-1'
+            ncfile.variables[name][:] = values[name]
+            ncfile.createVariable(flag_name, 'b', ('time', 'index_of_range', 'index_of_angle'))[:] = flags
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Benchmark the quick-look pyramid of lidar_quicklook.')
+    parser.add_argument('--rays', type = int, help = 'Number of rays. Default 28800 (a day at 3 s).', default = 28800)
+    parser.add_argument('--gates', type = int, help = 'Number of gates per ray. Default 200.', default = 200)
+    parser.add_argument('--pixels', type = int, help = 'Width of the plot in pixels. Default 1000.', default = 1000)
+    parser.add_argument('--rays-per-file', type = int, help = 'Rays added at a time, as a raw file would be. Default 1200 (an hour).', default = 1200, dest = 'rays_per_file')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    unix_times = 1686787200 + np.arange(args.rays) * 3.
+    ranges = (np.arange(args.gates) + 0.5) * 30.
+    flags = np.where(rng.random((args.rays, args.gates, 1)) < 0.7, 1, 2).astype(np.int8)
+    values = {name: rng.normal(0, 1, (args.rays, args.gates, 1)).astype(np.float32) for name in lidar_quicklook.VARIABLES}
+    name = 'attenuated_aerosol_backscatter_coefficient'
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench_stare_v1.0.nc')
+        write_day(path, unix_times, ranges, values, flags)
+        start = time.perf_counter()
+        with Dataset(path, 'a') as ncfile:
+            quicklook = lidar_quicklook.QuicklookFile(ncfile, args.rays, ranges[:,np.newaxis])
+            for first in range(0, args.rays, args.rays_per_file):
+                rays = slice(first, first + args.rays_per_file)
+                quicklook.add(unix_times[rays], flags[rays], {key: value[rays] for key, value in values.items()})
+            quicklook.close(ncfile)
+        make_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with Dataset(path) as ncfile:
+            full = np.ma.masked_where(ncfile.variables[lidar_quicklook.VARIABLES[name]][:] != 1, ncfile.variables[name][:])
+        full_time = time.perf_counter() - start
+        start = time.perf_counter()
+        result = lidar_quicklook.read_quicklook(quicklook.path, name, pixels = args.pixels)
+        read_time = time.perf_counter() - start
+        sizes = os.path.getsize(path), os.path.getsize(quicklook.path)
+
+    print(f'{args.rays} rays, {args.gates} gates, {quicklook.levels} levels, full file {sizes[0] / 1024**2:.1f} MB, pyramid {sizes[1] / 1024**2:.1f} MB')
+    print(f'making the pyramid: {make_time:.3f} s')
+    print(f'whole day at {args.pixels} pixels: level {result["level"]} ({result["mean"].shape[0]} x {result["mean"].shape[1]}, {result["mean"].nbytes * 3 / 1024**2:.1f} MB) in {read_time:.3f} s, full resolution ({full.nbytes / 1024**2:.1f} MB) in {full_time:.3f} s ({full_time / read_time:.1f}x slower)')
@@ -0,0 +1,81 @@
+"""
+Compare read_lidar.readLidarFile against the original line-by-line parser
+on a synthetic full-day Stare file, and check the outputs are identical.
+
+python benchmarks/bench_read_lidar.py --rays 28800 --gates 200
+"""
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import read_lidar
+import legacy_read_lidar
+import synthetic_hpl
+
+
+def compare_outputs(new, old, fields = None):
+    """
+    Raise AssertionError if the two readLidarFile dicts differ.
+    Arrays are compared by value, so e.g. an integer RG matches the
+    original float RG, datetime64 DP matches the original datetimes, and
+    the TimeStamp array matches the values of the original parse results.
+    If new was read with only some fields, just those are compared.
+    """
+    if fields is not None:
+        old = {key: value for key, value in old.items() if key in fields or key not in read_lidar.FIELDS}
+    assert new.keys() == old.keys(), f'Different keys: {new.keys() ^ old.keys()}'
+    for key in new:
+        if key == 'TimeStamp':
+            assert np.array_equal(new[key], [timestamp.fixed for timestamp in old[key]]), key
+        elif key == 'DP':
+            assert np.array_equal(new[key], old[key].astype('datetime64[us]')), key
+        elif isinstance(old[key], np.ndarray):
+            assert np.array_equal(new[key], old[key]), key
+        else:
+            assert new[key] == old[key], key
+
+
+def time_reader(reader, lidar_file, repeat):
+    """
+    Best time over repeat runs, and peak traced memory of the last run.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = reader(lidar_file)
+        times.append(time.perf_counter() - start)
+    del data
+    tracemalloc.start()
+    data = reader(lidar_file)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak, data
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Benchmark the .hpl reader against the original parser.')
+    parser.add_argument('--rays', type = int, help = 'Number of rays in the synthetic file. Default 28800 (one day at 3 s).', default = 28800)
+    parser.add_argument('--gates', type = int, help = 'Number of gates per ray. Default 200.', default = 200)
+    parser.add_argument('--repeat', type = int, help = 'Number of timing repeats, best is reported. Default 1.', default = 1)
+    parser.add_argument('--skip-legacy', action = 'store_true', help = 'Only time the current reader.', dest = 'skip_legacy')
+    parser.add_argument('--fields', type = str, help = 'Comma separated arrays for the current reader to return, e.g. D,AZ,EL,DP for the mean winds. Default is all.', default = None)
+    args = parser.parse_args()
+    fields = None if args.fields is None else args.fields.split(',')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        lidar_file = f'{tmpdir}/Stare_118_20230615_00.hpl'
+        synthetic_hpl.write_stare_file(lidar_file, rays = args.rays, gates = args.gates)
+        print(f'Synthetic file: {args.rays} rays, {args.gates} gates, {os.path.getsize(lidar_file) / 1e6:.1f} MB')
+
+        new_time, new_peak, new_data = time_reader(lambda lidar_file: read_lidar.readLidarFile(lidar_file, fields = fields), lidar_file, args.repeat)
+        print(f'read_lidar.readLidarFile: {new_time:.2f} s, peak memory {new_peak / 1e6:.1f} MB')
+        if not args.skip_legacy:
+            old_time, old_peak, old_data = time_reader(legacy_read_lidar.readLidarFile, lidar_file, args.repeat)
+            print(f'original readLidarFile:   {old_time:.2f} s ({old_time / new_time:.1f}x slower), peak memory {old_peak / 1e6:.1f} MB')
+            compare_outputs(new_data, old_data, fields)
+            print('Outputs match')
@@ -0,0 +1,57 @@
+"""
+Time lidar_resample.bin_sums, the one pass np.add.reduceat binning of the
+averaged files, against averaging each bin in a loop, and check they match.
+Random velocities, backscatter and SNR with random QC flags stand in for a
+day of Stare rays.
+
+python benchmarks/bench_resample.py --rays 28800 --gates 200 --interval 10
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import lidar_resample
+
+
+def loop_statistics(bins, good, values):
+    """
+    Mean and variance of the good values of each bin, a bin at a time.
+    """
+    statistics = {name: [] for name in values}
+    for b in np.unique(bins):
+        rays = bins == b
+        for name, value in values.items():
+            binned = np.ma.masked_array(value[rays], mask = ~good[rays])
+            statistics[name].append((binned.mean(axis = 0), binned.var(axis = 0)))
+    return statistics
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Benchmark the binned averages of lidar_resample.')
+    parser.add_argument('--rays', type = int, help = 'Number of rays. Default 28800 (a day at 3 s).', default = 28800)
+    parser.add_argument('--gates', type = int, help = 'Number of gates per ray. Default 200.', default = 200)
+    parser.add_argument('--interval', type = float, help = 'Averaging interval in seconds. Default 10.', default = 10.)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    unix_times = 1686787200 + np.arange(args.rays) * 3.
+    good = rng.random((args.rays, args.gates, 1)) < 0.7
+    values = {name: rng.normal(0, 1, (args.rays, args.gates, 1)) for name in lidar_resample.VARIABLES}
+    bins = np.floor_divide(unix_times, args.interval).astype(np.int64)
+
+    start = time.perf_counter()
+    _, _, counts, sums = lidar_resample.bin_sums(bins, good, values)
+    statistics = {name: lidar_resample.bin_statistics(counts, *sums[name]) for name in values}
+    new_time = time.perf_counter() - start
+    start = time.perf_counter()
+    loop = loop_statistics(bins, good, values)
+    old_time = time.perf_counter() - start
+
+    for name in values:
+        assert np.ma.allclose(statistics[name][0], np.ma.stack([mean for mean, _ in loop[name]])), name
+        assert np.ma.allclose(statistics[name][1], np.ma.stack([variance for _, variance in loop[name]])), name
+    print(f'{args.rays} rays, {args.gates} gates, {len(counts)} bins of {args.interval:g} s')
+    print(f'bin_sums: {new_time:.3f} s, loop over bins: {old_time:.3f} s ({old_time / new_time:.1f}x slower), results match')
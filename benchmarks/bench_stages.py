@@ -0,0 +1,207 @@
+"""
+Time each stage of the processing on a synthetic day of Stare and
+Wind_Profile files, and save the results as JSON for comparing versions.
+
+Stages, for each scan type:
+    header_parse      read_lidar.getStareFileHeader of every file
+    data_parse        read_lidar.getStareFileData of every file
+    time_conversion   read_lidar.decTimetoDecDate and lidar_util.get_times
+    struct_conversion arrays of the parsed files as the writers use them
+                      (process_lidar_stare.get_data, or
+                      process_lidar_wind_profile.stack_scans and get_radial_winds)
+    qc                aerosol_backscatter_qc.make_flags
+    winds             process_lidar_wind_profile.get_mean_winds (Wind_Profile only)
+    netcdf_write      making the netCDF files from already parsed data (cached
+                      Stare files, or read_scans for Wind_Profile), so it
+                      includes the arrays and QC as well as the writing
+
+Each stage's time is the best of --repeat runs. Peak memory is from a
+separate run under tracemalloc, which sees numpy but not the netCDF library.
+
+python benchmarks/bench_stages.py -t /path/to/AMF_CVs/tsv -o results.json
+python benchmarks/bench_stages.py -t /path/to/AMF_CVs/tsv --compare old_results.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import datetime as dt
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import read_lidar
+import lidar_util
+import aerosol_backscatter_qc
+import process_lidar_stare
+import process_lidar_wind_profile
+import synthetic_hpl
+
+
+def measure(function, repeat = 1, memory = True):
+    """
+    Run function repeat times. Returns its result, the best time in seconds,
+    and the peak memory in bytes of one more run under tracemalloc (None if
+    not memory).
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    peak = None
+    if memory:
+        del result
+        tracemalloc.start()
+        result = function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, min(seconds), peak
+
+
+def parse_stages(lidar_files, stage):
+    """
+    Header, data and time stages of lidar_files, with stage(name, function)
+    running and recording each.
+    """
+    headers = stage('header_parse', lambda: [read_lidar.getStareFileHeader(lidar_file) for lidar_file in lidar_files])
+    parsed = stage('data_parse', lambda: [read_lidar.getStareFileData(lidar_file, header[0], header[1]) for lidar_file, header in zip(lidar_files, headers)])
+    def convert_times():
+        times = []
+        for header, data in zip(headers, parsed):
+            _, DP = read_lidar.decTimetoDecDate(header[3], data[7], header[1], data[0])
+            times.append(lidar_util.get_times(DP))
+        return times
+    stage('time_conversion', convert_times)
+
+
+def stare_stages(lidar_files, ncfile_location, cache_dir, local_tsv_file_loc = None, repeat = 1, memory = True):
+    """
+    {stage: {'seconds', 'peak_mb'}} for a day of Stare files.
+    """
+    results = {}
+    def stage(name, function):
+        result, seconds, peak = measure(function, repeat, memory)
+        results[name] = {'seconds': round(seconds, 4), 'peak_mb': None if peak is None else round(peak / 1e6, 1)}
+        return result
+
+    parse_stages(lidar_files, stage)
+    all_file_data = [read_lidar.readLidarFile(lidar_file, fields = process_lidar_stare.STARE_FIELDS) for lidar_file in lidar_files]
+    # the arrays of every file are kept for the QC, so each file gets its own
+    file_arrays = stage('struct_conversion', lambda: [process_lidar_stare.get_data(data)[2:6] for data in all_file_data])
+    stage('qc', lambda: [aerosol_backscatter_qc.make_flags(datarange, datavel, dataint, databs) for datarange, datavel, databs, dataint in file_arrays])
+    del file_arrays
+
+    # parse into the cache first, so writing doesn't include parsing
+    process_lidar_stare.make_netcdf_aerosol_backscatter_radial_winds(lidar_files, ncfile_location = ncfile_location, local_tsv_file_loc = local_tsv_file_loc, cache_dir = cache_dir)
+    stage('netcdf_write', lambda: process_lidar_stare.make_netcdf_aerosol_backscatter_radial_winds(lidar_files, ncfile_location = ncfile_location, local_tsv_file_loc = local_tsv_file_loc, cache_dir = cache_dir))
+    return results
+
+
+def wind_profile_stages(lidar_files, ncfile_location, local_tsv_file_loc = None, repeat = 1, memory = True):
+    """
+    {stage: {'seconds', 'peak_mb'}} for a day of Wind_Profile files.
+    """
+    results = {}
+    def stage(name, function):
+        result, seconds, peak = measure(function, repeat, memory)
+        results[name] = {'seconds': round(seconds, 4), 'peak_mb': None if peak is None else round(peak / 1e6, 1)}
+        return result
+
+    parse_stages(lidar_files, stage)
+    fields = process_lidar_wind_profile.RADIAL_WINDS_FIELDS + process_lidar_wind_profile.MEAN_WINDS_FIELDS
+    all_file_data = [read_lidar.readLidarFile(lidar_file, fields = sorted(set(fields))) for lidar_file in lidar_files]
+    no_angles = process_lidar_wind_profile.scan_files(lidar_files)[2]
+    def make_structs():
+        scans = process_lidar_wind_profile.stack_scans(lidar_files, all_file_data, fields, no_angles)
+        return scans, process_lidar_wind_profile.get_radial_winds(scans)
+    scans, radial_winds = stage('struct_conversion', make_structs)
+    datarange, datavel, databs, dataint = radial_winds[:4]
+    stage('qc', lambda: aerosol_backscatter_qc.make_flags(datarange, datavel, dataint, databs))
+    stage('winds', lambda: process_lidar_wind_profile.get_mean_winds(scans))
+
+    def write():
+        process_lidar_wind_profile.make_netcdf_aerosol_backscatter_radial_winds(lidar_files, ncfile_location = ncfile_location, local_tsv_file_loc = local_tsv_file_loc, cache_dir = None, scans = scans)
+        process_lidar_wind_profile.make_netcdf_mean_winds_profile(lidar_files, ncfile_location = ncfile_location, local_tsv_file_loc = local_tsv_file_loc, cache_dir = None, scans = scans)
+    stage('netcdf_write', write)
+    return results
+
+
+def git_version():
+    """
+    Commit of the code being benchmarked, with '-dirty' if it has changes.
+    None if it isn't a git checkout.
+    """
+    tree = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd = tree, capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(new, old):
+    """
+    Print the stages of new and old results side by side, with the ratio of
+    old to new time (above 1 is faster).
+    """
+    print(f'{"stage":<32} {"old s":>9} {"new s":>9} {"speedup":>8} {"old MB":>8} {"new MB":>8}')
+    for scan_type, stages in new['stages'].items():
+        for name, result in stages.items():
+            old_result = old['stages'].get(scan_type, {}).get(name)
+            if old_result is None:
+                continue
+            speedup = old_result['seconds'] / result['seconds'] if result['seconds'] else float('nan')
+            print(f'{f"{scan_type} {name}":<32} {old_result["seconds"]:>9.4f} {result["seconds"]:>9.4f} {speedup:>7.2f}x {str(old_result["peak_mb"]):>8} {str(result["peak_mb"]):>8}')
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Benchmark each processing stage on synthetic .hpl files.')
+    parser.add_argument('--stare-files', type = int, help = 'Number of Stare files (1-24, spread over the day). Default 24.', default = 24, dest = 'stare_files')
+    parser.add_argument('--rays', type = int, help = 'Number of rays in each Stare file. Default 1200 (an hour at 3 s).', default = 1200)
+    parser.add_argument('--gates', type = int, help = 'Number of gates per ray, for Stare files. Default 200.', default = 200)
+    parser.add_argument('--scans', type = int, help = 'Number of Wind_Profile files (one scan each). Default 144 (a day at 10 minutes).', default = 144)
+    parser.add_argument('--scan-gates', type = int, help = 'Number of gates per ray, for Wind_Profile files. Default 100.', default = 100, dest = 'scan_gates')
+    parser.add_argument('--repeat', type = int, help = 'Number of timing repeats, best is reported. Default 1.', default = 1)
+    parser.add_argument('--no-memory', action = 'store_true', help = "Don't measure peak memory (saves running each stage again).", dest = 'no_memory')
+    parser.add_argument('--scan-types', nargs = '*', help = 'Scan types to benchmark, stare and/or wind-profile. Default is both.', default = ['stare', 'wind-profile'], choices = ['stare', 'wind-profile'], dest = 'scan_types')
+    parser.add_argument('-t','--tsv-location', type = str, help = "Path to local file location for AMF_CVs tsv files for 'offline' use. Default is None ('online' use).", default = None, dest = 'tsv_location')
+    parser.add_argument('-o','--output', type = str, help = 'Where to write the JSON results. Default is bench_stages_<version>.json', default = None, dest = 'output')
+    parser.add_argument('--compare', type = str, help = 'JSON results of another run to compare against.', default = None, dest = 'compare')
+    args = parser.parse_args()
+
+    version = git_version()
+    results = {
+        'version': version,
+        'date': dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'config': {key: value for key, value in vars(args).items() if key not in ['tsv_location', 'output', 'compare']},
+        'stages': {},
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.makedirs(f'{tmpdir}/raw')
+        os.makedirs(f'{tmpdir}/nc')
+        if 'stare' in args.scan_types:
+            stare_files = synthetic_hpl.write_stare_day(f'{tmpdir}/raw', files = args.stare_files, rays = args.rays, gates = args.gates)
+            results['stages']['stare'] = stare_stages(stare_files, f'{tmpdir}/nc', f'{tmpdir}/cache', args.tsv_location, args.repeat, not args.no_memory)
+        if 'wind-profile' in args.scan_types:
+            wp_files = synthetic_hpl.write_wind_profile_day(f'{tmpdir}/raw', scans = args.scans, gates = args.scan_gates)
+            results['stages']['wind-profile'] = wind_profile_stages(wp_files, f'{tmpdir}/nc', args.tsv_location, args.repeat, not args.no_memory)
+
+    output = args.output if args.output is not None else f'bench_stages_{version or "unknown"}.json'
+    with open(output, 'w') as f:
+        json.dump(results, f, indent = 1)
+
+    print(f'{"stage":<32} {"seconds":>9} {"peak MB":>8}')
+    for scan_type, stages in results['stages'].items():
+        for name, result in stages.items():
+            print(f'{f"{scan_type} {name}":<32} {result["seconds"]:>9.4f} {str(result["peak_mb"]):>8}')
+    print(f'Results written to {output}')
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare_results(results, json.load(f))
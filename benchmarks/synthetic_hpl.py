@@ -0,0 +1,111 @@
+"""
+Writers for synthetic Halo Photonics .hpl files, for use in the benchmarks.
+
+The header has the fields read by read_lidar.getStareFileHeader, and the data
+section uses the same fixed-width layout as the instrument:
+    timestamp line: decimal time (hours), azimuth, elevation
+    gate lines:     gate index, doppler, intensity (SNR + 1), beta
+"""
+import numpy as np
+
+
+HEADER_TEMPLATE = """Filename:\t{filename}
+System ID:\t118
+Number of gates:\t{gates}
+Range gate length (m):\t{gate_length:.1f}
+Gate length (pts):\t10
+Pulses/ray:\t{pulses_per_ray}
+No. of rays in file:\t{rays_per_point}
+Scan type:\t{scan_type}
+Focus range:\t65535
+Start time:\t{start_time}
+Resolution (m/s):\t0.0382
+Range of measurement (center of gate) = (range gate + 0.5) * Gate length
+Data line 1: Decimal time (hours)  Azimuth (degrees)  Elevation (degrees)
+f9.6,1x,f6.2,1x,f6.2
+Data line 2: Range Gate  Doppler (m/s)  Intensity (SNR + 1)  Beta (m-1 sr-1)
+i3,1x,f6.4,1x,f8.6,1x,e12.6 - repeat for no. gates
+****
+"""
+
+
+def make_ray_data(rng, rays, gates):
+    """
+    Random but plausible doppler, intensity and backscatter for each gate.
+    Signal decays with range and the far gates are noise, including
+    negative backscatter, so all of the QC checks have something to find.
+    """
+    gate_index = np.arange(gates)
+    decay = np.exp(-gate_index / (gates / 6))
+    doppler = rng.normal(0, 1.5, (rays, gates)) + rng.normal(0, 0.3, (rays, 1))
+    doppler[:, gates // 2:] = rng.uniform(-19.5, 19.5, (rays, gates - gates // 2))
+    intensity = 1 + 0.2 * decay + rng.normal(0, 0.004, (rays, gates))
+    backscatter = 1e-5 * decay + rng.normal(0, 2e-7, (rays, gates))
+    return doppler, intensity, backscatter
+
+
+def write_hpl_file(filename, decimal_times, azimuths, elevations, gates = 200, gate_length = 30.0, datadate = '20230615', scan_type = 'Stare', pulses_per_ray = 15000, rays_per_point = 1, seed = 0):
+    """
+    Write a synthetic .hpl file with one ray per entry of decimal_times.
+    decimal_times are hours since midnight of datadate, and wrap back to 0
+    after midnight as they do in the instrument files.
+    """
+    rng = np.random.default_rng(seed)
+    rays = len(decimal_times)
+    doppler, intensity, backscatter = make_ray_data(rng, rays, gates)
+    first = decimal_times[0]
+    start_time = f"{datadate} {int(first):02d}:{int(first * 60 % 60):02d}:{first * 3600 % 60:05.2f}"
+    header = HEADER_TEMPLATE.format(filename = filename.split('/')[-1], gates = gates, gate_length = gate_length,
+                                    pulses_per_ray = pulses_per_ray, rays_per_point = rays_per_point,
+                                    scan_type = scan_type, start_time = start_time)
+    with open(filename, 'wt') as fid:
+        fid.write(header)
+        for i in range(rays):
+            lines = [f"{decimal_times[i]:9.6f} {azimuths[i]:6.2f} {elevations[i]:6.2f}"]
+            lines.extend(f"{g:3d} {d:6.4f} {s:8.6f} {b:12.6E}" for g, d, s, b in zip(range(gates), doppler[i], intensity[i], backscatter[i]))
+            fid.write('\n'.join(lines))
+            fid.write('\n')
+
+
+def write_stare_file(filename, rays = 28800, gates = 200, ray_interval = 3.0, start_hour = 0.003, azimuth = 0.0, elevation = 90.0, **kwargs):
+    """
+    Write a synthetic Stare file. The defaults give a full day of rays at a
+    fixed pointing angle, with the last few rays just past midnight.
+    """
+    decimal_times = (start_hour + np.arange(rays) * ray_interval / 3600) % 24
+    azimuths = np.full(rays, azimuth)
+    elevations = np.full(rays, elevation)
+    write_hpl_file(filename, decimal_times, azimuths, elevations, gates = gates, **kwargs)
+
+
+def write_stare_day(directory, files = 24, rays = 1200, gates = 200, ray_interval = 3.0, datadate = '20230615', **kwargs):
+    """
+    Write a day of synthetic Stare files, evenly spaced through the day
+    (hourly by default) and each rays long. Files are named by hour, as the
+    instrument's are, so there can be at most 24. Returns the file names.
+    """
+    if not 0 < files <= 24:
+        raise ValueError(f'Stare files are named by hour, so there can be 1 to 24 of them, not {files}')
+    lidar_files = []
+    for i in range(files):
+        start_hour = i * 24 / files + 0.003
+        filename = f"{directory}/Stare_118_{datadate}_{int(start_hour):02d}.hpl"
+        write_stare_file(filename, rays = rays, gates = gates, ray_interval = ray_interval, start_hour = start_hour, datadate = datadate, seed = i, **kwargs)
+        lidar_files.append(filename)
+    return lidar_files
+
+
+def write_wind_profile_day(directory, scans = 144, gates = 100, scan_interval = 600.0, start_hour = 0.05, ray_interval = 4.0, azimuths = (359.99, 0.0, 90.0), elevations = (90.0, 75.0, 75.0), datadate = '20230615', **kwargs):
+    """
+    Write a day of synthetic Wind_Profile files, each one scan with a ray at
+    each of azimuths and elevations (by default vertical, then north and
+    east, as calculate_3d_winds needs). Returns the file names.
+    """
+    lidar_files = []
+    for i in range(scans):
+        first = start_hour + i * scan_interval / 3600
+        decimal_times = first + np.arange(len(azimuths)) * ray_interval / 3600
+        filename = f"{directory}/Wind_Profile_118_{datadate}_{int(first):02d}{int(first * 60 % 60):02d}{int(first * 3600 % 60):02d}.hpl"
+        write_hpl_file(filename, decimal_times, azimuths, elevations, gates = gates, datadate = datadate, scan_type = 'VAD', rays_per_point = len(azimuths), seed = i, **kwargs)
+        lidar_files.append(filename)
+    return lidar_files
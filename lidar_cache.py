@@ -0,0 +1,125 @@
+"""
+On-disk cache of read_lidar.readLidarFile outputs, so raw .hpl files that
+have already been parsed aren't parsed again.
+
+Each file's arrays and header values are saved as one .npz file in the
+cache directory, named from the raw file's path, size, modification time
+and read_lidar.READER_VERSION, so a changed file or reader is never served
+from the cache. The cache is kept under a maximum size by removing the
+least recently used entries. Caching is off unless a cache directory is
+given.
+"""
+import os
+import hashlib
+import tempfile
+import zipfile
+import numpy as np
+
+import read_lidar
+
+
+DEFAULT_MAX_SIZE = 10 * 1024**3
+
+# arrays saved, the rest of readLidarFile's arrays are worked out from these
+ARRAY_KEYS = ['DT', 'AZ', 'EL', 'RG', 'D', 'I', 'B', 'DP']
+HEADER_KEYS = ['num_headerlines', 'gate_number', 'gate_length', 'datadate', 'maximum', 'pulses_per_ray', 'rays_per_point', 'focus_range', 'resolution']
+
+
+def cache_file(cache_dir, lidar_file):
+    """
+    Path in cache_dir of the cache entry for lidar_file.
+    """
+    stat = os.stat(lidar_file)
+    key = f'{os.path.abspath(lidar_file)}|{stat.st_size}|{stat.st_mtime_ns}|{read_lidar.READER_VERSION}'
+    return os.path.join(cache_dir, f'{hashlib.sha1(key.encode()).hexdigest()}.npz')
+
+
+def load(cache_dir, lidar_file, header_only = False, fields = None):
+    """
+    readLidarFile dict for lidar_file from the cache, or None if it isn't
+    cached. With header_only, just the header values (and 'maximum') are
+    loaded, which doesn't need the arrays to be read. fields is as for
+    read_lidar.readLidarFile, only the arrays needed for them are read.
+    """
+    wanted = set([] if header_only else read_lidar.FIELDS if fields is None else fields)
+    filename = cache_file(cache_dir, lidar_file)
+    try:
+        with np.load(filename, allow_pickle = False) as cached:
+            data = {key: cached[key].item() for key in HEADER_KEYS}
+            data.update({key: cached[key] for key in ARRAY_KEYS if key in wanted or (key == 'RG' and 'A' in wanted) or (key in ['DT', 'AZ', 'EL'] and 'TimeStamp' in wanted)})
+            if 'DD' in wanted:
+                DD = cached['DD']
+        # mark as recently used
+        os.utime(filename)
+    except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+        # not cached, or a broken entry that will be replaced
+        return None
+    if 'DD' in wanted:
+        data['DD'] = np.broadcast_to(DD, (data['maximum'], data['gate_number']))
+    if 'A' in wanted:
+        data['A'] = read_lidar.gateRangeToAlt(data['RG'], data['gate_length'])
+    if 'TimeStamp' in wanted:
+        data['TimeStamp'] = np.hstack([data['DT'], data['AZ'], data['EL']])
+    return {key: value for key, value in data.items() if key in wanted or key not in read_lidar.FIELDS}
+
+
+def save(cache_dir, lidar_file, data):
+    """
+    Add the readLidarFile dict data for lidar_file to the cache.
+    Written to a temporary file first, so other processes never see a
+    partly written entry.
+    """
+    os.makedirs(cache_dir, exist_ok = True)
+    arrays = {key: data[key] for key in ARRAY_KEYS}
+    arrays.update({key: np.array(data[key]) for key in HEADER_KEYS})
+    # DD is the same for every gate of a ray
+    arrays['DD'] = data['DD'][:,:1]
+    fid, tmp_filename = tempfile.mkstemp(dir = cache_dir, suffix = '.tmp')
+    try:
+        with os.fdopen(fid, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_filename, cache_file(cache_dir, lidar_file))
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+def readLidarFile(lidar_file, cache_dir, fields = None):
+    """
+    read_lidar.readLidarFile, using and adding to the cache in cache_dir.
+    A file that isn't cached yet is read in full so it can be added, then
+    cut down to fields.
+    """
+    data = load(cache_dir, lidar_file, fields = fields)
+    if data is None:
+        data = read_lidar.readLidarFile(lidar_file)
+        # a file with no complete ray yet (e.g. just started) has no arrays
+        # to save, and will be a different entry once it has some
+        if data['maximum'] > 0:
+            save(cache_dir, lidar_file, data)
+        if fields is not None:
+            data = {key: value for key, value in data.items() if key in fields or key not in read_lidar.FIELDS}
+    return data
+
+
+def evict(cache_dir, max_size = DEFAULT_MAX_SIZE):
+    """
+    Remove the least recently used entries until the cache is no bigger
+    than max_size bytes.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.npz'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
@@ -0,0 +1,294 @@
+"""
+Multi-resolution quick-looks of the Stare radial winds, so long periods can
+be plotted without reading every ray and gate of the full resolution file.
+
+The Stare writer can also write a pyramid of levels to a sidecar netCDF
+file, each in a group 'level_<k>'. Each row of level k is a block of
+TIME_FACTOR rows of level k - 1 (level 0 being the rays of the full
+resolution file), and while there are at least 2 * MIN_GATES gates, each
+gate is a pair of gates. Every level has the minimum, maximum and mean of
+the values with QC flag 1, with the first and last time of the rays in each
+row. Levels are built a file at a time as the rays are written, carrying
+the rows of an unfinished block on to the next file. With a factor of 4 the
+levels together are a third of the rows of the full resolution file.
+
+read_quicklook returns the finest level with no more rows than there are
+pixels to plot them in, for a time window.
+"""
+import os
+import numpy as np
+from netCDF4 import Dataset
+
+
+# variables in the pyramid, with their QC flags
+VARIABLES = {
+    'radial_velocity_of_scatterers_away_from_instrument': 'qc_flag_radial_velocity_of_scatterers_away_from_instrument',
+    'attenuated_aerosol_backscatter_coefficient': 'qc_flag_backscatter',
+}
+# rows of the level below in each row of a level
+TIME_FACTOR = 4
+# levels are added until the top one has no more than this many rows
+TOP_ROWS = 1000
+# gates are only paired while the level below has at least twice this many
+MIN_GATES = 128
+
+
+def ray_rows(unix_times, good, values):
+    """
+    Rays as level 0 rows: {'time_start', 'time_end', 'count', and 'sum',
+    'min' and 'max' of each of values}, using only the good values.
+    """
+    rows = {'time_start': unix_times, 'time_end': unix_times, 'count': good.astype(np.int32), 'sum': {}, 'min': {}, 'max': {}}
+    for name, value in values.items():
+        value = np.ma.getdata(value)
+        rows['sum'][name] = np.where(good, value, 0)
+        rows['min'][name] = np.where(good, value, np.inf)
+        rows['max'][name] = np.where(good, value, -np.inf)
+    return rows
+
+
+
+def reduce_rows(rows, starts, axis):
+    """
+    rows (as from ray_rows) combined over blocks beginning at starts along
+    axis, 0 for time and 1 for gates.
+    """
+    reduced = {
+        'count': np.add.reduceat(rows['count'], starts, axis = axis),
+        'sum': {name: np.add.reduceat(value, starts, axis = axis) for name, value in rows['sum'].items()},
+        'min': {name: np.minimum.reduceat(value, starts, axis = axis) for name, value in rows['min'].items()},
+        'max': {name: np.maximum.reduceat(value, starts, axis = axis) for name, value in rows['max'].items()},
+    }
+    if axis == 0:
+        reduced['time_start'] = rows['time_start'][starts]
+        reduced['time_end'] = np.maximum.reduceat(rows['time_end'], starts)
+    else:
+        reduced['time_start'] = rows['time_start']
+        reduced['time_end'] = rows['time_end']
+    return reduced
+
+
+
+def slice_rows(rows, index):
+    """
+    index (a slice) of the time dimension of rows.
+    """
+    return {key: {name: v[index] for name, v in value.items()} if isinstance(value, dict) else value[index] for key, value in rows.items()}
+
+
+
+def join_rows(first, second):
+    """
+    rows of first then second.
+    """
+    return {key: {name: np.concatenate([v, second[key][name]]) for name, v in value.items()} if isinstance(value, dict) else np.concatenate([value, second[key]]) for key, value in first.items()}
+
+
+
+def level_shapes(total_rays, gates):
+    """
+    Number of levels for a file of total_rays rays, and which levels pair
+    their gates, with the number of gates of each level (level 0 first).
+    """
+    levels = max(1, int(np.ceil(np.log(max(total_rays, 1) / TOP_ROWS) / np.log(TIME_FACTOR))))
+    pair_gates = [False]
+    level_gates = [gates]
+    for _ in range(levels):
+        pair_gates.append(level_gates[-1] >= 2 * MIN_GATES)
+        level_gates.append((level_gates[-1] + 1) // 2 if pair_gates[-1] else level_gates[-1])
+    return levels, pair_gates, level_gates
+
+
+
+def quicklook_file_path(ncfile_path):
+    """
+    Path of the quick-look pyramid of the netCDF file ncfile_path, e.g.
+    ..._stare-quicklook_v1.0.nc for ..._stare_v1.0.nc
+    """
+    base, version = ncfile_path.rsplit('_v', 1)
+    return f'{base}-quicklook_v{version}'
+
+
+
+class QuicklookFile:
+    """
+    Pyramid of the full resolution file ncfile, written as the rays are
+    added.
+    ncfile - the full resolution netCDF file, with its dimensions made
+    total_rays - number of rays that will be added, which sets the levels
+    datarange - (index_of_range, index_of_angle) ranges
+    encoding - complevel and shuffle for the data variables, see
+               lidar_util.get_encoding
+    """
+    def __init__(self, ncfile, total_rays, datarange, encoding = None):
+        self.path = quicklook_file_path(ncfile.filepath())
+        self.levels, self.pair_gates, level_gates = level_shapes(total_rays, len(ncfile.dimensions['index_of_range']))
+        # rows of the level below in each level's unfinished block
+        self.pending = [None] * (self.levels + 1)
+        self.written = [0] * (self.levels + 1)
+        compression = {} if encoding is None or not encoding.get('complevel') else {'zlib': True, 'complevel': encoding['complevel'], 'shuffle': encoding.get('shuffle', True)}
+
+        self.ncfile = Dataset(self.path, 'w', format = 'NETCDF4')
+        ranges = np.ma.getdata(datarange)
+        for level in range(1, self.levels + 1):
+            if self.pair_gates[level]:
+                starts = np.arange(0, len(ranges), 2)
+                ranges = np.add.reduceat(ranges, starts, axis = 0) / np.diff(np.r_[starts, len(ranges)])[:,np.newaxis]
+            group = self.ncfile.createGroup(f'level_{level}')
+            group.setncattr('time_factor', TIME_FACTOR ** level)
+            group.setncattr('gate_factor', int(np.ceil(len(datarange) / level_gates[level])))
+            group.createDimension('time', None)
+            group.createDimension('index_of_range', level_gates[level])
+            group.createDimension('index_of_angle', ranges.shape[1])
+            for name in ['time_start', 'time_end']:
+                var = group.createVariable(name, 'f8', ('time',))
+                var.units = 'seconds since 1970-01-01 00:00:00'
+                var.long_name = f'{"First" if name == "time_start" else "Last"} ray time of each row'
+            var = group.createVariable('range', 'f4', ('index_of_range', 'index_of_angle'))
+            var.units = 'm'
+            var.long_name = 'Mean range of the gates of each column'
+            var[:] = ranges
+            for name in VARIABLES:
+                units = ncfile.variables[name].units if 'units' in ncfile.variables[name].ncattrs() else ''
+                for statistic in ['min', 'max', 'mean']:
+                    var = group.createVariable(f'{name}_{statistic}', 'f4', ('time', 'index_of_range', 'index_of_angle'), **compression)
+                    var.units = units
+                    var.long_name = f'{statistic.capitalize()} of {name} with QC flag 1'
+
+
+    def add(self, unix_times, flags, values):
+        """
+        Add rays with their QC flags (only flag 1 is used), and write the
+        rows of each level that are finished. values - {name: (time,
+        index_of_range, index_of_angle) array}, with at least VARIABLES.
+        """
+        good = np.ma.filled(flags, 0) == 1
+        self.cascade(ray_rows(unix_times, good, {name: values[name] for name in VARIABLES}))
+
+
+    def cascade(self, rows, final = False):
+        """
+        Combine rows into blocks for each level in turn, writing the rows
+        made. With final, an unfinished block is a row of its own rather
+        than held back.
+        """
+        for level in range(1, self.levels + 1):
+            if self.pending[level] is not None:
+                rows = self.pending[level] if rows is None else join_rows(self.pending[level], rows)
+                self.pending[level] = None
+            if rows is None or len(rows['time_start']) == 0:
+                rows = None
+                continue
+            blocked = len(rows['time_start']) if final else len(rows['time_start']) // TIME_FACTOR * TIME_FACTOR
+            if blocked < len(rows['time_start']):
+                self.pending[level] = slice_rows(rows, slice(blocked, None))
+            if blocked == 0:
+                rows = None
+                continue
+            rows = reduce_rows(slice_rows(rows, slice(None, blocked)), np.arange(0, blocked, TIME_FACTOR), 0)
+            if self.pair_gates[level]:
+                rows = reduce_rows(rows, np.arange(0, rows['count'].shape[1], 2), 1)
+            self.write(level, rows)
+
+
+    def write(self, level, rows):
+        """
+        Write rows after those already written to level.
+        """
+        group = self.ncfile.groups[f'level_{level}']
+        index = slice(self.written[level], self.written[level] + len(rows['time_start']))
+        group.variables['time_start'][index] = rows['time_start']
+        group.variables['time_end'][index] = rows['time_end']
+        empty = rows['count'] == 0
+        for name in VARIABLES:
+            group.variables[f'{name}_min'][index] = np.ma.masked_array(rows['min'][name], mask = empty)
+            group.variables[f'{name}_max'][index] = np.ma.masked_array(rows['max'][name], mask = empty)
+            group.variables[f'{name}_mean'][index] = np.ma.masked_array(rows['sum'][name] / np.where(empty, 1, rows['count']), mask = empty)
+        self.written[level] = index.stop
+
+
+    def close(self, ncfile):
+        """
+        Write the unfinished blocks of each level, copy the global attributes of
+        the full resolution ncfile, and close the file.
+        """
+        self.cascade(None, final = True)
+        self.ncfile.setncatts({key: ncfile.getncattr(key) for key in ncfile.ncattrs()})
+        self.ncfile.setncattr('levels', self.levels)
+        self.ncfile.setncattr('source_file', os.path.basename(ncfile.filepath()))
+        self.ncfile.close()
+
+
+
+def to_unix_time(value):
+    """
+    value as unix time, from a number or anything np.datetime64 takes.
+    """
+    if value is None or isinstance(value, (int, float, np.number)):
+        return value
+    return np.datetime64(value, 'us').astype(np.int64) / 1e6
+
+
+
+def window_rows(time_start, time_end, start, end):
+    """
+    slice of the rows with times in start to end (unix times, None for no
+    limit), from the sorted first and last times of each row.
+    """
+    first = 0 if start is None else int(np.searchsorted(time_end, start, side = 'left'))
+    last = len(time_start) if end is None else int(np.searchsorted(time_start, end, side = 'right'))
+    return slice(first, max(first, last))
+
+
+
+def select_level(row_counts, pixels):
+    """
+    Finest level (index of row_counts, the rows of each level in the
+    window, finest first) with no more than pixels rows, or the coarsest.
+    """
+    for level, rows in enumerate(row_counts):
+        if rows <= pixels:
+            return level
+    return len(row_counts) - 1
+
+
+
+def read_quicklook(quicklook_path, variable, start = None, end = None, pixels = 1000, angle = 0):
+    """
+    Min, max and mean of variable (one of VARIABLES) at angle, for start to
+    end (unix times, or anything np.datetime64 takes, None for no limit),
+    from the finest level of the pyramid at quicklook_path with no more
+    than pixels rows in that time. Level 0 is read from the full resolution
+    file next to it, masked where the QC flag isn't 1, with min, max and
+    mean all the values.
+    Returns a dict of 'level', 'time_start' and 'time_end' of each row,
+    'range' of each gate, and (time, range) 'min', 'max' and 'mean'.
+    """
+    start = to_unix_time(start)
+    end = to_unix_time(end)
+    with Dataset(quicklook_path) as quicklook:
+        source_path = os.path.join(os.path.dirname(quicklook_path), quicklook.getncattr('source_file'))
+        windows = []
+        with Dataset(source_path) as source:
+            times = source.variables['time'][:]
+            windows.append(window_rows(times, times, start, end))
+        for level in range(1, int(quicklook.getncattr('levels')) + 1):
+            group = quicklook.groups[f'level_{level}']
+            windows.append(window_rows(group.variables['time_start'][:], group.variables['time_end'][:], start, end))
+        level = select_level([window.stop - window.start for window in windows], pixels)
+        rows = windows[level]
+
+        if level > 0:
+            group = quicklook.groups[f'level_{level}']
+            result = {'level': level, 'time_start': group.variables['time_start'][rows], 'time_end': group.variables['time_end'][rows], 'range': group.variables['range'][:, angle]}
+            for statistic in ['min', 'max', 'mean']:
+                result[statistic] = group.variables[f'{variable}_{statistic}'][rows, :, angle]
+            return result
+
+    with Dataset(source_path) as source:
+        times = source.variables['time'][rows]
+        flags = source.variables[VARIABLES[variable]][rows, :, angle]
+        values = source.variables[variable][rows, :, angle]
+        values = np.ma.masked_where(np.ma.filled(flags, 0) != 1, values)
+        ranges = source.variables['range'][0, :, angle] if len(source.dimensions['time']) > 0 else None
+    return {'level': 0, 'time_start': times, 'time_end': times, 'range': ranges, 'min': values, 'max': values, 'mean': values}
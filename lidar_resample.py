@@ -0,0 +1,220 @@
+"""
+Time averages of the Stare radial winds, for quick-looks and model
+comparisons that don't need every ray. Rays are put in bins of a fixed
+interval (by their unix time), and for each bin, gate and angle the number
+of values with QC flag 1, and their mean and variance, are worked out.
+Files are added one at a time as they are written to the full resolution
+file, with the last bin of each carried on to the next, and finished bins
+are written to a netCDF file of their own.
+"""
+import os
+import numpy as np
+from netCDF4 import Dataset
+
+
+# variables averaged, with the units of their variance
+VARIABLES = {
+    'radial_velocity_of_scatterers_away_from_instrument': 'm2 s-2',
+    'attenuated_aerosol_backscatter_coefficient': 'm-2 sr-2',
+    'signal_to_noise_ratio_plus_1': '1',
+}
+
+
+def bin_sums(bins, good, values):
+    """
+    Sums over runs of rays in the same bin, in one pass with np.add.reduceat.
+    bins - (time,) bin of each ray, e.g. unix time // interval
+    good - (time, ...) where values are used, e.g. QC flag 1
+    values - {name: (time, ...) array}
+    Returns the bin of each run, the number of rays in it, the number of
+    good values, and {name: (sum, sum of squares)} of the good values.
+    """
+    starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    rays = np.diff(np.r_[starts, len(bins)])
+    counts = np.add.reduceat(good, starts, axis = 0, dtype = np.int64)
+    sums = {}
+    for name, value in values.items():
+        value = np.where(good, np.ma.getdata(value), 0)
+        sums[name] = (np.add.reduceat(value, starts, axis = 0), np.add.reduceat(value * value, starts, axis = 0))
+    return bins[starts], rays, counts, sums
+
+
+class Resampler:
+    """
+    bin_sums of rays added in time order, a file at a time. The last bin of
+    each add may be continued by the next, so is held back until then or
+    finish.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.held = None
+
+
+    def add(self, unix_times, good, values):
+        """
+        Add rays, see bin_sums. Returns the bins finished, as from bin_sums.
+        """
+        if len(unix_times) == 0:
+            return None
+        runs = list(bin_sums(np.floor_divide(unix_times, self.interval).astype(np.int64), good, values))
+        if self.held is not None and self.held[0][0] == runs[0][0]:
+            # first bin continues the held one
+            runs[1][0] += self.held[1][0]
+            runs[2][0] += self.held[2][0]
+            for name, (sums, squares) in runs[3].items():
+                sums[0] += self.held[3][name][0][0]
+                squares[0] += self.held[3][name][1][0]
+            finished = None
+        else:
+            finished = self.held
+        if len(runs[0]) > 1:
+            finished = join_runs(finished, take_runs(runs, slice(None, -1)))
+        self.held = take_runs(runs, slice(-1, None))
+        return finished
+
+
+    def finish(self):
+        """
+        The held bin, as from bin_sums, or None if there isn't one.
+        """
+        finished, self.held = self.held, None
+        return finished
+
+
+
+def take_runs(runs, index):
+    """
+    index of each of the arrays of bin_sums runs.
+    """
+    bins, rays, counts, sums = runs
+    return bins[index], rays[index], counts[index], {name: (value[0][index], value[1][index]) for name, value in sums.items()}
+
+
+
+def join_runs(first, second):
+    """
+    bin_sums runs of first then second, either of which can be None.
+    """
+    if first is None or second is None:
+        return second if first is None else first
+    return tuple(np.concatenate([first[i], second[i]]) for i in range(3)) + ({name: tuple(np.concatenate([first[3][name][j], second[3][name][j]]) for j in range(2)) for name in first[3]},)
+
+
+
+def bin_statistics(counts, sums, squares):
+    """
+    Mean and (population) variance of binned values from bin_sums, masked
+    where there are no good values.
+    """
+    no_values = counts == 0
+    counts = np.where(no_values, 1, counts)
+    mean = sums / counts
+    variance = np.maximum(squares / counts - mean * mean, 0)
+    return np.ma.masked_array(mean, mask = no_values), np.ma.masked_array(variance, mask = no_values)
+
+
+
+def copy_attributes(variable):
+    """
+    Attributes of variable that still apply to its averages.
+    """
+    return {key: variable.getncattr(key) for key in ['units', 'long_name', 'standard_name'] if key in variable.ncattrs()}
+
+
+
+def resampled_file_path(ncfile_path, interval):
+    """
+    Path for the interval averages of the netCDF file ncfile_path, e.g.
+    ..._stare-mean-600s_v1.0.nc for ..._stare_v1.0.nc
+    """
+    base, version = ncfile_path.rsplit('_v', 1)
+    return f'{base}-mean-{interval:g}s_v{version}'
+
+
+
+class ResampledFile:
+    """
+    netCDF file of the interval averages of the full resolution file
+    ncfile, written as bins are finished.
+    ncfile - the full resolution netCDF file, with its dimensions made
+    datarange - (index_of_range, index_of_angle) ranges
+    encoding - complevel and shuffle for the data variables, see
+               lidar_util.get_encoding
+    """
+    def __init__(self, ncfile, interval, datarange, encoding = None):
+        self.interval = interval
+        self.resampler = Resampler(interval)
+        self.path = resampled_file_path(ncfile.filepath(), interval)
+        self.ncfile = Dataset(self.path, 'w', format = 'NETCDF4_CLASSIC')
+        self.written = 0
+        compression = {} if encoding is None or not encoding.get('complevel') else {'zlib': True, 'complevel': encoding['complevel'], 'shuffle': encoding.get('shuffle', True)}
+
+        self.ncfile.createDimension('time', None)
+        self.ncfile.createDimension('bounds', 2)
+        self.ncfile.createDimension('index_of_range', len(ncfile.dimensions['index_of_range']))
+        self.ncfile.createDimension('index_of_angle', len(ncfile.dimensions['index_of_angle']))
+        for name in ['time', 'time_bounds']:
+            var = self.ncfile.createVariable(name, 'f8', ('time', 'bounds') if name == 'time_bounds' else ('time',))
+            var.units = 'seconds since 1970-01-01 00:00:00'
+            var.calendar = 'standard'
+        self.ncfile.variables['time'].long_name = f'Middle of each {interval:g} s interval'
+        self.ncfile.variables['time'].bounds = 'time_bounds'
+        var = self.ncfile.createVariable('range', 'f4', ('index_of_range', 'index_of_angle'))
+        var.setncatts(copy_attributes(ncfile.variables['range']))
+        var[:] = datarange
+        var = self.ncfile.createVariable('ray_count', 'i4', ('time',))
+        var.long_name = 'Number of rays in each interval'
+        var = self.ncfile.createVariable('good_count', 'i4', ('time', 'index_of_range', 'index_of_angle'), **compression)
+        var.long_name = 'Number of values with QC flag 1 (good data) in each interval, which the means and variances are of'
+        for name, variance_units in VARIABLES.items():
+            attributes = copy_attributes(ncfile.variables[name])
+            var = self.ncfile.createVariable(f'{name}_mean', 'f4', ('time', 'index_of_range', 'index_of_angle'), **compression)
+            var.setncatts(attributes)
+            var.long_name = f'Mean {attributes.get("long_name", name)}'
+            var.cell_methods = f'time: mean (interval: {interval:g} s where qc_flag = 1)'
+            var = self.ncfile.createVariable(f'{name}_variance', 'f4', ('time', 'index_of_range', 'index_of_angle'), **compression)
+            var.units = variance_units
+            var.long_name = f'Variance of {attributes.get("long_name", name)}'
+            var.cell_methods = f'time: variance (interval: {interval:g} s where qc_flag = 1)'
+
+
+    def add(self, unix_times, flags, values):
+        """
+        Add rays with their QC flags (only flag 1 is used), and write the
+        bins that are finished. values - {name: (time, index_of_range,
+        index_of_angle) array} for each of VARIABLES.
+        """
+        good = np.ma.filled(flags, 0) == 1
+        self.write(self.resampler.add(unix_times, good, values))
+
+
+    def write(self, runs):
+        """
+        Write bin_sums runs after the bins already written.
+        """
+        if runs is None:
+            return
+        bins, rays, counts, sums = runs
+        rows = slice(self.written, self.written + len(bins))
+        starts = bins * self.interval
+        self.ncfile.variables['time'][rows] = starts + self.interval / 2
+        self.ncfile.variables['time_bounds'][rows] = np.column_stack([starts, starts + self.interval])
+        self.ncfile.variables['ray_count'][rows] = rays
+        self.ncfile.variables['good_count'][rows] = counts
+        for name in VARIABLES:
+            mean, variance = bin_statistics(counts, *sums[name])
+            self.ncfile.variables[f'{name}_mean'][rows] = mean
+            self.ncfile.variables[f'{name}_variance'][rows] = variance
+        self.written += len(bins)
+
+
+    def close(self, ncfile):
+        """
+        Write the last bin, copy the global attributes of the full
+        resolution ncfile, and close the file.
+        """
+        self.write(self.resampler.finish())
+        self.ncfile.setncatts({key: ncfile.getncattr(key) for key in ncfile.ncattrs()})
+        self.ncfile.setncattr('averaging_interval', f'{self.interval:g} s')
+        self.ncfile.setncattr('averaged_from', os.path.basename(ncfile.filepath()))
+        self.ncfile.close()
@@ -0,0 +1,142 @@
+"""
+Timing and memory of each stage of the processing, for finding slow stages
+and files in long runs. Off unless start is called (the scripts'
+--stats-file), then every stage is appended to the stats file as a line of
+JSON:
+    stage            name of the stage, e.g. 'read', 'qc', 'write'
+    wall_seconds     elapsed time
+    cpu_seconds      CPU time of this process (not of worker processes)
+    peak_rss_mb      peak resident memory of the process so far
+    peak_rss_increase_mb  how much the stage raised the peak, 0 if it stayed
+                     below an earlier one
+    bytes_read, bytes_written  read and written by the process, including
+                     from the OS page cache (Linux only, otherwise null)
+plus 'run' (start time of the run, the same for all of its lines), 'script',
+'time' (when the stage finished), 'parent' (the stage it was in, if any),
+'error' (if it raised), and the stage's own fields, e.g. 'file' or
+'product', which stages within it inherit.
+"""
+import os
+import sys
+import json
+import time
+import cProfile
+import contextlib
+import datetime as dt
+
+
+_stats = {'file': None, 'run': None, 'script': None}
+# (name, fields) of the stages currently running, outermost first
+_running = []
+
+
+def start(stats_file, script = None):
+    """
+    Append stages to stats_file from now on. script - name recorded with
+    each line, by default the running script's.
+    """
+    _stats['file'] = stats_file
+    _stats['run'] = dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")
+    _stats['script'] = os.path.basename(sys.argv[0]) if script is None else script
+
+
+def stop():
+    """
+    Stop recording stages.
+    """
+    _stats['file'] = None
+
+
+def peak_rss():
+    """
+    Peak resident memory of this process in bytes, None if it isn't known
+    (e.g. on Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def io_counts():
+    """
+    Bytes read and written by this process (rchar and wchar of
+    /proc/self/io), or None, None where that isn't available.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counts = dict(line.split(':') for line in f)
+        return int(counts['rchar']), int(counts['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """
+    Record the code in the with block as stage name, if stats are being
+    recorded. Yields a dict, values added to it (e.g. the size of a file
+    once it has been written) are recorded with the stage's fields.
+    """
+    if _stats['file'] is None:
+        yield {}
+        return
+    inherited = {}
+    for _, outer_fields in _running:
+        inherited.update(outer_fields)
+    record = {**inherited, **fields}
+    parent = _running[-1][0] if _running else None
+    _running.append((name, fields))
+    peak_before = peak_rss()
+    read_before, written_before = io_counts()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        wall_seconds = time.perf_counter() - wall_start
+        cpu_seconds = time.process_time() - cpu_start
+        read_after, written_after = io_counts()
+        peak_after = peak_rss()
+        _running.pop()
+        line = {
+            'run': _stats['run'],
+            'script': _stats['script'],
+            'time': dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f"),
+            'stage': name,
+            'parent': parent,
+            'wall_seconds': round(wall_seconds, 6),
+            'cpu_seconds': round(cpu_seconds, 6),
+            'peak_rss_mb': None if peak_after is None else round(peak_after / 1e6, 1),
+            'peak_rss_increase_mb': None if peak_after is None else round((peak_after - peak_before) / 1e6, 1),
+            'bytes_read': None if read_after is None else read_after - read_before,
+            'bytes_written': None if written_after is None else written_after - written_before,
+        }
+        line.update(record)
+        with open(_stats['file'], 'a') as f:
+            f.write(json.dumps(line, default = str) + '\n')
+
+
+@contextlib.contextmanager
+def profile(profile_file):
+    """
+    Run the with block under cProfile and save the stats to profile_file,
+    for reading with pstats or e.g. snakeviz. Does nothing if profile_file
+    is None.
+    """
+    if profile_file is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_file)
@@ -0,0 +1,563 @@
+"""
+Helpers shared by the process_lidar scripts.
+"""
+import os
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import numpy as np
+
+import read_lidar
+import lidar_cache
+import lidar_stats
+import amof_template
+from ncas_amof_netcdf_template import util
+
+
+# product variables each product's writer fills, only these are made (see amof_template.make_netcdf)
+PRODUCT_VARIABLES = {
+    'aerosol-backscatter-radial-winds': ['range', 'radial_velocity_of_scatterers_away_from_instrument', 'attenuated_aerosol_backscatter_coefficient', 'signal_to_noise_ratio_plus_1', 'sensor_azimuth_angle_instrument_frame', 'sensor_view_angle_instrument_frame', 'qc_flag_radial_velocity_of_scatterers_away_from_instrument', 'qc_flag_backscatter'],
+    'mean-winds-profile': ['altitude', 'eastward_wind', 'northward_wind', 'upward_air_velocity', 'wind_speed', 'wind_from_direction'],
+}
+
+# product variables that can be chunked and compressed, see get_variable_encoding
+ENCODED_VARIABLES = {
+    'aerosol-backscatter-radial-winds': ['range', 'radial_velocity_of_scatterers_away_from_instrument', 'attenuated_aerosol_backscatter_coefficient', 'signal_to_noise_ratio_plus_1', 'qc_flag_radial_velocity_of_scatterers_away_from_instrument', 'qc_flag_backscatter'],
+    'mean-winds-profile': ['altitude', 'eastward_wind', 'northward_wind', 'upward_air_velocity', 'wind_speed', 'wind_from_direction'],
+}
+# variables that can be stored packed, with scale_factor and add_offset (see amof_template.EncodedVariables)
+PACKED_VARIABLES = ['range', 'radial_velocity_of_scatterers_away_from_instrument', 'signal_to_noise_ratio_plus_1']
+# (times, gates) in each chunk for each access pattern, None for the whole dimension
+CHUNK_SHAPES = {
+    'time-series': (4096, 8),
+    'profile': (16, None),
+}
+DEFAULT_ENCODING = {'complevel': 0, 'shuffle': True, 'chunks': None, 'pack': {}}
+
+
+def get_times(dt_times, unix_times = None):
+    """
+    Vectorised version of ncas_amof_netcdf_template.util.get_times, for a
+    datetime64 array such as read_lidar.readLidarFile's 'DP'.
+    unix_times can be given if already known, otherwise they are worked
+    out from dt_times.
+    Returns the same values as util.get_times, as numpy arrays:
+      unix_times, day-of-year, years, months, days, hours, minutes, seconds,
+      time_coverage_start_dt, time_coverage_end_dt, file_date
+    As in util.get_times, seconds are float32, with the microseconds
+    divided by 10 ** (number of digits of the microseconds) rather than by
+    1e6, and file_date compares those seconds.
+    """
+    dt_times = np.asarray(dt_times, dtype = 'datetime64[us]')
+    if unix_times is None:
+        unix_times = dt_times.astype(np.int64) / 1e6
+    year_start = dt_times.astype('datetime64[Y]')
+    month_start = dt_times.astype('datetime64[M]')
+    day_start = dt_times.astype('datetime64[D]')
+    years = year_start.astype(np.int64) + 1970
+    months = month_start.astype(np.int64) % 12 + 1
+    days = (day_start - month_start.astype('datetime64[D]')).astype(np.int64) + 1
+    microseconds = (dt_times - day_start).astype(np.int64)
+    hours = microseconds // 3600000000
+    minutes = microseconds // 60000000 % 60
+    fraction = microseconds % 1000000
+    digits = 1 + np.searchsorted(10 ** np.arange(1, 6), fraction, side = 'right')
+    seconds = (microseconds // 1000000 % 60 + fraction / 10 ** digits).astype(np.float32)
+    doy = (day_start - year_start.astype('datetime64[D]')).astype(np.int64) + 1
+    doy = doy + hours / 24 + minutes / (24 * 60) + seconds / (24 * 60 * 60)
+    time_coverage_start_dt = unix_times[0]
+    time_coverage_end_dt = unix_times[-1]
+
+    file_date = ""
+    if years[0] == years[-1]:
+        file_date += str(years[0])
+        if months[0] == months[-1]:
+            file_date += f"{months[0]:02d}"
+            if days[0] == days[-1]:
+                file_date += f"{days[0]:02d}"
+                if hours[0] == hours[-1]:
+                    file_date += f"-{hours[0]:02d}"
+                    if minutes[0] == minutes[-1]:
+                        file_date += f"{minutes[0]:02d}"
+                        if seconds[0] == seconds[-1]:
+                            file_date += f"{int(seconds[0]):02d}"
+    else:
+        raise ValueError("Incompatible dates - data from over 2 years")
+    return unix_times, doy, years, months, days, hours, minutes, seconds, time_coverage_start_dt, time_coverage_end_dt, file_date
+
+
+
+def concatenate_times(file_times):
+    """
+    Join the get_times outputs of several files. The per-time arrays are
+    concatenated, while time_coverage_start_dt, time_coverage_end_dt and
+    file_date become lists with one entry per file.
+    """
+    unix_times, doy, years, months, days, hours, minutes, seconds = [np.concatenate(i) for i in list(zip(*file_times))[:8]]
+    time_coverage_start_dt, time_coverage_end_dt, file_date = [list(i) for i in list(zip(*file_times))[8:]]
+    return unix_times, doy, years, months, days, hours, minutes, seconds, time_coverage_start_dt, time_coverage_end_dt, file_date
+
+
+
+def get_scan_times(start_times, end_times):
+    """
+    Times for a file per scan (e.g. wind profiles), from datetime64 arrays of
+    the first and last ray time in each scan. Returns the same as
+    concatenate_times on the get_times of each file, with the per-time
+    arrays only for the first ray of each scan, time_coverage_start_dt and
+    time_coverage_end_dt as the earliest and latest times, and file_date for
+    just the first and last scans.
+    """
+    unix_times, doy, years, months, days, hours, minutes, seconds, _, _, _ = get_times(start_times)
+    end_unix_times = np.asarray(end_times, dtype = 'datetime64[us]').astype(np.int64) / 1e6
+    file_date = [get_times([start_times[i], end_times[i]])[-1] for i in [0, -1]]
+    return unix_times, doy, years, months, days, hours, minutes, seconds, np.min(unix_times), np.max(end_unix_times), file_date
+
+
+
+class RayArrays:
+    """
+    (time, index_of_range, index_of_angle) masked arrays for the processing
+    scripts. Each is allocated once and reused for the later files of a day
+    while it is big enough, rather than made again for every file.
+    """
+    def __init__(self, dtype = np.float64):
+        self.dtype = dtype
+        self.buffers = {}
+
+
+    def array(self, name, values, no_angles, angle = 0):
+        """
+        (time, index_of_range) values put in angle of a
+        (time, index_of_range, no_angles) masked array, with only the other
+        angles (and any masked values) masked. angle is one index for every
+        ray, or an array of the index of each ray. The data under the mask
+        is -9999. The array uses the buffers for name, so is only valid
+        until the next call for name.
+        """
+        rays, gates = np.shape(values)
+        shape = (rays, gates, no_angles)
+        data = self.buffer(name, shape, self.dtype)
+        # each ray is scattered into its own angle
+        index = (slice(None), slice(None), angle) if np.ndim(angle) == 0 else (np.arange(rays), slice(None), angle)
+        data[index] = np.ma.getdata(values)
+        if no_angles == 1 and not np.ma.is_masked(values):
+            return np.ma.masked_array(data, copy = False)
+        mask = self.buffer(f'{name}_mask', shape, bool)
+        mask[:] = True
+        mask[index] = np.ma.getmaskarray(values)
+        data[mask] = -9999
+        return np.ma.masked_array(data, mask = mask, copy = False)
+
+
+    def buffer(self, name, shape, dtype):
+        """
+        shape part of the buffer for name, made (again) if it is too small.
+        """
+        if name not in self.buffers or len(self.buffers[name]) < shape[0] or self.buffers[name].shape[1:] != shape[1:] or self.buffers[name].dtype != dtype:
+            self.buffers[name] = np.empty(shape, dtype = dtype)
+        return self.buffers[name][:shape[0]]
+
+
+
+def gate_ranges(gate_number, gate_length):
+    """
+    Range of each gate, as read_lidar.readLidarFile's 'A' for every ray.
+    """
+    return read_lidar.gateRangeToAlt(np.arange(gate_number, dtype = np.float64), gate_length)
+
+
+
+def broadcast_rays(data, rays):
+    """
+    (range, angle) data, such as the ranges, as a read-only
+    (rays, range, angle) view for writing to variables with a time
+    dimension, without copying it for each ray.
+    """
+    shape = (rays,) + np.shape(data)
+    return np.ma.masked_array(np.broadcast_to(np.ma.getdata(data), shape), mask = np.broadcast_to(np.ma.getmaskarray(data), shape))
+
+
+
+def update_variable_slice(ncfile, ncfile_varname, data, start, stop, valid_limits, qc_data_error = True):
+    """
+    Write data to ncfile_varname[start:stop], for filling a variable one
+    piece at a time. Where the variable has valid_min and valid_max, the
+    min and max of data are added to valid_limits, to be set once all the
+    data is written with set_valid_limits. As util.update_variable does,
+    data for QC flag variables with flag_values is checked before writing,
+    and if it has other values raises a ValueError, or just prints a warning
+    if qc_data_error is False.
+    """
+    if "qc" in ncfile_varname.lower() and "flag_values" in ncfile.variables[ncfile_varname].ncattrs():
+        # masked values are written as the fill value, so only the rest are checked
+        if not np.isin(np.ma.compressed(data), ncfile.variables[ncfile_varname].flag_values).all():
+            valid_values = list(ncfile.variables[ncfile_varname].flag_values)
+            msg = f"Invalid data being added to QC variable, only {valid_values} are allowed."
+            if qc_data_error:
+                raise ValueError(msg)
+            else:
+                print(f"[WARN]: {msg}")
+    if "valid_min" in ncfile.variables[ncfile_varname].ncattrs():
+        limits = (np.nanmin(data), np.nanmax(data))
+        if "scale_factor" in ncfile.variables[ncfile_varname].ncattrs() and not packable(ncfile.variables[ncfile_varname], limits):
+            msg = f"{ncfile_varname} values {limits} don't fit in {np.dtype(amof_template.PACKED_TYPE).name} with scale_factor {ncfile.variables[ncfile_varname].scale_factor} and add_offset {ncfile.variables[ncfile_varname].add_offset}, use a larger scale_factor"
+            raise ValueError(msg)
+        valid_limits.setdefault(ncfile_varname, []).append(limits)
+    ncfile.variables[ncfile_varname][start:stop] = data
+
+
+
+def set_valid_limits(ncfile, valid_limits):
+    """
+    Set valid_min and valid_max from the limits gathered by
+    update_variable_slice, as util.update_variable does for a whole variable.
+    """
+    for ncfile_varname, limits in valid_limits.items():
+        mins, maxs = zip(*limits)
+        valid_min, valid_max = np.float64(np.nanmin(np.ma.array(mins))), np.float64(np.nanmax(np.ma.array(maxs)))
+        if "scale_factor" in ncfile.variables[ncfile_varname].ncattrs():
+            # packed data has packed valid_min and valid_max
+            valid_min, valid_max = pack_values(ncfile.variables[ncfile_varname], [valid_min, valid_max])
+        ncfile.variables[ncfile_varname].valid_min = valid_min.astype(ncfile.variables[ncfile_varname].datatype)
+        ncfile.variables[ncfile_varname].valid_max = valid_max.astype(ncfile.variables[ncfile_varname].datatype)
+
+
+
+def update_time_variables_slice(ncfile, times, start, stop, valid_limits):
+    """
+    update_variable_slice for each of the time variables, from the first
+    8 values returned by get_times.
+    """
+    unix_times, doy, years, months, days, hours, minutes, seconds = times[:8]
+    update_variable_slice(ncfile, 'time', unix_times, start, stop, valid_limits)
+    update_variable_slice(ncfile, 'year', years, start, stop, valid_limits)
+    update_variable_slice(ncfile, 'month', months, start, stop, valid_limits)
+    update_variable_slice(ncfile, 'day', days, start, stop, valid_limits)
+    update_variable_slice(ncfile, 'hour', hours, start, stop, valid_limits)
+    update_variable_slice(ncfile, 'minute', minutes, start, stop, valid_limits)
+    update_variable_slice(ncfile, 'second', seconds, start, stop, valid_limits)
+    update_variable_slice(ncfile, 'day_of_year', doy, start, stop, valid_limits)
+
+
+
+def get_valid_limits(ncfile):
+    """
+    valid_limits (see update_variable_slice) holding the valid_min and
+    valid_max already set in ncfile, so data appended to it is checked
+    against the data already there.
+    """
+    valid_limits = {}
+    for ncfile_varname, variable in ncfile.variables.items():
+        if "valid_min" in variable.ncattrs() and not isinstance(variable.valid_min, str):
+            if "scale_factor" in variable.ncattrs():
+                valid_limits[ncfile_varname] = [tuple(unpack_values(variable, [variable.valid_min, variable.valid_max]))]
+            else:
+                valid_limits[ncfile_varname] = [(variable.valid_min, variable.valid_max)]
+    return valid_limits
+
+
+
+def pack_values(variable, values):
+    """
+    values (e.g. valid limits) in the packed units of a variable with
+    scale_factor and add_offset.
+    """
+    return np.round((np.asarray(values, dtype = np.float64) - variable.add_offset) / variable.scale_factor)
+
+
+
+def packable(variable, values):
+    """
+    True if values can be packed into variable without overflowing or
+    becoming the fill value. Masked and NaN values are ignored.
+    """
+    packed = pack_values(variable, [value for value in values if value is not np.ma.masked and np.isfinite(value)])
+    return bool(np.all(packed > amof_template.PACKED_FILL_VALUE) and np.all(packed <= np.iinfo(amof_template.PACKED_TYPE).max))
+
+
+
+def unpack_values(variable, values):
+    """
+    Packed values of a variable with scale_factor and add_offset, unpacked.
+    """
+    return np.asarray(values, dtype = np.float64) * variable.scale_factor + variable.add_offset
+
+
+
+def parse_pack(values):
+    """
+    {variable: (scale_factor, add_offset)} from 'VARIABLE=SCALE_FACTOR[,ADD_OFFSET]'
+    strings, as given on the command line.
+    """
+    pack = {}
+    for value in values:
+        variable, _, factors = value.partition('=')
+        pack[variable.strip()] = parse_pack_factors(variable.strip(), factors)
+    return pack
+
+
+
+def parse_pack_factors(variable, factors):
+    """
+    (scale_factor, add_offset) from 'SCALE_FACTOR[,ADD_OFFSET]' for variable.
+    """
+    if variable not in PACKED_VARIABLES:
+        msg = f"Can't pack {variable}, variables that can be packed are {PACKED_VARIABLES}"
+        raise ValueError(msg)
+    factors = [float(i) for i in factors.split(',')]
+    if len(factors) not in [1, 2] or factors[0] <= 0:
+        msg = f"Packing for {variable} should be SCALE_FACTOR[,ADD_OFFSET] with SCALE_FACTOR > 0"
+        raise ValueError(msg)
+    return factors[0], factors[1] if len(factors) == 2 else 0.0
+
+
+
+def get_encoding(metadata_file = None, encoding = None):
+    """
+    netCDF encoding options (see DEFAULT_ENCODING) from the netcdf_complevel,
+    netcdf_shuffle, netcdf_chunks and netcdf_pack_<variable> lines of
+    metadata_file, overridden by those in encoding that are not None
+    (e.g. from the command line).
+    """
+    options = dict(DEFAULT_ENCODING, pack = {})
+    if metadata_file is not None:
+        for key, value in util.get_metadata(metadata_file).items():
+            if key == 'netcdf_complevel':
+                options['complevel'] = int(value)
+            elif key == 'netcdf_shuffle':
+                options['shuffle'] = value.lower() in ['true', 'yes', '1']
+            elif key == 'netcdf_chunks':
+                options['chunks'] = value
+            elif key.startswith('netcdf_pack_'):
+                options['pack'][key[len('netcdf_pack_'):]] = parse_pack_factors(key[len('netcdf_pack_'):], value)
+    for key, value in (encoding or {}).items():
+        if key == 'pack':
+            options['pack'].update(value or {})
+        elif value is not None:
+            options[key] = value
+    return options
+
+
+
+def chunk_sizes(chunks, dimension_lengths):
+    """
+    Chunk shape for a variable with dimension_lengths (time first, gates or
+    altitudes second, then any others, which are not split). chunks is a
+    name in CHUNK_SHAPES or 'TIMES,GATES'. Unlimited (None) time is split
+    into chunks of TIMES.
+    """
+    if chunks in CHUNK_SHAPES:
+        times, gates = CHUNK_SHAPES[chunks]
+    else:
+        try:
+            times, gates = [int(i) for i in chunks.split(',')]
+        except ValueError:
+            msg = f"Chunks should be one of {list(CHUNK_SHAPES)} or TIMES,GATES, not {chunks}"
+            raise ValueError(msg)
+    lengths = list(dimension_lengths.values())
+    if lengths[0] is not None:
+        times = min(times, max(lengths[0], 1))
+    gates = lengths[1] if gates is None else min(gates, lengths[1])
+    return (times, gates, *lengths[2:])
+
+
+
+def get_variable_encoding(product, dimension_lengths, metadata_file = None, encoding = None):
+    """
+    {variable: createVariable keyword arguments} for the ENCODED_VARIABLES
+    of product, with 'pack' for variables stored packed (see
+    amof_template.make_netcdf). Options are from get_encoding, with no
+    options the variables are made as create_netcdf makes them.
+    dimension_lengths - lengths of the variables' dimensions, time first
+    """
+    options = get_encoding(metadata_file, encoding)
+    variable_encoding = {}
+    for ncfile_varname in ENCODED_VARIABLES[product]:
+        kwargs = {}
+        if options['complevel']:
+            kwargs.update(zlib = True, complevel = options['complevel'], shuffle = options['shuffle'])
+        if options['chunks']:
+            kwargs['chunksizes'] = chunk_sizes(options['chunks'], dimension_lengths)
+        if ncfile_varname in options['pack']:
+            kwargs['pack'] = options['pack'][ncfile_varname]
+        if kwargs:
+            variable_encoding[ncfile_varname] = kwargs
+    return variable_encoding
+
+
+
+def manifest_file(ncfile_location, lidar_file, product, options):
+    """
+    Name of the manifest of raw files in the netCDF file made with
+    incremental processing, for the day of lidar_file. options can be ''
+    for products without any.
+    """
+    datadate = read_lidar.getStareFileHeader(lidar_file)[3]
+    options = f'_{options}' if options else ''
+    return f'{ncfile_location}/ncas-lidar-dop-2_{datadate}_{product}{options}_manifest.json'
+
+
+
+def file_state(lidar_file):
+    """
+    Path, size and modification time of lidar_file, for spotting changes.
+    """
+    stat = os.stat(lidar_file)
+    return {'path': os.path.abspath(lidar_file), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+
+def load_manifest(manifest_file):
+    """
+    Manifest saved by save_manifest, or None if there isn't one, it is from
+    a different reader version, or its netCDF file is gone.
+    """
+    try:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if manifest.get('reader_version') != read_lidar.READER_VERSION or not os.path.isfile(manifest['ncfile']):
+        return None
+    return manifest
+
+
+
+def save_manifest(manifest_file, ncfile_path, lidar_files, num_rays):
+    """
+    Record that num_rays rays of each of lidar_files are in the netCDF file
+    ncfile_path. Written to a temporary file first, so a run that stops part
+    way through never leaves a partly written manifest.
+    """
+    manifest = {'ncfile': os.path.abspath(ncfile_path), 'reader_version': read_lidar.READER_VERSION, 'files': []}
+    for lidar_file, rays in zip(lidar_files, num_rays):
+        manifest['files'].append({**file_state(lidar_file), 'rays': int(rays)})
+    with open(f'{manifest_file}.tmp', 'w') as f:
+        json.dump(manifest, f, indent = 1)
+    os.replace(f'{manifest_file}.tmp', manifest_file)
+
+
+
+def new_rays(manifest, lidar_files, cache_dir = None):
+    """
+    Rays of lidar_files that aren't in the manifest's netCDF file yet.
+    The files in the manifest have to be the first of lidar_files, in the
+    same order and unchanged, except for the last of them, which can have
+    more rays if it was still being written at the last run.
+    Returns the number of rays in each of lidar_files and the first new ray
+    in each, or None if the netCDF file has to be made again.
+    """
+    ingested = manifest['files']
+    if len(lidar_files) < len(ingested):
+        return None
+    num_rays = []
+    first_rays = []
+    for i, lidar_file in enumerate(lidar_files):
+        if i >= len(ingested):
+            num_rays.append(count_rays(lidar_file, cache_dir)[1])
+            first_rays.append(0)
+            continue
+        state = file_state(lidar_file)
+        if state['path'] != ingested[i]['path']:
+            return None
+        if state['size'] == ingested[i]['size'] and state['mtime_ns'] == ingested[i]['mtime_ns']:
+            num_rays.append(ingested[i]['rays'])
+        elif i == len(ingested) - 1 and state['size'] > ingested[i]['size']:
+            num_rays.append(count_rays(lidar_file, cache_dir)[1])
+        else:
+            return None
+        first_rays.append(ingested[i]['rays'])
+        if num_rays[i] < first_rays[i]:
+            return None
+    return num_rays, first_rays
+
+
+
+def count_rays(lidar_file, cache_dir = None):
+    """
+    Number of gates and rays in lidar_file, from the cache in cache_dir if
+    the file is there, otherwise from its header and a count of its lines.
+    """
+    if cache_dir is not None:
+        header = lidar_cache.load(cache_dir, lidar_file, header_only = True)
+        if header is not None:
+            return header['gate_number'], header['maximum']
+    header = read_lidar.getStareFileHeader(lidar_file)
+    return header[1], read_lidar.countRays(lidar_file, header[0], header[1])
+
+
+
+def ray_angles(lidar_file, cache_dir = None):
+    """
+    Azimuth and elevation of each ray in lidar_file, from the cache in
+    cache_dir if the file is there, otherwise from just the ray timestamp
+    lines (see read_lidar.LidarFile).
+    """
+    if cache_dir is not None:
+        data = lidar_cache.load(cache_dir, lidar_file, fields = ['AZ', 'EL'])
+        if data is not None:
+            return data['AZ'][:,0], data['EL'][:,0]
+    with read_lidar.LidarFile(lidar_file) as lidar:
+        return lidar.AZ[:,0], lidar.EL[:,0]
+
+
+
+def _read_lidar_file(lidar_file, cache_dir = None, fields = None):
+    """
+    read_lidar.readLidarFile in a worker process, through the cache if
+    cache_dir is given. DD is the same for every gate of a ray, so only one
+    column is sent back rather than the full rays x gates array its
+    broadcast view would be pickled as.
+    """
+    if cache_dir is None:
+        data = read_lidar.readLidarFile(lidar_file, fields = fields)
+    else:
+        data = lidar_cache.readLidarFile(lidar_file, cache_dir, fields = fields)
+    if data.get('DD') is not None:
+        data['DD'] = data['DD'][:,:1].copy()
+    return data
+
+
+
+def read_lidar_files(lidar_files, workers = 1, cache_dir = None, cache_size = lidar_cache.DEFAULT_MAX_SIZE, fields = None):
+    """
+    Yield read_lidar.readLidarFile for each of lidar_files, in input order.
+    With workers > 1, files are parsed in a pool of that many processes,
+    with at most 2 * workers files read ahead so memory stays bounded.
+    If cache_dir is given, files are loaded from the cache there when they
+    have been read before, and added to it when not. The cache is then cut
+    back to cache_size bytes, once all files are read or the generator is
+    closed.
+    fields - arrays wanted from each file, see read_lidar.readLidarFile
+    """
+    try:
+        if workers <= 1:
+            for lidar_file in lidar_files:
+                with lidar_stats.stage('read', file = lidar_file) as record:
+                    record['file_bytes'] = os.path.getsize(lidar_file)
+                    if cache_dir is None:
+                        data = read_lidar.readLidarFile(lidar_file, fields = fields)
+                    else:
+                        data = lidar_cache.readLidarFile(lidar_file, cache_dir, fields = fields)
+                yield data
+        else:
+            files = iter(lidar_files)
+            with ProcessPoolExecutor(max_workers = workers) as executor:
+                pending = deque((lidar_file, executor.submit(_read_lidar_file, lidar_file, cache_dir, fields)) for lidar_file in islice(files, 2 * workers))
+                while pending:
+                    lidar_file, future = pending.popleft()
+                    # parsed in another process, so this is the time spent waiting for it
+                    with lidar_stats.stage('read', file = lidar_file, workers = workers) as record:
+                        record['file_bytes'] = os.path.getsize(lidar_file)
+                        data = future.result()
+                    pending.extend((lidar_file, executor.submit(_read_lidar_file, lidar_file, cache_dir, fields)) for lidar_file in islice(files, 1))
+                    if data.get('DD') is not None:
+                        data['DD'] = np.broadcast_to(data['DD'], (data['maximum'], data['gate_number']))
+                    yield data
+    finally:
+        # also when the caller stops early and the generator is closed
+        if cache_dir is not None:
+            with lidar_stats.stage('cache_evict'):
+                lidar_cache.evict(cache_dir, cache_size)
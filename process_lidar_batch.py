@@ -0,0 +1,190 @@
+"""
+Make the netCDF files for a range of days, e.g. reprocessing a campaign.
+Each day's products from the same raw files (e.g. both wind profile
+products) are a job, run in a pool of processes, so the files are only read
+once. Products whose netCDF file is newer than all of its raw files (and the
+metadata file) are skipped, and a JSON summary of every product is written
+at the end.
+"""
+import os
+import glob
+import json
+import time
+import traceback
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import lidar_util
+import lidar_cache
+import process_lidar_stare
+import process_lidar_wind_profile
+
+
+# job product name: (raw file prefix, netCDF file product, netCDF file options, function making it,
+#                    fields it needs from process_lidar_wind_profile.read_scans, or None if it reads the files itself)
+PRODUCTS = {
+    'stare': ('Stare', 'aerosol-backscatter-radial-winds', 'stare', process_lidar_stare.make_netcdf_aerosol_backscatter_radial_winds, None),
+    'wind-profile': ('Wind_Profile', 'aerosol-backscatter-radial-winds', 'wind-profile', process_lidar_wind_profile.make_netcdf_aerosol_backscatter_radial_winds, process_lidar_wind_profile.PRODUCT_FIELDS['aerosol-backscatter-radial-winds']),
+    'mean-winds-profile': ('Wind_Profile', 'mean-winds-profile', '', process_lidar_wind_profile.make_netcdf_mean_winds_profile, process_lidar_wind_profile.PRODUCT_FIELDS['mean-winds-profile']),
+}
+
+
+def get_days(start_date, end_date):
+    """
+    List of YYYYmmdd strings from start_date to end_date, inclusive.
+    """
+    start = dt.datetime.strptime(start_date, '%Y%m%d')
+    end = dt.datetime.strptime(end_date, '%Y%m%d')
+    return [(start + dt.timedelta(days = i)).strftime('%Y%m%d') for i in range((end - start).days + 1)]
+
+
+
+def raw_files(datapath, day, prefix):
+    """
+    Raw files for day in datapath, laid out as Proc/YYYY/YYYYmm/YYYYmmdd.
+    """
+    return sorted(glob.glob(f'{datapath}/{day[:4]}/{day[:6]}/{day}/{prefix}*.hpl'))
+
+
+
+def output_files(ncfile_location, day, product):
+    """
+    netCDF files already made for day and the job product. Usually one, but
+    the date in the name can include the hour if the raw files only cover
+    part of the day.
+    """
+    nc_product = '_'.join(i for i in PRODUCTS[product][1:3] if i)
+    return sorted(glob.glob(f'{ncfile_location}/ncas-lidar-dop-2_*_{day}*_{nc_product}_v*.nc'))
+
+
+
+def up_to_date(lidar_files, ncfiles, manifest_file, metadata_file = None):
+    """
+    True if there are netCDF files newer than all of lidar_files and
+    metadata_file, and they aren't still being added to by incremental runs
+    (which keep manifest_file next to them, None if it isn't known).
+    """
+    if len(ncfiles) == 0 or manifest_file is None or os.path.isfile(manifest_file):
+        return False
+    inputs = list(lidar_files) + ([metadata_file] if metadata_file is not None else [])
+    return min(os.path.getmtime(ncfile) for ncfile in ncfiles) >= max(os.path.getmtime(f) for f in inputs)
+
+
+
+def run_job(day, products, lidar_files, metadata_file = None, ncfile_location = '.', local_tsv_file_loc = None, workers = 1, cache_dir = None, cache_size = lidar_cache.DEFAULT_MAX_SIZE, encoding = None, verbose = False):
+    """
+    Make the netCDF files of products (all from lidar_files) for day, in a
+    pool process. Products made from process_lidar_wind_profile.read_scans
+    share one read of the files, whose time is each one's 'read_seconds'.
+    Returns the run summary entry of each product.
+    """
+    summaries = [{'date': day, 'product': product, 'raw_files': len(lidar_files)} for product in products]
+    kwargs = {}
+    fields = sorted(set().union(*[PRODUCTS[product][4] for product in products if PRODUCTS[product][4] is not None]))
+    if fields:
+        start = time.perf_counter()
+        try:
+            kwargs['scans'] = process_lidar_wind_profile.read_scans(lidar_files, fields, verbose = verbose, workers = workers, cache_dir = cache_dir, cache_size = cache_size)
+        except Exception as e:
+            for summary in summaries:
+                summary['status'] = 'failed'
+                summary['error'] = f'{type(e).__name__}: {e}'
+                summary['traceback'] = traceback.format_exc()
+            return summaries
+        for summary in summaries:
+            summary['read_seconds'] = round(time.perf_counter() - start, 3)
+    for product, summary in zip(products, summaries):
+        start = time.perf_counter()
+        try:
+            PRODUCTS[product][3](lidar_files, metadata_file = metadata_file, ncfile_location = ncfile_location, verbose = verbose, local_tsv_file_loc = local_tsv_file_loc, workers = workers, cache_dir = cache_dir, cache_size = cache_size, encoding = encoding, **(kwargs if PRODUCTS[product][4] is not None else {}))
+            summary['status'] = 'made'
+            summary['ncfiles'] = output_files(ncfile_location, day, product)
+        except Exception as e:
+            summary['status'] = 'failed'
+            summary['error'] = f'{type(e).__name__}: {e}'
+            summary['traceback'] = traceback.format_exc()
+        summary['seconds'] = round(time.perf_counter() - start, 3)
+    return summaries
+
+
+
+def process_days(start_date, end_date, datapath, products = list(PRODUCTS), metadata_file = None, ncfile_location = '.', local_tsv_file_loc = None, jobs = 1, workers = 1, cache_dir = None, cache_size = lidar_cache.DEFAULT_MAX_SIZE, encoding = None, force = False, verbose = False):
+    """
+    Make netCDF files for products from start_date to end_date (YYYYmmdd,
+    inclusive), with up to jobs jobs at once. Each job is the products of a
+    day that need making from the same raw files, see run_job.
+    force - remake files even if they are up to date
+    workers, cache_dir, cache_size - passed on to each job, see
+                                     lidar_util.read_lidar_files
+    encoding - netCDF chunking, compression and packing options, see
+               lidar_util.get_encoding
+    Returns the run summary.
+    """
+    summary = {'start_date': start_date, 'end_date': end_date, 'datapath': datapath, 'ncfile_location': ncfile_location, 'started': dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"), 'jobs': []}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers = jobs) as executor:
+        futures = []
+        for day in get_days(start_date, end_date):
+            # products to make for each raw file prefix
+            due = {}
+            for product in products:
+                lidar_files = raw_files(datapath, day, PRODUCTS[product][0])
+                try:
+                    manifest_file = lidar_util.manifest_file(ncfile_location, lidar_files[0], *PRODUCTS[product][1:3]) if lidar_files else None
+                except Exception:
+                    # unreadable first file, the job will fail and report it
+                    manifest_file = None
+                if len(lidar_files) == 0:
+                    summary['jobs'].append({'date': day, 'product': product, 'raw_files': 0, 'status': 'no raw files'})
+                elif not force and up_to_date(lidar_files, output_files(ncfile_location, day, product), manifest_file, metadata_file):
+                    summary['jobs'].append({'date': day, 'product': product, 'raw_files': len(lidar_files), 'status': 'up to date'})
+                else:
+                    due.setdefault(PRODUCTS[product][0], (lidar_files, []))[1].append(product)
+            for lidar_files, due_products in due.values():
+                futures.append(executor.submit(run_job, day, due_products, lidar_files, metadata_file = metadata_file, ncfile_location = ncfile_location, local_tsv_file_loc = local_tsv_file_loc, workers = workers, cache_dir = cache_dir, cache_size = cache_size, encoding = encoding))
+        for future in as_completed(futures):
+            for job in future.result():
+                if verbose:
+                    print(f"{job['date']} {job['product']}: {job['status']}" + (f" ({job['error']})" if job['status'] == 'failed' else ''))
+                summary['jobs'].append(job)
+    summary['jobs'].sort(key = lambda job: (job['date'], list(PRODUCTS).index(job['product'])))
+    summary['seconds'] = round(time.perf_counter() - start, 3)
+    summary['counts'] = {status: sum(job['status'] == status for job in summary['jobs']) for status in ['made', 'up to date', 'no raw files', 'failed']}
+    return summary
+
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Create AMOF-compliant netCDF files for ncas-lidar-dop-2 instrument for a range of days.')
+    parser.add_argument('start_date', type = str, help = 'First day to process, YYYYmmdd.')
+    parser.add_argument('end_date', type = str, nargs = '?', help = 'Last day to process, YYYYmmdd. Default is start_date.', default = None)
+    parser.add_argument('-d','--datapath', type = str, help = 'Path to raw data, laid out as YYYY/YYYYmm/YYYYmmdd (the Proc directory). Default is .', default = '.', dest = 'datapath')
+    parser.add_argument('-v','--verbose', action='store_true', help = 'Print out additional information.', dest = 'verbose')
+    parser.add_argument('-m','--metadata', type = str, help = 'csv file with global attributes and additional metadata. Default is None', dest='metadata')
+    parser.add_argument('-o','--ncfile-location', type=str, help = 'Path for where to save netCDF files. Default is .', default = '.', dest="ncfile_location")
+    parser.add_argument('-p','--products', nargs = '*', help = f'Products to make. Options are {", ".join(PRODUCTS)}, default is all of them.', default = list(PRODUCTS), choices = list(PRODUCTS))
+    parser.add_argument('-t','--tsv-location', type = str, help = "Path to local file location for AMF_CVs tsv files for 'offline' use. Default is None ('online' use).", default = None, dest = 'tsv_location')
+    parser.add_argument('-j','--jobs', type = int, help = 'Number of jobs (the products of a day from the same raw files) to run at once. Default is 1.', default = 1, dest = 'jobs')
+    parser.add_argument('-w','--workers', type = int, help = 'Number of processes each job reads raw files with. Default is 1 (read in the job process).', default = 1, dest = 'workers')
+    parser.add_argument('-f','--force', action = 'store_true', help = 'Remake netCDF files even if they are newer than their raw files.', dest = 'force')
+    parser.add_argument('-s','--summary-file', type = str, help = 'Where to write the JSON run summary. Default is batch_summary_<start_date>_<end_date>.json in the netCDF file location.', default = None, dest = 'summary_file')
+    parser.add_argument('--cache-dir', type = str, help = 'Directory to cache parsed raw files in, so they are not parsed again on reruns, e.g. ~/.cache/ncas-lidar-dop-2. Default is None, no cache', default = None, dest = 'cache_dir')
+    parser.add_argument('--cache-size', type = float, help = f'Maximum size of the cache in GB, least recently used files are removed beyond this. Default is {lidar_cache.DEFAULT_MAX_SIZE / 1024**3:g}', default = lidar_cache.DEFAULT_MAX_SIZE / 1024**3, dest = 'cache_size')
+    parser.add_argument('--no-cache', action = 'store_true', help = 'Parse all raw files, without using or adding to the cache, even if --cache-dir is given.', dest = 'no_cache')
+    parser.add_argument('-z','--complevel', type = int, help = 'zlib compression level (1-9) for the data variables, 0 for none. Default is netcdf_complevel in the metadata file, or 0.', default = None, dest = 'complevel')
+    parser.add_argument('--no-shuffle', action = 'store_const', const = False, help = 'Compress without the shuffle filter. Default is netcdf_shuffle in the metadata file, or shuffle.', default = None, dest = 'shuffle')
+    parser.add_argument('--chunks', type = str, help = f'Chunk shape of the data variables, for how they are mostly read: {" or ".join(lidar_util.CHUNK_SHAPES)}, or TIMES,GATES. Default is netcdf_chunks in the metadata file, or the netCDF library default.', default = None, dest = 'chunks')
+    parser.add_argument('--pack', nargs = '*', help = f'VARIABLE=SCALE_FACTOR[,ADD_OFFSET] to store a variable as 16 bit integers, for any of {", ".join(lidar_util.PACKED_VARIABLES)}. Also netcdf_pack_<variable> in the metadata file. Default is no packing.', default = [], dest = 'pack')
+    args = parser.parse_args()
+    end_date = args.start_date if args.end_date is None else args.end_date
+    cache_dir = None if args.no_cache else args.cache_dir
+    cache_size = int(args.cache_size * 1024**3)
+    encoding = {'complevel': args.complevel, 'shuffle': args.shuffle, 'chunks': args.chunks, 'pack': lidar_util.parse_pack(args.pack)}
+    summary_file = args.summary_file if args.summary_file is not None else f'{args.ncfile_location}/batch_summary_{args.start_date}_{end_date}.json'
+
+    summary = process_days(args.start_date, end_date, args.datapath, products = args.products, metadata_file = args.metadata, ncfile_location = args.ncfile_location, local_tsv_file_loc = args.tsv_location, jobs = args.jobs, workers = args.workers, cache_dir = cache_dir, cache_size = cache_size, encoding = encoding, force = args.force, verbose = args.verbose)
+    with open(summary_file, 'w') as f:
+        json.dump(summary, f, indent = 1)
+    if args.verbose:
+        print(f"{summary['counts']}, summary written to {summary_file}")
@@ -1,158 +1,340 @@
+import os
 import datetime as dt
 import numpy as np
 from netCDF4 import Dataset
-import csv
 
 import read_lidar
+import lidar_util
+import lidar_cache
+import lidar_stats
+import lidar_resample
+import lidar_quicklook
+import amof_template
 import aerosol_backscatter_qc
-from ncas_amof_netcdf_template import create_netcdf, util, remove_empty_variables
+from ncas_amof_netcdf_template import util
+
+
+# arrays read from each raw file, see read_lidar.readLidarFile. Range comes from the header, see lidar_util.gate_ranges
+STARE_FIELDS = ['D', 'I', 'B', 'AZ', 'EL', 'DP']
 
 
     
-def get_data(lidar_file):
-    data = read_lidar.readLidarFile(lidar_file)
-    
-    # need to create 3d arrays with dimensions time, index_of_range, index_of_angle
-    # how many angles are there? (hopefully only 1, that's all I've written this for at the moment
-    el_rounded = set([round(i,1) for i in set(data['EL'][:,0])])
-    az_rounded = set([round(i,1) for i in set(data['AZ'][:,0])])
-    no_angles = len(el_rounded) * len(az_rounded)
+def angle_keys(azimuths, elevations):
+    """
+    (ray, 2) azimuths and elevations rounded to 0.1 degrees, so rays at the
+    same pointing angle match. An azimuth of 360 is the same as 0.
+    """
+    return np.column_stack([np.round(np.ravel(azimuths), 1) % 360, np.round(np.ravel(elevations), 1)])
+
+
+
+def get_angles(azimuths, elevations):
+    """
+    Sorted (angle, 2) distinct azimuth/elevation pairs of rays, one for each
+    index_of_angle.
+    """
+    return np.unique(angle_keys(azimuths, elevations), axis = 0)
+
+
+
+def get_angle_index(angles, azimuths, elevations):
+    """
+    Index in angles (from get_angles) of the azimuth and elevation of each
+    ray. Raises ValueError if any ray is at an angle not in angles.
+    """
+    ray_angles, inverse = np.unique(angle_keys(azimuths, elevations), axis = 0, return_inverse = True)
+    matches = np.all(ray_angles[:,np.newaxis,:] == angles[np.newaxis,:,:], axis = 2)
+    missing = ~matches.any(axis = 1)
+    if missing.any():
+        raise ValueError(f'Rays at azimuth/elevation {", ".join(f"{az:g}/{el:g}" for az, el in ray_angles[missing])}, which are not one of the angles of the file ({", ".join(f"{az:g}/{el:g}" for az, el in angles)})')
+    return matches.argmax(axis = 1)[np.ravel(inverse)]
+
+
+
+def file_angles(ncfile):
+    """
+    angles (as from get_angles) of an existing netCDF file, from the
+    instrument frame azimuth and elevation written at each index_of_angle.
+    """
+    azimuths = ncfile.variables['sensor_azimuth_angle_instrument_frame'][:]
+    elevations = ncfile.variables['sensor_view_angle_instrument_frame'][:]
+    # first time each angle was used
+    first = np.argmax(~np.ma.getmaskarray(azimuths), axis = 0)
+    columns = np.arange(azimuths.shape[1])
+    return angle_keys(np.ma.getdata(azimuths)[first, columns].astype(np.float64), np.ma.getdata(elevations)[first, columns].astype(np.float64))
+
+
+
+def angle_columns(values, angle_index, no_angles):
+    """
+    (time,) values of each ray as (time, index_of_angle), in the column of
+    the ray's angle and masked in the others.
+    """
+    columns = np.ma.masked_all((len(values), no_angles))
+    columns[np.arange(len(values)), angle_index] = values
+    return columns
+
+
+
+def get_data(data, arrays = None, angles = None):
+    """
+    data - dict from read_lidar.readLidarFile
+    arrays - lidar_util.RayArrays to put the data in, reusing its buffers
+    angles - from get_angles, for the index_of_angle dimension of the file
+             the data is for. Default is the angles in data.
+    Returns data, the number of angles, the (index_of_range, index_of_angle)
+    ranges, (time, index_of_range, index_of_angle) velocity, backscatter
+    and intensity, and the index of each ray's angle (None if there is only
+    one angle). Each ray is only in the column of its angle, the others are
+    masked.
+    """
+    if angles is None:
+        angles = get_angles(data['AZ'], data['EL'])
+    no_angles = len(angles)
+    angle_index = get_angle_index(angles, data['AZ'], data['EL'])
+    if no_angles == 1:
+        angle_index = None
     
-    if no_angles != 1:
-        print(f"WARNING: More than one elevation/azimuth angle ({no_angles}), code isn't designed to cope with this...")
-        print(f"Azimuths: {set(data['AZ'][:,0])}")
-        print(f"Elevations: {set(data['EL'][:,0])}")
+    # range is the same for every ray and angle, so is kept as (index_of_range, index_of_angle)
+    datarange = np.ma.masked_array(np.repeat(lidar_util.gate_ranges(data['gate_number'], data['gate_length'])[:,np.newaxis], no_angles, axis = 1))
     
-    datarange = np.ma.ones((len(data['TimeStamp']), data['gate_number'], no_angles)) * -9999
-    datarange = np.ma.masked_where(datarange == -9999, datarange)
-    datarange[:,:,0] = data['A']
+    if arrays is None:
+        arrays = lidar_util.RayArrays()
+    angle = 0 if angle_index is None else angle_index
+    datavel = arrays.array('velocity', data['D'], no_angles, angle)
+    databs = arrays.array('backscatter', data['B'], no_angles, angle)
+    dataint = arrays.array('intensity', data['I'], no_angles, angle)
     
-    datavel = np.ma.ones((len(data['TimeStamp']), data['gate_number'], no_angles)) * -9999
-    datavel = np.ma.masked_where(datavel == -9999, datavel)
-    datavel[:,:,0] = data['D']
+    return data, no_angles, datarange, datavel, databs, dataint, angle_index
+
+
+
+def write_rays(ncfile, data, first_ray, last_ray, current_time, valid_limits, verbose = False, arrays = None, angles = None, derived_files = ()):
+    """
+    QC rays first_ray to last_ray of data (dict from read_lidar.readLidarFile)
+    and write them to ncfile, from current_time along the time dimension.
+    arrays, angles - see get_data
+    derived_files - files made from the rays as they are written
+                    (lidar_resample.ResampledFile,
+                    lidar_quicklook.QuicklookFile) to add them to
+    Returns get_times of the rays written.
+    """
+    with lidar_stats.stage('arrays'):
+        data, no_angles, datarange, datavel, databs, dataint, angle_index = get_data(data, arrays, angles)
+    rays = slice(first_ray, last_ray)
+    stop_time = current_time + last_ray - first_ray
+    azimuths = np.round(data['AZ'][rays,:1], 1)
+    elevations = np.round(data['EL'][rays,:1], 1)
+    if angle_index is not None:
+        angle_index = angle_index[rays]
+        azimuths = angle_columns(azimuths[:,0], angle_index, no_angles)
+        elevations = angle_columns(elevations[:,0], angle_index, no_angles)
     
-    databs = np.ma.ones((len(data['TimeStamp']), data['gate_number'], no_angles)) * -9999
-    databs = np.ma.masked_where(databs == -9999, databs)
-    databs[:,:,0] = data['B']
+    if verbose: print('Doing QC')
+    with lidar_stats.stage('qc'):
+        flags = aerosol_backscatter_qc.make_flags(datarange, datavel[rays], dataint[rays], databs[rays], angle_index = angle_index)
     
-    dataint = np.ma.ones((len(data['TimeStamp']), data['gate_number'], no_angles)) * -9999
-    dataint = np.ma.masked_where(dataint == -9999, dataint)
-    dataint[:,:,0] = data['I']
+    if verbose:
+        print('Updating variables')
+    with lidar_stats.stage('write'):
+        lidar_util.update_variable_slice(ncfile, 'range', lidar_util.broadcast_rays(datarange, stop_time - current_time), current_time, stop_time, valid_limits)
+        lidar_util.update_variable_slice(ncfile, 'radial_velocity_of_scatterers_away_from_instrument', datavel[rays], current_time, stop_time, valid_limits)
+        lidar_util.update_variable_slice(ncfile, 'attenuated_aerosol_backscatter_coefficient', databs[rays], current_time, stop_time, valid_limits)
+        lidar_util.update_variable_slice(ncfile, 'signal_to_noise_ratio_plus_1', dataint[rays], current_time, stop_time, valid_limits)
+        lidar_util.update_variable_slice(ncfile, 'qc_flag_radial_velocity_of_scatterers_away_from_instrument', flags, current_time, stop_time, valid_limits)
+        lidar_util.update_variable_slice(ncfile, 'qc_flag_backscatter', flags, current_time, stop_time, valid_limits)
+        lidar_util.update_variable_slice(ncfile, 'sensor_azimuth_angle_instrument_frame', azimuths, current_time, stop_time, valid_limits)
+        lidar_util.update_variable_slice(ncfile, 'sensor_view_angle_instrument_frame', elevations, current_time, stop_time, valid_limits)
+        #util.update_variable(ncfile, 'sensor_azimuth_angle_earth_frame', .....)
+        #util.update_variable(ncfile, 'sensor_view_angle_earth_frame', .....)
+        
+        times = lidar_util.get_times(data['DP'][rays])
+        lidar_util.update_time_variables_slice(ncfile, times, current_time, stop_time, valid_limits)
     
-    return data, no_angles, datarange, datavel, databs, dataint
+    if derived_files:
+        with lidar_stats.stage('derived_files'):
+            values = {'radial_velocity_of_scatterers_away_from_instrument': datavel[rays], 'attenuated_aerosol_backscatter_coefficient': databs[rays], 'signal_to_noise_ratio_plus_1': dataint[rays]}
+            for derived_file in derived_files:
+                derived_file.add(times[0], flags, values)
+    return times
 
 
 
-def make_netcdf_aerosol_backscatter_radial_winds(lidar_files, metadata_file = None, ncfile_location = '.', verbose = False, local_tsv_file_loc = None):
+def read_and_write_rays(ncfile, lidar_files, num_rays, first_rays, all_file_data, current_time, valid_limits, angles, verbose = False, derived_files = ()):
     """
-    lidar_files - list
+    Read each of lidar_files from all_file_data (an iterator of their
+    read_lidar.readLidarFile dicts), and write rays first_rays to num_rays
+    of each to ncfile with write_rays, one file at a time.
+    Rays added to a file after num_rays was counted are left for next time.
+    angles - of the file's index_of_angle dimension, see get_angles
+    derived_files - see write_rays
+    Returns the earliest and latest times written.
     """
-    all_data = {}
-    for i in range(len(lidar_files)):
+    time_coverage_start_dt = []
+    time_coverage_end_dt = []
+    # the files of a day are usually the same size, so their arrays are reused
+    arrays = lidar_util.RayArrays()
+    for i, data in enumerate(all_file_data):
         if verbose:
             print(f'Reading file {i+1} of {len(lidar_files)}')
-        if i == 0:
-            data, no_angles, datarange, datavel, databs, dataint = get_data(lidar_files[i])
-            all_data[str(i)] = data 
-            
-            unix_times, doy, years, months, days, hours, minutes, seconds, time_coverage_start_dt, time_coverage_end_dt, file_date = util.get_times(data['DP'])
-            time_coverage_start_dt = [time_coverage_start_dt]
-            time_coverage_end_dt = [time_coverage_end_dt]
-            file_date = [file_date]
-            
-        else:
-            this_data, this_no_angles, this_datarange, this_datavel, this_databs, this_dataint = get_data(lidar_files[i])
-            all_data[str(i)] = this_data
-            no_angles = np.vstack((no_angles,this_no_angles))
-            datarange = np.vstack((datarange,this_datarange))
-            datavel = np.vstack((datavel,this_datavel))
-            databs = np.vstack((databs,this_databs))
-            dataint = np.vstack((dataint,this_dataint))
-            
-            this_unix_times, this_doy, this_years, this_months, this_days, this_hours, this_minutes, this_seconds, this_time_coverage_start_dt, this_time_coverage_end_dt, this_file_date = util.get_times(this_data['DP'])
-            
-            unix_times.extend(this_unix_times)
-            doy.extend(this_doy)
-            years.extend(this_years)
-            months.extend(this_months)
-            days.extend(this_days)
-            hours.extend(this_hours)
-            minutes.extend(this_minutes)
-            seconds.extend(this_seconds)
-            time_coverage_start_dt.append(this_time_coverage_start_dt)
-            time_coverage_end_dt.append(this_time_coverage_end_dt)
-            file_date.append(this_file_date)
-    
-    if verbose: print('Doing QC')        
-    flags = aerosol_backscatter_qc.make_flags(datarange, datavel, dataint, databs)
-            
-    inst_azimuths = np.ma.ones((len(unix_times),1)) * -9999
-    inst_azimuths = np.ma.masked_where(inst_azimuths == -9999, inst_azimuths)
-    
-    inst_elevations = np.ma.ones((len(unix_times),1)) * -9999
-    inst_elevations = np.ma.masked_where(inst_elevations == -9999, inst_elevations)
-    
-    current_time = 0
-    for key, value in all_data.items():
-        last_time = current_time + len(value['AZ'][:,0])
-        inst_azimuths[current_time:last_time,0] = [round(i,1) for i in value['AZ'][:,0]]#value['AZ'][:,0]
-        inst_elevations[current_time:last_time,0] = [round(i,1) for i in value['EL'][:,0]]#value['EL'][:,0]
-        current_time = last_time
-        
+        if data['maximum'] < num_rays[i]:
+            raise ValueError(f'{lidar_files[i]} has changed since its rays were counted ({num_rays[i]} rays, now {data["maximum"]})')
+        with lidar_stats.stage('file', file = lidar_files[i], rays = num_rays[i] - first_rays[i]):
+            times = write_rays(ncfile, data, first_rays[i], num_rays[i], current_time, valid_limits, verbose = verbose, arrays = arrays, angles = angles, derived_files = derived_files)
+        current_time += num_rays[i] - first_rays[i]
+        time_coverage_start_dt.append(times[8])
+        time_coverage_end_dt.append(times[9])
+    return min(time_coverage_start_dt), max(time_coverage_end_dt)
+
+
+
+def append_aerosol_backscatter_radial_winds(ncfile_path, lidar_files, num_rays, first_rays, verbose = False, workers = 1, cache_dir = None, cache_size = lidar_cache.DEFAULT_MAX_SIZE):
+    """
+    Add the rays of lidar_files from first_rays to num_rays (see
+    lidar_util.new_rays) to the end of the netCDF file made by an earlier
+    incremental run, and update valid_min/valid_max and time_coverage_end.
+    """
+    new_files = [i for i in range(len(lidar_files)) if num_rays[i] > first_rays[i]]
+    if len(new_files) == 0:
+        if verbose:
+            print('No new rays to add')
+        return
+    if verbose:
+        print(f'Adding {sum(num_rays) - sum(first_rays)} rays to {ncfile_path}')
+    ncfile = Dataset(ncfile_path, 'a')
+    valid_limits = lidar_util.get_valid_limits(ncfile)
+    # the index_of_angle dimension can't grow, so new rays have to be at the angles already in the file
+    angles = file_angles(ncfile)
+    all_file_data = lidar_util.read_lidar_files([lidar_files[i] for i in new_files], workers = workers, cache_dir = cache_dir, cache_size = cache_size, fields = STARE_FIELDS)
+    _, time_coverage_end_dt = read_and_write_rays(ncfile, [lidar_files[i] for i in new_files], [num_rays[i] for i in new_files], [first_rays[i] for i in new_files], all_file_data, len(ncfile.dimensions['time']), valid_limits, angles, verbose = verbose)
+    lidar_util.set_valid_limits(ncfile, valid_limits)
+    ncfile.setncattr('time_coverage_end', dt.datetime.fromtimestamp(time_coverage_end_dt, dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"))
+    ncfile.setncattr('last_revised_date', dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"))
+    with lidar_stats.stage('close') as record:
+        ncfile.close()
+        record['ncfile_bytes'] = os.path.getsize(ncfile_path)
+
+
+
+def make_netcdf_aerosol_backscatter_radial_winds(lidar_files, metadata_file = None, ncfile_location = '.', verbose = False, local_tsv_file_loc = None, workers = 1, cache_dir = None, cache_size = lidar_cache.DEFAULT_MAX_SIZE, incremental = False, encoding = None, resample = None, quicklook = False):
+    """
+    lidar_files - list
+    The time dimension is sized from the ray counts of the files, then each
+    file is read, QC'd and written into it in turn, so only one file's data
+    is in memory at a time (plus the first and penultimate files, which are
+    needed up front for the file name).
+    workers - number of processes to read files with, see lidar_util.read_lidar_files
+    cache_dir, cache_size - cache of parsed files, see lidar_util.read_lidar_files (None for no cache)
+    incremental - for a day that is still being measured. A manifest of the
+                  rays in the netCDF file is kept, and later runs only add
+                  rays that are new since. The file is named by day, has an
+                  unlimited time dimension.
+    encoding - netCDF chunking, compression and packing options, see
+               lidar_util.get_encoding (they can also be in metadata_file)
+    resample - intervals in seconds to also make files of averages over,
+               see lidar_resample. Not made by incremental runs.
+    quicklook - also make a pyramid of decimated levels for plotting, see
+                lidar_quicklook. Not made by incremental runs.
+    """
+    manifest_file = lidar_util.manifest_file(ncfile_location, lidar_files[0], 'aerosol-backscatter-radial-winds', 'stare')
+    if incremental:
+        manifest = lidar_util.load_manifest(manifest_file)
+        new_rays = None if manifest is None else lidar_util.new_rays(manifest, lidar_files, cache_dir)
+        if new_rays is not None:
+            append_aerosol_backscatter_radial_winds(manifest['ncfile'], lidar_files, *new_rays, verbose = verbose, workers = workers, cache_dir = cache_dir, cache_size = cache_size)
+            lidar_util.save_manifest(manifest_file, manifest['ncfile'], lidar_files, new_rays[0])
+            return
+    elif os.path.isfile(manifest_file):
+        # file is about to be remade without an unlimited time dimension
+        os.remove(manifest_file)
+    
+    # the angles of every ray are needed up front for the index_of_angle
+    # dimension, and give the number of rays in each file
+    with lidar_stats.stage('count_rays'):
+        ray_angles = [lidar_util.ray_angles(lidar_file, cache_dir) for lidar_file in lidar_files]
+        num_rays = [len(azimuths) for azimuths, _ in ray_angles]
+        angles = get_angles(np.concatenate([azimuths for azimuths, _ in ray_angles]), np.concatenate([elevations for _, elevations in ray_angles]))
+    # files with no complete ray yet (e.g. one just started) have nothing to
+    # write, but stay in the manifest so their rays are added by a later run
+    counted_files, counted_rays = lidar_files, num_rays
+    lidar_files = [lidar_file for lidar_file, rays in zip(counted_files, counted_rays) if rays > 0]
+    num_rays = [rays for rays in counted_rays if rays > 0]
+    if not lidar_files:
+        raise ValueError('ERROR: No rays in any of the files')
+    if verbose and len(angles) > 1:
+        print(f'Rays at {len(angles)} azimuth/elevation angles: {", ".join(f"{az:g}/{el:g}" for az, el in angles)}')
+    
+    # a single file is both the first and the penultimate, and only read once
+    penultimate = max(len(lidar_files) - 2, 0)
+    if verbose and penultimate == 0:
+        print(f'Reading file 1 of {len(lidar_files)}')
+    elif verbose:
+        print(f'Reading file 1 and {penultimate+1} of {len(lidar_files)}')
+    # files are read in the order they are needed, first and penultimate then the rest
+    held_files = list(dict.fromkeys([0, penultimate]))
+    read_order = held_files + [i for i in range(len(lidar_files)) if i not in held_files]
+    all_file_data = lidar_util.read_lidar_files([lidar_files[i] for i in read_order], workers = workers, cache_dir = cache_dir, cache_size = cache_size, fields = STARE_FIELDS)
+    held_data = {i: next(all_file_data) for i in held_files}
+    first_file_date = lidar_util.get_times(held_data[0]['DP'])[-1]
+    penultimate_file_date = lidar_util.get_times(held_data[penultimate]['DP'])[-1]
+    # header values of the first file are used for the global attributes
+    first_file = {key: value for key, value in held_data[0].items() if not isinstance(value, np.ndarray)}
+    no_angles = len(angles)
     
     if verbose:
         print('Making netCDF file')
     # in this case, we know that often the last measurement of a day is just after midnight
     # as such, we will compare the first file date with the penultimate one, rather than the last
     actual_file_date = ''
-    if file_date[0][:4] == file_date[-2][:4]:
-        actual_file_date += file_date[0][:4]
-        if file_date[0][4:6] == file_date[-2][4:6]:
-            actual_file_date += file_date[0][4:6]
-            if file_date[0][6:8] == file_date[-2][6:8]:
-                actual_file_date += file_date[0][6:8]
-                if file_date[0][8:11] == file_date[-2][8:11]:
-                    actual_file_date += file_date[0][8:11]
-                    if file_date[0][11:13] == file_date[-2][11:13]:
-                        actual_file_date += file_date[0][11:13]
-                        if file_date[0][13:] == file_date[-2][13:]:
-                            actual_file_date += file_date[0][13:]
-
-    ncfile = create_netcdf.main('ncas-lidar-dop-2', date = actual_file_date, dimension_lengths = {'time':len(unix_times), 'index_of_range': all_data['0']['gate_number'], 'index_of_angle': no_angles[0]}, loc = 'land', products = ['aerosol-backscatter-radial-winds'], file_location = ncfile_location, options='stare', use_local_files = local_tsv_file_loc, return_open = True)
-    
-    # needed due to error in AMOF google sheets
-    ncfile.createVariable('qc_flag_radial_velocity_of_scatterers_away_from_instrument', 'b', dimensions=('time', 'index_of_range', 'index_of_angle'))
-    ncfile.createVariable('qc_flag_backscatter', 'b', dimensions=('time', 'index_of_range', 'index_of_angle'))
+    if first_file_date[:4] == penultimate_file_date[:4]:
+        actual_file_date += first_file_date[:4]
+        if first_file_date[4:6] == penultimate_file_date[4:6]:
+            actual_file_date += first_file_date[4:6]
+            if first_file_date[6:8] == penultimate_file_date[6:8]:
+                actual_file_date += first_file_date[6:8]
+                if first_file_date[8:11] == penultimate_file_date[8:11]:
+                    actual_file_date += first_file_date[8:11]
+                    if first_file_date[11:13] == penultimate_file_date[11:13]:
+                        actual_file_date += first_file_date[11:13]
+                        if first_file_date[13:] == penultimate_file_date[13:]:
+                            actual_file_date += first_file_date[13:]
+    if incremental:
+        # later runs add to the same file, whatever hours it then covers
+        actual_file_date = actual_file_date[:8]
     
-    if verbose:
-        print('Updating variables')
-    util.update_variable(ncfile, 'range', datarange)
-    util.update_variable(ncfile, 'radial_velocity_of_scatterers_away_from_instrument', datavel)
-    util.update_variable(ncfile, 'attenuated_aerosol_backscatter_coefficient', databs)
-    util.update_variable(ncfile, 'signal_to_noise_ratio_plus_1', dataint)
-    util.update_variable(ncfile, 'sensor_azimuth_angle_instrument_frame', inst_azimuths)
-    util.update_variable(ncfile, 'sensor_view_angle_instrument_frame', inst_elevations)
-    util.update_variable(ncfile, 'qc_flag_radial_velocity_of_scatterers_away_from_instrument', flags)
-    util.update_variable(ncfile, 'qc_flag_backscatter', flags)
-    #util.update_variable(ncfile, 'sensor_azimuth_angle_earth_frame', .....)
-    #util.update_variable(ncfile, 'sensor_view_angle_earth_frame', .....)
-    util.update_variable(ncfile, 'time', unix_times)
-    util.update_variable(ncfile, 'year', years)
-    util.update_variable(ncfile, 'month', months)
-    util.update_variable(ncfile, 'day', days)
-    util.update_variable(ncfile, 'hour', hours)
-    util.update_variable(ncfile, 'minute', minutes)
-    util.update_variable(ncfile, 'second', seconds)
-    util.update_variable(ncfile, 'day_of_year', doy)
-    
-    ncfile.setncattr('time_coverage_start', dt.datetime.fromtimestamp(min(time_coverage_start_dt), dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"))
-    ncfile.setncattr('time_coverage_end', dt.datetime.fromtimestamp(max(time_coverage_end_dt), dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"))
-    ncfile.setncattr('pulses_per_ray', int(all_data['0']['pulses_per_ray']))
-    ncfile.setncattr('rays_per_point', int(all_data['0']['rays_per_point']))
-    ncfile.setncattr('focus', f"{int(all_data['0']['focus_range'])}m" if int(all_data['0']['focus_range']) != 65535 else 'Inf')
-    ncfile.setncattr('velocity_resolution', f"{float(all_data['0']['resolution'])} m/s")
-    ncfile.setncattr('number_of_gates', int(all_data['0']['gate_number']))
-    ncfile.setncattr('gate_length', f"{int(all_data['0']['gate_length'])}m")
+    dimension_lengths = {'time':None if incremental else sum(num_rays), 'index_of_range': first_file['gate_number'], 'index_of_angle': no_angles}
+    variable_encoding = lidar_util.get_variable_encoding('aerosol-backscatter-radial-winds', dimension_lengths, metadata_file, encoding)
+    with lidar_stats.stage('make_netcdf'):
+        ncfile = amof_template.make_netcdf('ncas-lidar-dop-2', 'aerosol-backscatter-radial-winds', actual_file_date, dimension_lengths = dimension_lengths, loc = 'land', file_location = ncfile_location, options='stare', use_local_files = local_tsv_file_loc, variables = lidar_util.PRODUCT_VARIABLES['aerosol-backscatter-radial-winds'], encoding = variable_encoding)
+        
+        # needed due to error in AMOF google sheets
+        ncfile.createVariable('qc_flag_radial_velocity_of_scatterers_away_from_instrument', 'b', dimensions=('time', 'index_of_range', 'index_of_angle'), **variable_encoding.get('qc_flag_radial_velocity_of_scatterers_away_from_instrument', {}))
+        ncfile.createVariable('qc_flag_backscatter', 'b', dimensions=('time', 'index_of_range', 'index_of_angle'), **variable_encoding.get('qc_flag_backscatter', {}))
+    
+    derived_files = []
+    if (resample or quicklook) and incremental:
+        print('WARNING: files of averages and quick-looks are not made by incremental runs, make them when the day is complete')
+    elif resample or quicklook:
+        datarange = np.repeat(lidar_util.gate_ranges(first_file['gate_number'], first_file['gate_length'])[:,np.newaxis], no_angles, axis = 1)
+        derived_files = [lidar_resample.ResampledFile(ncfile, interval, datarange, lidar_util.get_encoding(metadata_file, encoding)) for interval in resample or []]
+        if quicklook:
+            derived_files.append(lidar_quicklook.QuicklookFile(ncfile, sum(num_rays), datarange, lidar_util.get_encoding(metadata_file, encoding)))
+    
+    valid_limits = {}
+    file_data = (held_data.pop(i) if i in held_data else next(all_file_data) for i in range(len(lidar_files)))
+    time_coverage_start_dt, time_coverage_end_dt = read_and_write_rays(ncfile, lidar_files, num_rays, [0] * len(lidar_files), file_data, 0, valid_limits, angles, verbose = verbose, derived_files = derived_files)
+    # every file has been taken from all_file_data, closing it cuts back the cache
+    all_file_data.close()
+    lidar_util.set_valid_limits(ncfile, valid_limits)
+    
+    ncfile.setncattr('time_coverage_start', dt.datetime.fromtimestamp(time_coverage_start_dt, dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"))
+    ncfile.setncattr('time_coverage_end', dt.datetime.fromtimestamp(time_coverage_end_dt, dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"))
+    ncfile.setncattr('pulses_per_ray', int(first_file['pulses_per_ray']))
+    ncfile.setncattr('rays_per_point', int(first_file['rays_per_point']))
+    ncfile.setncattr('focus', f"{int(first_file['focus_range'])}m" if int(first_file['focus_range']) != 65535 else 'Inf')
+    ncfile.setncattr('velocity_resolution', f"{float(first_file['resolution'])} m/s")
+    ncfile.setncattr('number_of_gates', int(first_file['gate_number']))
+    ncfile.setncattr('gate_length', f"{int(first_file['gate_length'])}m")
     
     util.add_metadata_to_netcdf(ncfile, metadata_file)
                 
@@ -165,11 +347,18 @@ def make_netcdf_aerosol_backscatter_radial_winds(lidar_files, metadata_file = No
         geobounds = f"{ncfile.variables['latitude'][0]}N, {ncfile.variables['longitude'][0]}E"
         ncfile.setncattr('geospatial_bounds', geobounds)
     
-    ncfile.close()
+    for derived_file in derived_files:
+        if verbose:
+            print(f'Writing {derived_file.path}')
+        derived_file.close(ncfile)
+    
+    ncfile_path = ncfile.filepath()
+    with lidar_stats.stage('close') as record:
+        ncfile.close()
+        record['ncfile_bytes'] = os.path.getsize(ncfile_path)
     
-    if verbose:
-        print('Removing empty variables')
-    remove_empty_variables.main(f'{ncfile_location}/ncas-lidar-dop-2_iao_{actual_file_date}_aerosol-backscatter-radial-winds_stare_v1.0.nc', verbose = verbose, skip_check = True)
+    if incremental:
+        lidar_util.save_manifest(manifest_file, ncfile_path, counted_files, counted_rays)
 
 
     
@@ -183,13 +372,33 @@ if __name__ == "__main__":
     parser.add_argument('-o','--ncfile-location', type=str, help = 'Path for where to save netCDF file. Default is .', default = '.', dest="ncfile_location")
     parser.add_argument('-p','--products', nargs = '*', help = 'Products of ncas-lidar-dop-2 to make netCDF files for. Options are mean-winds-profile (not yet implemented), aerosol-backscatter-radial-winds, depolarisation-ratio (not yet implemented). One or many can be given (space separated), default is "aerosol-backscatter-radial-winds".', default = ['aerosol-backscatter-radial-winds'])
     parser.add_argument('-t','--tsv-location', type = str, help = "Path to local file location for AMF_CVs tsv files for 'offline' use. Default is None ('online' use).", default = None, dest = 'tsv_location')
+    parser.add_argument('-w','--workers', type = int, help = 'Number of processes to read raw files with. Default is 1 (read in the main process).', default = 1, dest = 'workers')
+    parser.add_argument('--cache-dir', type = str, help = 'Directory to cache parsed raw files in, so they are not parsed again on reruns, e.g. ~/.cache/ncas-lidar-dop-2. Default is None, no cache', default = None, dest = 'cache_dir')
+    parser.add_argument('--cache-size', type = float, help = f'Maximum size of the cache in GB, least recently used files are removed beyond this. Default is {lidar_cache.DEFAULT_MAX_SIZE / 1024**3:g}', default = lidar_cache.DEFAULT_MAX_SIZE / 1024**3, dest = 'cache_size')
+    parser.add_argument('--no-cache', action = 'store_true', help = 'Parse all raw files, without using or adding to the cache, even if --cache-dir is given.', dest = 'no_cache')
+    parser.add_argument('-i','--incremental', action = 'store_true', help = "Only add data from raw files (or rays) that are new since the last incremental run for the day, e.g. for today's data.", dest = 'incremental')
+    parser.add_argument('-z','--complevel', type = int, help = 'zlib compression level (1-9) for the data variables, 0 for none. Default is netcdf_complevel in the metadata file, or 0.', default = None, dest = 'complevel')
+    parser.add_argument('--no-shuffle', action = 'store_const', const = False, help = 'Compress without the shuffle filter. Default is netcdf_shuffle in the metadata file, or shuffle.', default = None, dest = 'shuffle')
+    parser.add_argument('--chunks', type = str, help = f'Chunk shape of the data variables, for how they are mostly read: {" or ".join(lidar_util.CHUNK_SHAPES)}, or TIMES,GATES. Default is netcdf_chunks in the metadata file, or the netCDF library default.', default = None, dest = 'chunks')
+    parser.add_argument('--pack', nargs = '*', help = f'VARIABLE=SCALE_FACTOR[,ADD_OFFSET] to store a variable as 16 bit integers, for any of {", ".join(lidar_util.PACKED_VARIABLES)}. Also netcdf_pack_<variable> in the metadata file. Default is no packing.', default = [], dest = 'pack')
+    parser.add_argument('--resample', nargs = '*', type = float, help = 'Also make files of the mean and variance, over intervals of these many seconds, of the velocity, backscatter and SNR with QC flag 1, e.g. --resample 10 60 600. Not made with --incremental. Default is none.', default = [], dest = 'resample')
+    parser.add_argument('--quicklook', action = 'store_true', help = 'Also make a file of the min, max and mean of the velocity and backscatter with QC flag 1 over blocks of rays and gates, at levels of halving resolution, for plotting long periods. Not made with --incremental.', dest = 'quicklook')
+    parser.add_argument('--stats-file', type = str, help = 'File to append the time, CPU time, peak memory and bytes read and written of each processing stage and raw file to, as lines of JSON. Default is None (not recorded).', default = None, dest = 'stats_file')
+    parser.add_argument('--profile', type = str, help = 'File to save cProfile stats of the run to, for reading with pstats. Default is None (not profiled).', default = None, dest = 'profile')
     args = parser.parse_args()
+    cache_dir = None if args.no_cache else args.cache_dir
+    cache_size = int(args.cache_size * 1024**3)
+    encoding = {'complevel': args.complevel, 'shuffle': args.shuffle, 'chunks': args.chunks, 'pack': lidar_util.parse_pack(args.pack)}
+    if args.stats_file is not None:
+        lidar_stats.start(args.stats_file)
     
     
-    for prod in args.products:
-        if prod == 'aerosol-backscatter-radial-winds':
-            make_netcdf_aerosol_backscatter_radial_winds(args.input_file, metadata_file = args.metadata, ncfile_location = args.ncfile_location, verbose = args.verbose, local_tsv_file_loc = args.tsv_location)
-        elif prod in ['mean-winds-profile', 'depolarisation-ratio']:
-            print(f'WARNING: {prod} is not yet implemented, continuing with other prodcuts...')
-        else:
-            print(f'WARNING: {prod} is not recognised for this instrument, continuing with other prodcuts...')
+    with lidar_stats.profile(args.profile):
+        for prod in args.products:
+            if prod == 'aerosol-backscatter-radial-winds':
+                with lidar_stats.stage('product', product = prod, raw_files = len(args.input_file)):
+                    make_netcdf_aerosol_backscatter_radial_winds(args.input_file, metadata_file = args.metadata, ncfile_location = args.ncfile_location, verbose = args.verbose, local_tsv_file_loc = args.tsv_location, workers = args.workers, cache_dir = cache_dir, cache_size = cache_size, incremental = args.incremental, encoding = encoding, resample = args.resample, quicklook = args.quicklook)
+            elif prod in ['mean-winds-profile', 'depolarisation-ratio']:
+                print(f'WARNING: {prod} is not yet implemented, continuing with other prodcuts...')
+            else:
+                print(f'WARNING: {prod} is not recognised for this instrument, continuing with other prodcuts...')
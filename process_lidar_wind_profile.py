@@ -1,210 +1,336 @@
+import os
 import datetime as dt
 import numpy as np
 from netCDF4 import Dataset
 import csv
-from bisect import bisect_left
+from functools import lru_cache
 
 import read_lidar
+import lidar_util
+import lidar_cache
+import lidar_stats
+import amof_template
 import aerosol_backscatter_qc
-from ncas_amof_netcdf_template import create_netcdf, util, remove_empty_variables
+from ncas_amof_netcdf_template import util
 
 
+# arrays read from each raw file for each product, see read_lidar.readLidarFile. Range comes from the header, see lidar_util.gate_ranges
+RADIAL_WINDS_FIELDS = ['D', 'I', 'B', 'AZ', 'EL', 'DP']
+MEAN_WINDS_FIELDS = ['D', 'AZ', 'EL', 'DP']
+PRODUCT_FIELDS = {'aerosol-backscatter-radial-winds': RADIAL_WINDS_FIELDS, 'mean-winds-profile': MEAN_WINDS_FIELDS}
 
-def uv_from_dir(u,v):
+
+def wind_from_direction(u, v):
     """
-    Given u and v wind speeds, returns direction wind travelling from
+    Given arrays of u and v wind speeds, returns direction wind travelling from
     """
-    if v == 0:
-        if u >= 0:
-            a = 270
-        else:
-            a = 90
-    else:
-        a = np.rad2deg(np.arctan(u/v))
-        if v > 0:
-            a += 180
-        if v < 0:
-            if u > 0:
-                a += 360
-    return (a)
-
-
-
-def find_closest(numberlist, number, which='closest'):
-    """
-    Given a list and a desired number, this function finds the closest number
-    in the list to the desired number. If two numbers in the list are equally
-    close, the smaller one is returned.
-    Options:
-    which
-         'closest' - returns number and index of number closest in list.
-                     Default option.
-         'lower'   - returns number and index of number in list immediately
-                     below given number.
-         'higher'  - returns number and index of number in list immediately
-                     above given number.
-         'both'    - returns number and index of number above and below it in
-                     list.
-    Returns number in list and index of that number in list.
-    """
-    if which not in {'closest', 'lower', 'higher', 'both'}:
-        msg = "Invalid option for which - valid options are 'closest', 'lower', 'higher', and 'both'"
+    wdir = np.rad2deg(np.arctan2(-u, -v)) % 360
+    # no wind is given as from 270, as it always has been
+    return np.where((u == 0) & (v == 0), 270, wdir)
+
+
+
+def closest_index(numbers, values):
+    """
+    Index of the closest number in sorted array numbers to each of values.
+    If two numbers are equally close, the index of the smaller one is
+    returned, and values outside numbers get the first or last index.
+    """
+    pos = np.searchsorted(numbers, values)
+    before = np.clip(pos - 1, 0, len(numbers) - 1)
+    after = np.clip(pos, 0, len(numbers) - 1)
+    index = np.where(numbers[after] - values < values - numbers[before], after, before)
+    index = np.where(pos == 0, 0, index)
+    return np.where(pos == len(numbers), len(numbers) - 1, index)
+
+
+
+def scan_files(lidar_files, cache_dir = None):
+    """
+    Number of scans, gates and angles in a day of wind profile files, from
+    the file headers and a count of the rays in each file, so the arrays can
+    be made at their final size before any data is read.
+    Each file is one scan with a ray per angle, so all files need the same
+    number of gates and rays. Files with no complete ray yet (e.g. one that
+    has just been started) are left out.
+    Returns the files with rays, and the numbers of scans, gates and angles.
+    """
+    counts = [lidar_util.count_rays(lidar_file, cache_dir) for lidar_file in lidar_files]
+    lidar_files = [lidar_file for lidar_file, (_, rays) in zip(lidar_files, counts) if rays > 0]
+    if not lidar_files:
+        raise ValueError("ERROR: No rays in any of the files")
+    gate_numbers, num_rays = zip(*[count for count in counts if count[1] > 0])
+    if len(set(gate_numbers)) != 1 or len(set(num_rays)) != 1:
+        msg = f"ERROR: Number of gates ({set(gate_numbers)}) or rays ({set(num_rays)}) changes between files"
         raise ValueError(msg)
-    pos = bisect_left(numberlist, number)
-    if not isinstance(numberlist,list):
-        numberlist=list(numberlist)
-    if pos == 0:
-        return numberlist[0],0
-    if pos == len(numberlist):
-        return numberlist[-1],numberlist.index(numberlist[-1])
-    before=numberlist[pos-1]
-    after=numberlist[pos]
-    if which == 'closest':
-        if after-number < number-before:
-            return after, numberlist.index(after)
-        else:
-            return before, numberlist.index(before)
-    elif which == 'lower':
-        return before, numberlist.index(before)
-    elif which == 'higher':
-        return after, numberlist.index(after)
-    elif which == 'both':
-        return before, after, numberlist.index(before), numberlist.index(after)
+    return lidar_files, len(lidar_files), gate_numbers[0], num_rays[0]
 
 
-    
-def get_data(lidar_file):
-    data = read_lidar.readLidarFile(lidar_file)
-    
-    # need to create 3d arrays with dimensions time, index_of_range, index_of_angle
-    # how many angles are there? (hopefully only 1, that's all I've written this for at the moment
-    el_rounded = set([round(i,1) for i in set(data['EL'][:,0])])
+
+def get_no_angles(data):
+    """
+    data - dict from read_lidar.readLidarFile
+    Number of azimuth angles in the scan
+    """
     az_rounded = set([round(i,1) for i in set(data['AZ'][:,0])])
-    no_angles = len(az_rounded)
-    
-    datarange = np.ma.ones((1, data['gate_number'], no_angles)) * -9999
-    datarange = np.ma.masked_where(datarange == -9999, datarange)
-    datarange[0,:,:] = data['A'].T
-    
-    datavel = np.ma.ones((1, data['gate_number'], no_angles)) * -9999
-    datavel = np.ma.masked_where(datavel == -9999, datavel)
-    datavel[0,:,:] = data['D'].T
-    
-    databs = np.ma.ones((1, data['gate_number'], no_angles)) * -9999
-    databs = np.ma.masked_where(databs == -9999, databs)
-    databs[0,:,:] = data['B'].T
-    
-    dataint = np.ma.ones((1, data['gate_number'], no_angles)) * -9999
-    dataint = np.ma.masked_where(dataint == -9999, dataint)
-    dataint[0,:,:] = data['I'].T
-    
-    return data, no_angles, datarange, datavel, databs, dataint
+    return len(az_rounded)
 
 
 
-def calculate_3d_winds(data):
-    altitudes = (data['A'][:,:] * np.sin(np.deg2rad(data['EL'][:])))
+def check_no_angles(data, no_angles, lidar_file):
+    """
+    Raise ValueError if the scan in data doesn't have a ray at each of
+    no_angles different azimuths.
+    """
+    this_no_angles = get_no_angles(data)
+    if this_no_angles != no_angles or data['maximum'] != no_angles:
+        msg = f"ERROR: {lidar_file} has {data['maximum']} rays at {this_no_angles} azimuth angles, expected {no_angles}"
+        raise ValueError(msg)
+
+
+
+@lru_cache(maxsize = 32)
+def gate_matching_index(elevations, azimuths, gate_length, gate_number):
+    """
+    Beam geometry for calculate_3d_winds. This only depends on the pointing
+    angles and gates, not the data, so is worked out once and cached.
+    elevations, azimuths - tuples with the angle of each ray in the scan
+    Returns
+      vertical_coords - altitudes of the vertical beam gates that are used
+      beams - index of the vertical, 90 and 0/360 azimuth rays
+      gates - index of the gate in each of the beams closest to each of vertical_coords
+      angle_array - matrix taking the beams' radial velocities to u, v and w
+    """
+    elevations = np.array(elevations)
+    azimuths = np.array(azimuths)
+    ranges = (np.arange(gate_number) + 0.5) * gate_length
+    altitudes = ranges * np.sin(np.deg2rad(elevations))[:,np.newaxis]
     # index of vertical pointing beam. Well, first find biggest elevation, check it's 90 (or close to, e.g. 90.01 is okay)
-    for i in np.where((data['EL'])==(np.max(data['EL'])))[0]:
-        if abs(data['EL'][i] - 90) < 0.5:  # np.sin(89.5) = 0.9996, 9585 * 0.9996 = 9584.64. I'd say +/- 0.5 deg is okay
-            vertical_beam = i
-            vertical_coords = data['A'][i]
+    # np.sin(89.5) = 0.9996, 9585 * 0.9996 = 9584.64. I'd say +/- 0.5 deg is okay
+    vertical_beams = np.nonzero((elevations == np.max(elevations)) & (abs(elevations - 90) < 0.5))[0]
     # find indexs for 90 and 0/360 azimuths
-    for i in range(len(data['AZ'])):
-        if abs(data['AZ'][i]-90) < 0.5:
-            az90_index = i
-        elif abs(data['AZ'][i]-360) < 0.5 or abs(data['AZ'][i]-0) < 0.5:
-            az360_index = i
+    az90_indexs = np.nonzero(abs(azimuths - 90) < 0.5)[0]
+    az360_indexs = np.nonzero((abs(azimuths - 360) < 0.5) | (abs(azimuths - 0) < 0.5))[0]
+    if len(vertical_beams) == 0 or len(az90_indexs) == 0 or len(az360_indexs) == 0:
+        msg = f"ERROR: Need vertical, 90 and 0/360 azimuth beams, got elevations {elevations} and azimuths {azimuths}"
+        raise ValueError(msg)
+    beams = np.array([vertical_beams[-1], az90_indexs[-1], az360_indexs[-1]])
     # find max height to use, this will be minimum highest height from the three beams
-    max_height = np.min(altitudes[:,-1])  # 4795.5 in this example
+    max_height = np.min(altitudes[:,-1])
     # now only want vertical coords that are less than max_height
-    vertical_coords = vertical_coords[np.where(vertical_coords <= max_height)]
+    vertical_coords = ranges[ranges <= max_height]
     # find closest gate in each beam to the vertical coords
-    indexs_beam0 = []  # vertical
-    indexs_beam1 = []  # 0/360
-    indexs_beam2 = []  # 90
-    for v in vertical_coords:
-        indexs_beam0.append(find_closest(altitudes[vertical_beam], v)[1])
-        indexs_beam1.append(find_closest(altitudes[az360_index], v)[1])
-        indexs_beam2.append(find_closest(altitudes[az90_index], v)[1])
-        
-    all_vr1s = data['D'][vertical_beam, indexs_beam0]
-    all_vr2s = data['D'][az90_index, indexs_beam2]
-    all_vr3s = data['D'][az360_index, indexs_beam1]  
-    dop_winds = np.array([all_vr1s,all_vr2s,all_vr3s])
-    
-    angle_array = np.array([[-np.tan(np.deg2rad(data['EL'][az90_index,0])), 1/np.cos(np.deg2rad(data['EL'][az90_index,0])), 0],
-                            [-np.tan(np.deg2rad(data['EL'][az360_index,0])), 0,                                             1/np.cos(np.deg2rad(data['EL'][az360_index,0]))],
-                            [1,                                              0,                                             0]])
+    gates = np.array([closest_index(altitudes[beam], vertical_coords) for beam in beams])
+    
+    az90_elevation = np.deg2rad(elevations[beams[1]])
+    az360_elevation = np.deg2rad(elevations[beams[2]])
+    angle_array = np.array([[-np.tan(az90_elevation),  1/np.cos(az90_elevation), 0],
+                            [-np.tan(az360_elevation), 0,                        1/np.cos(az360_elevation)],
+                            [1,                        0,                        0]])
+    return vertical_coords, beams, gates, angle_array
 
-    # Matrix multiplication
-    threedwinds = angle_array@dop_winds
+
+
+def get_gate_matching_index(data):
+    """
+    gate_matching_index for the scan in data, a dict from read_lidar.readLidarFile
+    """
+    return gate_matching_index(tuple(data['EL'][:,0].tolist()), tuple(data['AZ'][:,0].tolist()), data['gate_length'], data['gate_number'])
+
+
+
+def calculate_3d_winds(doppler, geometries):
+    """
+    u, v and w winds for many scans at once
+    doppler - (scans, rays, gates) radial velocities
+    geometries - gate_matching_index of each scan
+    Returns threedwinds (scans, 3, altitudes), with wind speed and direction (scans, altitudes)
+    """
+    beams = np.array([geometry[1] for geometry in geometries])
+    gates = np.array([geometry[2] for geometry in geometries])
+    angle_arrays = np.array([geometry[3] for geometry in geometries])
+    dop_winds = doppler[np.arange(len(geometries))[:,np.newaxis,np.newaxis], beams[:,:,np.newaxis], gates]
     
-    wind_speed = (threedwinds[0,:]**2 + threedwinds[1,:]**2) ** 0.5  # 2D wind speed
-    wdir = np.empty(threedwinds[0].shape)
-    for i in range(threedwinds[0].shape[0]):
-        wdir[i] = uv_from_dir(threedwinds[0,i],threedwinds[1,i])
-        
-    return vertical_coords, threedwinds, wind_speed, wdir
+    # Matrix multiplication
+    threedwinds = angle_arrays @ dop_winds
     
+    wind_speed = (threedwinds[:,0,:]**2 + threedwinds[:,1,:]**2) ** 0.5  # 2D wind speed
+    wdir = wind_from_direction(threedwinds[:,0,:], threedwinds[:,1,:])
+    return threedwinds, wind_speed, wdir
 
 
 
-def make_netcdf_aerosol_backscatter_radial_winds(lidar_files, metadata_file = None, ncfile_location = '.', verbose = False, local_tsv_file_loc = None):
+def complete_scans(lidar_files, cache_dir = None):
     """
-    lidar_files - list
+    lidar_files without any at the end that have fewer rays than the first,
+    as they are still being written.
+    """
+    num_rays = [lidar_util.count_rays(lidar_file, cache_dir)[1] for lidar_file in lidar_files]
+    while len(num_rays) > 1 and num_rays[-1] < num_rays[0]:
+        num_rays.pop()
+    return lidar_files[:len(num_rays)]
+
+
+
+def new_scans(manifest_file, lidar_files, cache_dir = None):
+    """
+    For incremental runs, the files in lidar_files that aren't in the netCDF
+    file in manifest_file yet, and the file's path. None if there is no
+    file to add to, or it has to be made again (see lidar_util.new_rays).
+    Each file is one scan, so a file that has changed since it was added
+    means starting again. Files with no rays yet are left for a later run.
     """
-    all_data = {}
-    for i in range(len(lidar_files)):
+    manifest = lidar_util.load_manifest(manifest_file)
+    if manifest is None:
+        return None
+    new_rays = lidar_util.new_rays(manifest, lidar_files, cache_dir)
+    if new_rays is None or any(0 < first < rays for rays, first in zip(*new_rays)):
+        return None
+    return [lidar_file for lidar_file, rays, first in zip(lidar_files, *new_rays) if first == 0 and rays > 0], manifest['ncfile']
+
+
+
+def read_scans(lidar_files, fields = RADIAL_WINDS_FIELDS + MEAN_WINDS_FIELDS, verbose = False, workers = 1, cache_dir = None, cache_size = lidar_cache.DEFAULT_MAX_SIZE):
+    """
+    Read the scans in lidar_files once, for making any of the products from.
+    fields - arrays to keep from each file, see read_lidar.readLidarFile
+    Returns a dict with a (scan, ray, ...) array of each of fields, the
+    first and last ray time ('start_times', 'end_times') and gate matching
+    geometries of each scan, the header values of the first file
+    ('first_file'), and lidar_files.
+    """
+    scan_lidar_files, _, _, no_angles = scan_files(lidar_files, cache_dir)
+    all_file_data = lidar_util.read_lidar_files(scan_lidar_files, workers = workers, cache_dir = cache_dir, cache_size = cache_size, fields = sorted(set(fields) | {'AZ', 'EL', 'DP'}))
+    # the files are read as they are stacked, so 'read' stages are within this
+    with lidar_stats.stage('read_scans', raw_files = len(scan_lidar_files)):
+        scans = stack_scans(scan_lidar_files, all_file_data, fields, no_angles, verbose = verbose)
+    # the files asked for, so the scans can be matched to them (see get_scans)
+    scans['lidar_files'] = list(lidar_files)
+    return scans
+
+
+
+def stack_scans(lidar_files, all_file_data, fields, no_angles, verbose = False):
+    """
+    read_scans from all_file_data, an iterable of the
+    read_lidar.readLidarFile dicts of lidar_files (with at least fields and
+    'AZ', 'EL' and 'DP'), each no_angles rays.
+    """
+    no_scans = len(lidar_files)
+    scans = {'lidar_files': list(lidar_files), 'geometries': []}
+    scans['start_times'] = np.empty(no_scans, dtype = 'datetime64[us]')
+    scans['end_times'] = np.empty(no_scans, dtype = 'datetime64[us]')
+    
+    for i, data in enumerate(all_file_data):
         if verbose:
             print(f'Reading file {i+1} of {len(lidar_files)}')
+        check_no_angles(data, no_angles, lidar_files[i])
         if i == 0:
-            data, no_angles, datarange, datavel, databs, dataint = get_data(lidar_files[i])
-            all_data[str(i)] = data 
-            
-            unix_times, doy, years, months, days, hours, minutes, seconds, time_coverage_start_dt, time_coverage_end_dt, file_date = util.get_times(data['DP'])
-            time_coverage_start_dt = [time_coverage_start_dt]
-            time_coverage_end_dt = [time_coverage_end_dt]
-            file_date = [file_date]
-            
-        else:
-            this_data, this_no_angles, this_datarange, this_datavel, this_databs, this_dataint = get_data(lidar_files[i])
-            all_data[str(i)] = this_data
-            no_angles = np.vstack((no_angles,this_no_angles))
-            datarange = np.vstack((datarange,this_datarange))
-            datavel = np.vstack((datavel,this_datavel))
-            databs = np.vstack((databs,this_databs))
-            dataint = np.vstack((dataint,this_dataint))
-            
-            this_unix_times, this_doy, this_years, this_months, this_days, this_hours, this_minutes, this_seconds, this_time_coverage_start_dt, this_time_coverage_end_dt, this_file_date = util.get_times(this_data['DP'])
-            
-            unix_times.extend(this_unix_times)
-            doy.extend(this_doy)
-            years.extend(this_years)
-            months.extend(this_months)
-            days.extend(this_days)
-            hours.extend(this_hours)
-            minutes.extend(this_minutes)
-            seconds.extend(this_seconds)
-            time_coverage_start_dt.append(this_time_coverage_start_dt)
-            time_coverage_end_dt.append(this_time_coverage_end_dt)
-            file_date.append(this_file_date)
-            
+            # header values of the first file are used for the global attributes
+            scans['first_file'] = {key: value for key, value in data.items() if not isinstance(value, np.ndarray)}
+            for key in fields:
+                scans[key] = np.empty((no_scans,) + data[key].shape, dtype = data[key].dtype)
+        for key in fields:
+            scans[key][i] = data[key]
+        scans['geometries'].append(get_gate_matching_index(data))
+        scans['start_times'][i] = data['DP'][0]
+        scans['end_times'][i] = data['DP'][-1]
+    return scans
+
+
+
+def get_scans(scans, lidar_files, fields, verbose = False, workers = 1, cache_dir = None, cache_size = lidar_cache.DEFAULT_MAX_SIZE):
+    """
+    scans from read_scans if they are of lidar_files and have all of fields,
+    otherwise lidar_files read with read_scans.
+    """
+    if scans is None or scans['lidar_files'] != list(lidar_files) or not set(fields) <= scans.keys():
+        scans = read_scans(lidar_files, fields, verbose = verbose, workers = workers, cache_dir = cache_dir, cache_size = cache_size)
+    return scans
+
+
+
+def get_radial_winds(scans):
+    """
+    (index_of_range, index_of_angle) ranges, which are the same for every
+    scan, (time, index_of_range, index_of_angle) arrays of velocity,
+    backscatter and intensity, and (time, index_of_angle) azimuths and
+    elevations, from read_scans.
+    """
+    no_scans, no_angles, gate_number = scans['D'].shape
+    # every angle of every scan has data, so these are unmasked views of the scans
+    datarange = np.ma.masked_array(np.repeat(lidar_util.gate_ranges(gate_number, scans['first_file']['gate_length'])[:,np.newaxis], no_angles, axis = 1))
+    datavel = np.ma.masked_array(scans['D'].transpose(0, 2, 1), copy = False)
+    databs = np.ma.masked_array(scans['B'].transpose(0, 2, 1), copy = False)
+    dataint = np.ma.masked_array(scans['I'].transpose(0, 2, 1), copy = False)
+    inst_azimuths = np.ma.masked_array(scans['AZ'][:,:,0], copy = False)
+    inst_elevations = np.ma.masked_array(scans['EL'][:,:,0], copy = False)
+    return datarange, datavel, databs, dataint, inst_azimuths, inst_elevations
+
+
+
+def write_radial_winds(ncfile, datarange, datavel, databs, dataint, inst_azimuths, inst_elevations, times, current_time, valid_limits, verbose = False):
+    """
+    QC the scans from get_radial_winds and write them to ncfile, from
+    current_time along the time dimension. times are the get_scan_times of
+    the scans.
+    """
+    stop_time = current_time + len(datavel)
     if verbose: print('Doing QC')
-    flags = aerosol_backscatter_qc.make_flags(datarange, datavel, dataint, databs)
-            
-            
-    actual_no_angles = no_angles[0][0]
-    
-    inst_azimuths = np.ma.ones((len(unix_times[::actual_no_angles]),3)) * -9999
-    inst_azimuths = np.ma.masked_where(inst_azimuths == -9999, inst_azimuths)
+    with lidar_stats.stage('qc'):
+        flags = aerosol_backscatter_qc.make_flags(datarange, datavel, dataint, databs)
     
-    inst_elevations = np.ma.ones((len(unix_times[::actual_no_angles]),3)) * -9999
-    inst_elevations = np.ma.masked_where(inst_elevations == -9999, inst_elevations)
-    
-    for key, value in all_data.items():
-        inst_azimuths[int(key)] = value['AZ'][:,0]
-        inst_elevations[int(key)] = value['EL'][:,0]
+    if verbose:
+        print('Updating variables')
+    with lidar_stats.stage('write'):
+        lidar_util.update_variable_slice(ncfile, 'range', lidar_util.broadcast_rays(datarange, stop_time - current_time), current_time, stop_time, valid_limits)
+        lidar_util.update_variable_slice(ncfile, 'radial_velocity_of_scatterers_away_from_instrument', datavel, current_time, stop_time, valid_limits)
+        lidar_util.update_variable_slice(ncfile, 'attenuated_aerosol_backscatter_coefficient', databs, current_time, stop_time, valid_limits)
+        lidar_util.update_variable_slice(ncfile, 'signal_to_noise_ratio_plus_1', dataint, current_time, stop_time, valid_limits)
+        lidar_util.update_variable_slice(ncfile, 'sensor_azimuth_angle_instrument_frame', inst_azimuths, current_time, stop_time, valid_limits)
+        lidar_util.update_variable_slice(ncfile, 'sensor_view_angle_instrument_frame', inst_elevations, current_time, stop_time, valid_limits)
+        lidar_util.update_variable_slice(ncfile, 'qc_flag_radial_velocity_of_scatterers_away_from_instrument', flags, current_time, stop_time, valid_limits)
+        lidar_util.update_variable_slice(ncfile, 'qc_flag_backscatter', flags, current_time, stop_time, valid_limits)
+        #util.update_variable(ncfile, 'sensor_azimuth_angle_earth_frame', .....)
+        #util.update_variable(ncfile, 'sensor_view_angle_earth_frame', .....)
+        lidar_util.update_time_variables_slice(ncfile, times, current_time, stop_time, valid_limits)
+
+
+
+def make_netcdf_aerosol_backscatter_radial_winds(lidar_files, metadata_file = None, ncfile_location = '.', verbose = False, local_tsv_file_loc = None, workers = 1, cache_dir = None, cache_size = lidar_cache.DEFAULT_MAX_SIZE, incremental = False, scans = None, encoding = None):
+    """
+    lidar_files - list
+    workers - number of processes to read files with, see lidar_util.read_lidar_files
+    cache_dir, cache_size - cache of parsed files, see lidar_util.read_lidar_files (None for no cache)
+    incremental - for a day that is still being measured. A manifest of the
+                  scans in the netCDF file is kept, and later runs only add
+                  new scans. The file is named by day, has an unlimited time
+                  dimension.
+    scans - read_scans of lidar_files, if already read for another product.
+            Read here if not given, or of different files.
+    encoding - netCDF chunking, compression and packing options, see
+               lidar_util.get_encoding (they can also be in metadata_file)
+    """
+    if incremental:
+        lidar_files = complete_scans(lidar_files, cache_dir)
+    manifest_file = lidar_util.manifest_file(ncfile_location, lidar_files[0], 'aerosol-backscatter-radial-winds', 'wind-profile')
+    if incremental:
+        new_files = new_scans(manifest_file, lidar_files, cache_dir)
+        if new_files is not None:
+            append_aerosol_backscatter_radial_winds(*new_files, verbose = verbose, workers = workers, cache_dir = cache_dir, cache_size = cache_size, scans = scans)
+            lidar_util.save_manifest(manifest_file, new_files[1], lidar_files, [lidar_util.count_rays(lidar_file, cache_dir)[1] for lidar_file in lidar_files])
+            return
+    elif os.path.isfile(manifest_file):
+        # file is about to be remade without an unlimited time dimension
+        os.remove(manifest_file)
+    
+    scans = get_scans(scans, lidar_files, RADIAL_WINDS_FIELDS, verbose = verbose, workers = workers, cache_dir = cache_dir, cache_size = cache_size)
+    first_file = scans['first_file']
+    with lidar_stats.stage('arrays'):
+        datarange, datavel, databs, dataint, inst_azimuths, inst_elevations = get_radial_winds(scans)
+    no_scans, gate_number, no_angles = datavel.shape
+    times = lidar_util.get_scan_times(scans['start_times'], scans['end_times'])
+    time_coverage_start_dt, time_coverage_end_dt, file_date = times[8:]
     
     if verbose:
         print('Making netCDF file')
@@ -222,42 +348,31 @@ def make_netcdf_aerosol_backscatter_radial_winds(lidar_files, metadata_file = No
                         actual_file_date += file_date[0][11:13]
                         if file_date[0][13:] == file_date[-1][13:]:
                             actual_file_date += file_date[0][13:]
+    if incremental:
+        # later runs add to the same file, whatever hours it then covers
+        actual_file_date = actual_file_date[:8]
 
-    ncfile = create_netcdf.main('ncas-lidar-dop-2', date = actual_file_date, dimension_lengths = {'time':len(unix_times)/actual_no_angles, 'index_of_range': all_data['0']['gate_number'], 'index_of_angle': actual_no_angles}, loc = 'land', products = ['aerosol-backscatter-radial-winds'], file_location = ncfile_location, options='wind-profile', return_open = True, use_local_files = local_tsv_file_loc)
-    
-    # needed due to error in AMOF google sheets
-    ncfile.createVariable('qc_flag_radial_velocity_of_scatterers_away_from_instrument', 'b', dimensions=('time', 'index_of_range', 'index_of_angle'))
-    ncfile.createVariable('qc_flag_backscatter', 'b', dimensions=('time', 'index_of_range', 'index_of_angle'))
-    
-    if verbose:
-        print('Updating variables')
-    util.update_variable(ncfile, 'range', datarange)
-    util.update_variable(ncfile, 'radial_velocity_of_scatterers_away_from_instrument', datavel)
-    util.update_variable(ncfile, 'attenuated_aerosol_backscatter_coefficient', databs)
-    util.update_variable(ncfile, 'signal_to_noise_ratio_plus_1', dataint)
-    util.update_variable(ncfile, 'sensor_azimuth_angle_instrument_frame', inst_azimuths)
-    util.update_variable(ncfile, 'sensor_view_angle_instrument_frame', inst_elevations)
-    util.update_variable(ncfile, 'qc_flag_radial_velocity_of_scatterers_away_from_instrument', flags)
-    util.update_variable(ncfile, 'qc_flag_backscatter', flags)
-    #util.update_variable(ncfile, 'sensor_azimuth_angle_earth_frame', .....)
-    #util.update_variable(ncfile, 'sensor_view_angle_earth_frame', .....)
-    util.update_variable(ncfile, 'time', unix_times[::actual_no_angles])
-    util.update_variable(ncfile, 'year', years[::actual_no_angles])
-    util.update_variable(ncfile, 'month', months[::actual_no_angles])
-    util.update_variable(ncfile, 'day', days[::actual_no_angles])
-    util.update_variable(ncfile, 'hour', hours[::actual_no_angles])
-    util.update_variable(ncfile, 'minute', minutes[::actual_no_angles])
-    util.update_variable(ncfile, 'second', seconds[::actual_no_angles])
-    util.update_variable(ncfile, 'day_of_year', doy[::actual_no_angles])
-    
-    ncfile.setncattr('time_coverage_start', dt.datetime.fromtimestamp(min(time_coverage_start_dt), dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"))
-    ncfile.setncattr('time_coverage_end', dt.datetime.fromtimestamp(max(time_coverage_end_dt), dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"))
-    ncfile.setncattr('pulses_per_ray', int(all_data['0']['pulses_per_ray']))
-    ncfile.setncattr('rays_per_point', int(all_data['0']['rays_per_point']))
-    ncfile.setncattr('focus', f"{int(all_data['0']['focus_range'])}m" if int(all_data['0']['focus_range']) != 65535 else 'Inf')
-    ncfile.setncattr('velocity_resolution', f"{float(all_data['0']['resolution'])} m/s")
-    ncfile.setncattr('number_of_gates', int(all_data['0']['gate_number']))
-    ncfile.setncattr('gate_length', f"{int(all_data['0']['gate_length'])}m")
+    dimension_lengths = {'time':None if incremental else no_scans, 'index_of_range': gate_number, 'index_of_angle': no_angles}
+    variable_encoding = lidar_util.get_variable_encoding('aerosol-backscatter-radial-winds', dimension_lengths, metadata_file, encoding)
+    with lidar_stats.stage('make_netcdf'):
+        ncfile = amof_template.make_netcdf('ncas-lidar-dop-2', 'aerosol-backscatter-radial-winds', actual_file_date, dimension_lengths = dimension_lengths, loc = 'land', file_location = ncfile_location, options='wind-profile', use_local_files = local_tsv_file_loc, variables = lidar_util.PRODUCT_VARIABLES['aerosol-backscatter-radial-winds'], encoding = variable_encoding)
+        
+        # needed due to error in AMOF google sheets
+        ncfile.createVariable('qc_flag_radial_velocity_of_scatterers_away_from_instrument', 'b', dimensions=('time', 'index_of_range', 'index_of_angle'), **variable_encoding.get('qc_flag_radial_velocity_of_scatterers_away_from_instrument', {}))
+        ncfile.createVariable('qc_flag_backscatter', 'b', dimensions=('time', 'index_of_range', 'index_of_angle'), **variable_encoding.get('qc_flag_backscatter', {}))
+    
+    valid_limits = {}
+    write_radial_winds(ncfile, datarange, datavel, databs, dataint, inst_azimuths, inst_elevations, times, 0, valid_limits, verbose = verbose)
+    lidar_util.set_valid_limits(ncfile, valid_limits)
+    
+    ncfile.setncattr('time_coverage_start', dt.datetime.fromtimestamp(time_coverage_start_dt, dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"))
+    ncfile.setncattr('time_coverage_end', dt.datetime.fromtimestamp(time_coverage_end_dt, dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"))
+    ncfile.setncattr('pulses_per_ray', int(first_file['pulses_per_ray']))
+    ncfile.setncattr('rays_per_point', int(first_file['rays_per_point']))
+    ncfile.setncattr('focus', f"{int(first_file['focus_range'])}m" if int(first_file['focus_range']) != 65535 else 'Inf')
+    ncfile.setncattr('velocity_resolution', f"{float(first_file['resolution'])} m/s")
+    ncfile.setncattr('number_of_gates', int(first_file['gate_number']))
+    ncfile.setncattr('gate_length', f"{int(first_file['gate_length'])}m")
     
     util.add_metadata_to_netcdf(ncfile, metadata_file)
                 
@@ -270,75 +385,114 @@ def make_netcdf_aerosol_backscatter_radial_winds(lidar_files, metadata_file = No
         geobounds = f"{ncfile.variables['latitude'][0]}N, {ncfile.variables['longitude'][0]}E"
         ncfile.setncattr('geospatial_bounds', geobounds)
     
-    ncfile.close()
+    ncfile_path = ncfile.filepath()
+    with lidar_stats.stage('close') as record:
+        ncfile.close()
+        record['ncfile_bytes'] = os.path.getsize(ncfile_path)
     
-    if verbose:
-        print('Removing empty variables')
-    remove_empty_variables.main(f'{ncfile_location}/ncas-lidar-dop-2_iao_{actual_file_date}_aerosol-backscatter-radial-winds_wind-profile_v1.0.nc', verbose = verbose, skip_check = True)
+    if incremental:
+        lidar_util.save_manifest(manifest_file, ncfile_path, lidar_files, [lidar_util.count_rays(lidar_file, cache_dir)[1] for lidar_file in lidar_files])
 
 
-    
-def make_netcdf_mean_winds_profile(lidar_files, metadata_file = None, ncfile_location = '.', verbose = False, local_tsv_file_loc = None):
+
+def append_aerosol_backscatter_radial_winds(lidar_files, ncfile_path, verbose = False, workers = 1, cache_dir = None, cache_size = lidar_cache.DEFAULT_MAX_SIZE, scans = None):
     """
-    lidar_files - list
+    Add the scans in lidar_files to the end of the netCDF file made by an
+    earlier incremental run, and update valid_min/valid_max and
+    time_coverage_end.
     """
-    all_data = {}
-    for i in range(len(lidar_files)):
+    if len(lidar_files) == 0:
         if verbose:
-            print(f'Reading file {i+1} of {len(lidar_files)}')
-        if i == 0:
-            #data, no_angles, datarange, datavel, databs, dataint = get_data(lidar_files[i])
-            data, no_angles, *_ = get_data(lidar_files[i])
-            all_data[str(i)] = data 
-            
-            unix_times, doy, years, months, days, hours, minutes, seconds, time_coverage_start_dt, time_coverage_end_dt, file_date = util.get_times(data['DP'])
-            time_coverage_start_dt = [time_coverage_start_dt]
-            time_coverage_end_dt = [time_coverage_end_dt]
-            file_date = [file_date]
-            
-            altitudes, threedwinds, wind_speed, wdir = calculate_3d_winds(data)
-            all_threedwinds = np.empty([len(lidar_files),np.shape(threedwinds)[0],np.shape(threedwinds)[1]])
-            all_threedwinds[i] = threedwinds
-            all_wind_speed = np.empty([len(lidar_files),np.shape(wind_speed)[0]])
-            all_wind_speed[i] = wind_speed
-            all_wdir = np.empty([len(lidar_files),np.shape(wdir)[0]])
-            all_wdir[i] = wdir
-
-            
-        else:
-            #this_data, this_no_angles, this_datarange, this_datavel, this_databs, this_dataint = get_data(lidar_files[i])
-            this_data, *_ = get_data(lidar_files[i])
-            all_data[str(i)] = this_data
-            
-            this_unix_times, this_doy, this_years, this_months, this_days, this_hours, this_minutes, this_seconds, this_time_coverage_start_dt, this_time_coverage_end_dt, this_file_date = util.get_times(this_data['DP'])
-            
-            unix_times.extend(this_unix_times)
-            doy.extend(this_doy)
-            years.extend(this_years)
-            months.extend(this_months)
-            days.extend(this_days)
-            hours.extend(this_hours)
-            minutes.extend(this_minutes)
-            seconds.extend(this_seconds)
-            time_coverage_start_dt.append(this_time_coverage_start_dt)
-            time_coverage_end_dt.append(this_time_coverage_end_dt)
-            file_date.append(this_file_date)
-            
-            this_altitudes, this_threedwinds, this_wind_speed, this_wdir = calculate_3d_winds(this_data)
-            
-            # altitudes should match, if not throw error and stop
-            if (this_altitudes != altitudes).any():
-                msg = "ERROR: Change in altitudes with time"
-                raise ValueError(msg)
-                
-            all_threedwinds[i] = this_threedwinds
-            all_wind_speed[i] = this_wind_speed
-            all_wdir[i] = this_wdir
-            
+            print('No new scans to add')
+        return
+    if verbose:
+        print(f'Adding {len(lidar_files)} scans to {ncfile_path}')
+    scans = get_scans(scans, lidar_files, RADIAL_WINDS_FIELDS, verbose = verbose, workers = workers, cache_dir = cache_dir, cache_size = cache_size)
+    with lidar_stats.stage('arrays'):
+        datarange, datavel, databs, dataint, inst_azimuths, inst_elevations = get_radial_winds(scans)
+    times = lidar_util.get_scan_times(scans['start_times'], scans['end_times'])
+    
+    ncfile = Dataset(ncfile_path, 'a')
+    valid_limits = lidar_util.get_valid_limits(ncfile)
+    write_radial_winds(ncfile, datarange, datavel, databs, dataint, inst_azimuths, inst_elevations, times, len(ncfile.dimensions['time']), valid_limits, verbose = verbose)
+    lidar_util.set_valid_limits(ncfile, valid_limits)
+    ncfile.setncattr('time_coverage_end', dt.datetime.fromtimestamp(times[9], dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"))
+    ncfile.setncattr('last_revised_date', dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"))
+    with lidar_stats.stage('close') as record:
+        ncfile.close()
+        record['ncfile_bytes'] = os.path.getsize(ncfile_path)
 
+
+
+def get_mean_winds(scans):
+    """
+    u, v and w winds, wind speed and direction (time, altitude), and the
+    altitudes, from read_scans.
+    """
+    geometries = scans['geometries']
+    # altitudes should match, if not throw error and stop
+    for geometry in geometries:
+        if not np.array_equal(geometry[0], geometries[0][0]):
+            msg = "ERROR: Change in altitudes with time"
+            raise ValueError(msg)
+    
+    altitudes = geometries[0][0]
+    all_threedwinds, all_wind_speed, all_wdir = calculate_3d_winds(scans['D'], geometries)
+    return altitudes, all_threedwinds, all_wind_speed, all_wdir
+
+
+
+def write_mean_winds(ncfile, altitudes, all_threedwinds, all_wind_speed, all_wdir, times, current_time, valid_limits, verbose = False):
+    """
+    Write winds from get_mean_winds to ncfile, from current_time along the
+    time dimension. times are the get_scan_times of the scans.
+    """
+    stop_time = current_time + len(all_threedwinds)
     eastward_winds = all_threedwinds[:,0,:]
     northward_winds = all_threedwinds[:,1,:]
     upward_winds = all_threedwinds[:,2,:]
+    
+    if verbose:
+        print('Updating variables')
+    if ncfile.variables['altitude'].dimensions[0] == 'time':
+        lidar_util.update_variable_slice(ncfile, 'altitude', np.broadcast_to(altitudes, (stop_time - current_time, len(altitudes))), current_time, stop_time, valid_limits)
+    else:
+        lidar_util.update_variable_slice(ncfile, 'altitude', altitudes, None, None, valid_limits)
+    lidar_util.update_variable_slice(ncfile, 'eastward_wind', eastward_winds, current_time, stop_time, valid_limits)
+    lidar_util.update_variable_slice(ncfile, 'northward_wind', northward_winds, current_time, stop_time, valid_limits)
+    lidar_util.update_variable_slice(ncfile, 'upward_air_velocity', upward_winds, current_time, stop_time, valid_limits)
+    lidar_util.update_variable_slice(ncfile, 'wind_speed', all_wind_speed, current_time, stop_time, valid_limits)
+    lidar_util.update_variable_slice(ncfile, 'wind_from_direction', all_wdir, current_time, stop_time, valid_limits)
+    lidar_util.update_time_variables_slice(ncfile, times, current_time, stop_time, valid_limits)
+
+
+
+def make_netcdf_mean_winds_profile(lidar_files, metadata_file = None, ncfile_location = '.', verbose = False, local_tsv_file_loc = None, workers = 1, cache_dir = None, cache_size = lidar_cache.DEFAULT_MAX_SIZE, incremental = False, scans = None, encoding = None):
+    """
+    lidar_files - list
+    workers - number of processes to read files with, see lidar_util.read_lidar_files
+    cache_dir, cache_size - cache of parsed files, see lidar_util.read_lidar_files (None for no cache)
+    incremental, scans, encoding - see make_netcdf_aerosol_backscatter_radial_winds
+    """
+    if incremental:
+        lidar_files = complete_scans(lidar_files, cache_dir)
+    manifest_file = lidar_util.manifest_file(ncfile_location, lidar_files[0], 'mean-winds-profile', '')
+    if incremental:
+        new_files = new_scans(manifest_file, lidar_files, cache_dir)
+        if new_files is not None:
+            append_mean_winds_profile(*new_files, verbose = verbose, workers = workers, cache_dir = cache_dir, cache_size = cache_size, scans = scans)
+            lidar_util.save_manifest(manifest_file, new_files[1], lidar_files, [lidar_util.count_rays(lidar_file, cache_dir)[1] for lidar_file in lidar_files])
+            return
+    elif os.path.isfile(manifest_file):
+        # file is about to be remade without an unlimited time dimension
+        os.remove(manifest_file)
+    
+    scans = get_scans(scans, lidar_files, MEAN_WINDS_FIELDS, verbose = verbose, workers = workers, cache_dir = cache_dir, cache_size = cache_size)
+    with lidar_stats.stage('winds'):
+        altitudes, all_threedwinds, all_wind_speed, all_wdir = get_mean_winds(scans)
+    no_scans = len(all_threedwinds)
+    times = lidar_util.get_scan_times(scans['start_times'], scans['end_times'])
+    time_coverage_start_dt, time_coverage_end_dt, file_date = times[8:]
         
     if verbose: 
         print('Making netCDF file')
@@ -356,28 +510,21 @@ def make_netcdf_mean_winds_profile(lidar_files, metadata_file = None, ncfile_loc
                         actual_file_date += file_date[0][11:13]
                         if file_date[0][13:] == file_date[-1][13:]:
                             actual_file_date += file_date[0][13:]
+    if incremental:
+        # later runs add to the same file, whatever hours it then covers
+        actual_file_date = actual_file_date[:8]
 
-    ncfile = create_netcdf.main('ncas-lidar-dop-2', date = actual_file_date, dimension_lengths = {'time':len(lidar_files), 'altitude': np.shape(altitudes)[0]}, loc = 'land', products = ['mean-winds-profile'], file_location = ncfile_location, return_open = True, use_local_files = local_tsv_file_loc)
+    dimension_lengths = {'time':None if incremental else no_scans, 'altitude': np.shape(altitudes)[0]}
+    with lidar_stats.stage('make_netcdf'):
+        ncfile = amof_template.make_netcdf('ncas-lidar-dop-2', 'mean-winds-profile', actual_file_date, dimension_lengths = dimension_lengths, loc = 'land', file_location = ncfile_location, use_local_files = local_tsv_file_loc, variables = lidar_util.PRODUCT_VARIABLES['mean-winds-profile'], encoding = lidar_util.get_variable_encoding('mean-winds-profile', dimension_lengths, metadata_file, encoding))
     
-    if verbose:
-        print('Updating variables')
-    util.update_variable(ncfile, 'altitude', altitudes)
-    util.update_variable(ncfile, 'eastward_wind', eastward_winds)
-    util.update_variable(ncfile, 'northward_wind', northward_winds)
-    util.update_variable(ncfile, 'upward_air_velocity', upward_winds)
-    util.update_variable(ncfile, 'wind_speed', all_wind_speed)
-    util.update_variable(ncfile, 'wind_from_direction', all_wdir)
-    util.update_variable(ncfile, 'time', unix_times[::no_angles])
-    util.update_variable(ncfile, 'year', years[::no_angles])
-    util.update_variable(ncfile, 'month', months[::no_angles])
-    util.update_variable(ncfile, 'day', days[::no_angles])
-    util.update_variable(ncfile, 'hour', hours[::no_angles])
-    util.update_variable(ncfile, 'minute', minutes[::no_angles])
-    util.update_variable(ncfile, 'second', seconds[::no_angles])
-    util.update_variable(ncfile, 'day_of_year', doy[::no_angles])
+    valid_limits = {}
+    with lidar_stats.stage('write'):
+        write_mean_winds(ncfile, altitudes, all_threedwinds, all_wind_speed, all_wdir, times, 0, valid_limits, verbose = verbose)
+    lidar_util.set_valid_limits(ncfile, valid_limits)
     
-    ncfile.setncattr('time_coverage_start', dt.datetime.fromtimestamp(min(time_coverage_start_dt), dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S %Z"))
-    ncfile.setncattr('time_coverage_end', dt.datetime.fromtimestamp(max(time_coverage_end_dt), dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S %Z"))
+    ncfile.setncattr('time_coverage_start', dt.datetime.fromtimestamp(time_coverage_start_dt, dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S %Z"))
+    ncfile.setncattr('time_coverage_end', dt.datetime.fromtimestamp(time_coverage_end_dt, dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S %Z"))
     
     util.add_metadata_to_netcdf(ncfile, metadata_file)
                 
@@ -390,13 +537,48 @@ def make_netcdf_mean_winds_profile(lidar_files, metadata_file = None, ncfile_loc
         geobounds = f"{ncfile.variables['latitude'][0]}N, {ncfile.variables['longitude'][0]}E"
         ncfile.setncattr('geospatial_bounds', geobounds)
     
-    ncfile.close()
+    ncfile_path = ncfile.filepath()
+    with lidar_stats.stage('close') as record:
+        ncfile.close()
+        record['ncfile_bytes'] = os.path.getsize(ncfile_path)
     
+    if incremental:
+        lidar_util.save_manifest(manifest_file, ncfile_path, lidar_files, [lidar_util.count_rays(lidar_file, cache_dir)[1] for lidar_file in lidar_files])
+
+
+
+def append_mean_winds_profile(lidar_files, ncfile_path, verbose = False, workers = 1, cache_dir = None, cache_size = lidar_cache.DEFAULT_MAX_SIZE, scans = None):
+    """
+    Add the winds from the scans in lidar_files to the end of the netCDF
+    file made by an earlier incremental run, and update valid_min/valid_max
+    and time_coverage_end.
+    """
+    if len(lidar_files) == 0:
+        if verbose:
+            print('No new scans to add')
+        return
     if verbose:
-        print('Removing empty variables')
-    remove_empty_variables.main(f'{ncfile_location}/ncas-lidar-dop-2_iao_{actual_file_date}_mean-winds-profile_v1.0.nc', verbose = verbose, skip_check = True)
-            
-        
+        print(f'Adding {len(lidar_files)} scans to {ncfile_path}')
+    scans = get_scans(scans, lidar_files, MEAN_WINDS_FIELDS, verbose = verbose, workers = workers, cache_dir = cache_dir, cache_size = cache_size)
+    with lidar_stats.stage('winds'):
+        altitudes, all_threedwinds, all_wind_speed, all_wdir = get_mean_winds(scans)
+    times = lidar_util.get_scan_times(scans['start_times'], scans['end_times'])
+    
+    ncfile = Dataset(ncfile_path, 'a')
+    if not np.array_equal(np.ravel(ncfile.variables['altitude'][:])[:len(altitudes)], altitudes.astype(ncfile.variables['altitude'].dtype)):
+        ncfile.close()
+        msg = "ERROR: Change in altitudes with time"
+        raise ValueError(msg)
+    valid_limits = lidar_util.get_valid_limits(ncfile)
+    with lidar_stats.stage('write'):
+        write_mean_winds(ncfile, altitudes, all_threedwinds, all_wind_speed, all_wdir, times, len(ncfile.dimensions['time']), valid_limits, verbose = verbose)
+    lidar_util.set_valid_limits(ncfile, valid_limits)
+    ncfile.setncattr('time_coverage_end', dt.datetime.fromtimestamp(times[9], dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S %Z"))
+    ncfile.setncattr('last_revised_date', dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"))
+    with lidar_stats.stage('close') as record:
+        ncfile.close()
+        record['ncfile_bytes'] = os.path.getsize(ncfile_path)
+    
     
     
     
@@ -410,15 +592,40 @@ if __name__ == "__main__":
     parser.add_argument('-o','--ncfile-location', type=str, help = 'Path for where to save netCDF file. Default is .', default = '.', dest="ncfile_location")
     parser.add_argument('-p','--products', nargs = '*', help = 'Products of ncas-lidar-dop-2 to make netCDF files for. Options are mean-winds-profile (not yet implemented), aerosol-backscatter-radial-winds, depolarisation-ratio (not yet implemented). One or many can be given (space separated), default is "aerosol-backscatter-radial-winds".', default = ['aerosol-backscatter-radial-winds','mean-winds-profile'])
     parser.add_argument('-t','--tsv-location', type = str, help = "Path to local store of AMF_CVs tsv files (for 'offline' use). Default is None ('online' use).", default = None, dest = 'tsv_location')
+    parser.add_argument('-w','--workers', type = int, help = 'Number of processes to read raw files with. Default is 1 (read in the main process).', default = 1, dest = 'workers')
+    parser.add_argument('--cache-dir', type = str, help = 'Directory to cache parsed raw files in, so they are not parsed again on reruns, e.g. ~/.cache/ncas-lidar-dop-2. Default is None, no cache', default = None, dest = 'cache_dir')
+    parser.add_argument('--cache-size', type = float, help = f'Maximum size of the cache in GB, least recently used files are removed beyond this. Default is {lidar_cache.DEFAULT_MAX_SIZE / 1024**3:g}', default = lidar_cache.DEFAULT_MAX_SIZE / 1024**3, dest = 'cache_size')
+    parser.add_argument('--no-cache', action = 'store_true', help = 'Parse all raw files, without using or adding to the cache, even if --cache-dir is given.', dest = 'no_cache')
+    parser.add_argument('-i','--incremental', action = 'store_true', help = "Only add scans that are new since the last incremental run for the day, e.g. for today's data.", dest = 'incremental')
+    parser.add_argument('-z','--complevel', type = int, help = 'zlib compression level (1-9) for the data variables, 0 for none. Default is netcdf_complevel in the metadata file, or 0.', default = None, dest = 'complevel')
+    parser.add_argument('--no-shuffle', action = 'store_const', const = False, help = 'Compress without the shuffle filter. Default is netcdf_shuffle in the metadata file, or shuffle.', default = None, dest = 'shuffle')
+    parser.add_argument('--chunks', type = str, help = f'Chunk shape of the data variables, for how they are mostly read: {" or ".join(lidar_util.CHUNK_SHAPES)}, or TIMES,GATES. Default is netcdf_chunks in the metadata file, or the netCDF library default.', default = None, dest = 'chunks')
+    parser.add_argument('--pack', nargs = '*', help = f'VARIABLE=SCALE_FACTOR[,ADD_OFFSET] to store a variable as 16 bit integers, for any of {", ".join(lidar_util.PACKED_VARIABLES)}. Also netcdf_pack_<variable> in the metadata file. Default is no packing.', default = [], dest = 'pack')
+    parser.add_argument('--stats-file', type = str, help = 'File to append the time, CPU time, peak memory and bytes read and written of each processing stage and raw file to, as lines of JSON. Default is None (not recorded).', default = None, dest = 'stats_file')
+    parser.add_argument('--profile', type = str, help = 'File to save cProfile stats of the run to, for reading with pstats. Default is None (not profiled).', default = None, dest = 'profile')
     args = parser.parse_args()
-    
-    
-    for prod in args.products:
-        if prod == 'aerosol-backscatter-radial-winds':
-            make_netcdf_aerosol_backscatter_radial_winds(args.input_file, metadata_file = args.metadata, ncfile_location = args.ncfile_location, verbose = args.verbose, local_tsv_file_loc = args.tsv_location)
-        elif prod == 'mean-winds-profile':
-            make_netcdf_mean_winds_profile(args.input_file, metadata_file = args.metadata, ncfile_location = args.ncfile_location, verbose = args.verbose, local_tsv_file_loc = args.tsv_location)
-        elif prod in ['depolarisation-ratio']:
-            print(f'WARNING: {prod} is not yet implemented, continuing with other prodcuts...')
-        else:
-            print(f'WARNING: {prod} is not recognised for this instrument, continuing with other prodcuts...')
+    cache_dir = None if args.no_cache else args.cache_dir
+    cache_size = int(args.cache_size * 1024**3)
+    encoding = {'complevel': args.complevel, 'shuffle': args.shuffle, 'chunks': args.chunks, 'pack': lidar_util.parse_pack(args.pack)}
+    if args.stats_file is not None:
+        lidar_stats.start(args.stats_file)
+    
+    with lidar_stats.profile(args.profile):
+        # read the files once for all the products. Incremental runs only read
+        # the new scans, which is done for each product
+        scans = None
+        fields = sorted(set().union(*[PRODUCT_FIELDS[prod] for prod in args.products if prod in PRODUCT_FIELDS]))
+        if fields and not args.incremental:
+            scans = read_scans(args.input_file, fields, verbose = args.verbose, workers = args.workers, cache_dir = cache_dir, cache_size = cache_size)
+        
+        for prod in args.products:
+            if prod == 'aerosol-backscatter-radial-winds':
+                with lidar_stats.stage('product', product = prod, raw_files = len(args.input_file)):
+                    make_netcdf_aerosol_backscatter_radial_winds(args.input_file, metadata_file = args.metadata, ncfile_location = args.ncfile_location, verbose = args.verbose, local_tsv_file_loc = args.tsv_location, workers = args.workers, cache_dir = cache_dir, cache_size = cache_size, incremental = args.incremental, scans = scans, encoding = encoding)
+            elif prod == 'mean-winds-profile':
+                with lidar_stats.stage('product', product = prod, raw_files = len(args.input_file)):
+                    make_netcdf_mean_winds_profile(args.input_file, metadata_file = args.metadata, ncfile_location = args.ncfile_location, verbose = args.verbose, local_tsv_file_loc = args.tsv_location, workers = args.workers, cache_dir = cache_dir, cache_size = cache_size, incremental = args.incremental, scans = scans, encoding = encoding)
+            elif prod in ['depolarisation-ratio']:
+                print(f'WARNING: {prod} is not yet implemented, continuing with other prodcuts...')
+            else:
+                print(f'WARNING: {prod} is not recognised for this instrument, continuing with other prodcuts...')
@@ -1,6 +1,16 @@
-import parse
+import os
+import mmap
+import tempfile
 import numpy as np
 import datetime as dt
+from itertools import islice
+
+
+# change when readLidarFile output changes, so cached outputs (see lidar_cache) are remade
+READER_VERSION = 2
+
+# arrays readLidarFile can return, see its fields argument
+FIELDS = ['TimeStamp', 'DT', 'AZ', 'EL', 'RG', 'D', 'I', 'B', 'DD', 'DP', 'A']
 
 
 def getStareFileHeader(input_file):
@@ -9,6 +19,8 @@ def getStareFileHeader(input_file):
         m=1
         temp=fid.readline()
         while temp[0:4] != '****':
+            if temp == '':
+                raise ValueError(f"ERROR: End of header not found in {input_file}")
             #linelength=length_(temp)
             tempsplit = temp.split("\t")
             if tempsplit[0] == 'Start time:':
@@ -33,68 +45,101 @@ def getStareFileHeader(input_file):
 
 
 
-def getStareFileData(input_file, headerlines_number=None,gate_number=None):
-    TimeStamp = []
-    raw_data=[]
-    #Pythonised, DW 2015-07-13
-    with open(input_file, 'rt') as fid:
-        formatTime=parse.compile('{:f} {:f} {:f}')
-        formatSpec=parse.compile('{:d} {:f} {:f} {:e}')
-        n=1
-        for _ in range(headerlines_number):
-            next(fid)
-
-        #until end of file
-        for timeline in fid:
-            TimeStamp.append(formatTime.parse(timeline.strip().replace('  ',' ')))
-            scan_data = np.empty([gate_number, 4])
-            for i in range(gate_number):
-                line = formatSpec.parse(next(fid).strip())
-                scan_data[i] = line.fixed[0:4]
-    
-            raw_data.append(scan_data)
-            n=n + 1
-    
-    return TimeStamp,raw_data
+def countRays(input_file, headerlines_number, gate_number):
+    """
+    Number of complete rays in the file, from a count of its lines.
+    """
+    with open(input_file, 'rb') as fid:
+        lines = 0
+        last = b'\n'
+        for chunk in iter(lambda: fid.read(1 << 20), b''):
+            lines += chunk.count(b'\n')
+            last = chunk[-1:]
+    # last line may not end with a newline
+    if last != b'\n':
+        lines += 1
+    return max(lines - headerlines_number, 0) // (gate_number + 1)
 
 
 
-def stareCellToStruct(TimeStamp, raw_data, gate_number):
-    maximum=len(TimeStamp) 
+def getStareFileData(input_file, headerlines_number=None,gate_number=None, dtype=np.float64, chunk_rays=100, fields=None):
+    """
+    Read the data section straight into preallocated, column-oriented arrays,
+    sized from the number of rays in the file. Each ray is a timestamp line
+    followed by gate_number gate lines, so a chunk of rays is tokenised in
+    one go and split into columns with a reshape.
+    D, I and B are stored as dtype (float32 halves their memory), and RG as
+    the integer gate index.
+    fields - which of RG, D, I and B to fill, None for all. The others are
+             returned as None, and never allocated.
+    An incomplete last ray (file still being written) is left out.
+    """
+    maximum = countRays(input_file, headerlines_number, gate_number)
+    gate_columns = ['RG', 'D', 'I', 'B'] if fields is None else [key for key in ['RG', 'D', 'I', 'B'] if key in fields]
     DT=np.empty([maximum,1])
     AZ=np.empty([maximum,1])
     EL=np.empty([maximum,1])
-    RG=np.empty([maximum,gate_number])
-    D=np.empty([maximum,gate_number])
-    I=np.empty([maximum,gate_number])
-    B=np.empty([maximum,gate_number])
-    for i in range(0,maximum):
-        DT[i]=TimeStamp[i][0]
-        AZ[i]=TimeStamp[i][1]
-        EL[i]=TimeStamp[i][2]
-        RG[i,:]=(raw_data[i][:,0])
-        D[i,:]=(raw_data[i][:,1])
-        I[i,:]=(raw_data[i][:,2])
-        B[i,:]=(raw_data[i][:,3])
+    RG=np.empty([maximum,gate_number], dtype=np.int32) if 'RG' in gate_columns else None
+    D=np.empty([maximum,gate_number], dtype=dtype) if 'D' in gate_columns else None
+    I=np.empty([maximum,gate_number], dtype=dtype) if 'I' in gate_columns else None
+    B=np.empty([maximum,gate_number], dtype=dtype) if 'B' in gate_columns else None
+
+    line_fields = None
+    with open(input_file, 'rt') as fid:
+        for _ in range(headerlines_number):
+            next(fid)
+        for start in range(0, maximum, chunk_rays):
+            stop = min(start + chunk_rays, maximum)
+            block = ''.join(islice(fid, (stop - start) * (gate_number + 1)))
+            times, gates, line_fields = parseRays(block, stop - start, gate_number, line_fields)
+            DT[start:stop,0] = times[:,0]
+            AZ[start:stop,0] = times[:,1]
+            EL[start:stop,0] = times[:,2]
+            for column, array in enumerate([RG, D, I, B]):
+                if array is not None:
+                    array[start:stop] = gates[:,:,column]
+
     return DT, AZ, EL, RG, D, I, B, maximum
 
 
 
-def decTimetoDecDate(datadate, maximum, gate_number, DT):
+def parseRays(block, rays, gate_number, fields=None):
+    """
+    Tokenise the text of whole rays in one go. fields is the number of
+    values on the timestamp and gate lines, worked out from the first ray
+    if not given (newer firmware adds pitch and roll to the timestamp line).
+    Returns the (rays, timestamp fields) and (rays, gate_number, gate fields)
+    values, and fields.
+    """
+    if fields is None:
+        lines = block.split('\n', 2)
+        fields = (len(lines[0].split()), len(lines[1].split()))
+    time_fields, gate_fields = fields
+    values = np.fromstring(block, sep=' ').reshape(rays, time_fields + gate_fields * gate_number)
+    return values[:,:time_fields], values[:,time_fields:].reshape(rays, gate_number, gate_fields), fields
+
+
+
+def decTimetoDecDate(datadate, maximum, gate_number, DT, full_DD=False):
+    """
+    Times of each ray from the decimal hours in DT. Rays after the time goes
+    back past midnight are put on the following day.
+    Returns DD (matlab datenum, the same for every gate of a ray, so by
+    default a read-only broadcast view rather than a full rays x gates
+    array) and DP (datetime64[us]).
+    """
     dt_init = dt.datetime.strptime(datadate, '%Y%m%d')
     Decimal_Year = datetime2matlabdn(dt_init)
-    DD=np.empty([maximum,gate_number])
-    DD.fill(np.nan)
-    DP=np.empty(maximum, dtype=dt.datetime)#, dtype='datetime64[s]')
-    #DP.fill(np.nan)
-    hours_to_add = 0
-    for i in range(0,maximum):
-        if i > 0 and (DT[i,0] < DT[i-1,0]) and (DT[i,0] < 1):
-            hours_to_add = 24
-        #DP[i] = np.datetime64((dt_init + dt.timedelta(hours=DT[i,0])).strftime('%Y-%m-%dT%H:%M:%SZ'))
-        DP[i] = (dt_init + dt.timedelta(hours=(DT[i,0]+hours_to_add)))#.strftime('%Y-%m-%dT%H:%M:%SZ')
-        for m in range(0,gate_number):
-            DD[i,m] = Decimal_Year + ((DT[i]+hours_to_add) / 24)
+    hours = DT[:,0]
+    rollover = np.concatenate(([False], (np.diff(hours) < 0) & (hours[1:] < 1)))
+    hours = hours + 24 * (np.cumsum(rollover) > 0)
+    DD = np.broadcast_to((Decimal_Year + (hours / 24))[:,np.newaxis], (maximum, gate_number))
+    if full_DD:
+        DD = DD.copy()
+    # whole hours and the fraction in microseconds, rounded as dt.timedelta(hours=...) does
+    whole_hours = np.trunc(hours)
+    microseconds = whole_hours.astype(np.int64) * 3600000000 + np.round((hours - whole_hours) * 3600000000.0).astype(np.int64)
+    DP = np.datetime64(dt_init, 'us') + microseconds.astype('timedelta64[us]')
     return DD, DP
 
 
@@ -112,22 +157,196 @@ def gateRangeToAlt(RG, gate_length):
 
 
 
-def readLidarFile(input_file):
+def readLidarFile(input_file, dtype=np.float64, fields=None):
+    """
+    fields - list of the arrays wanted (see FIELDS), None for all of them.
+             Only what they need is worked out, e.g. ['D', 'AZ', 'EL', 'DP']
+             doesn't store I, B or RG. Header values are always returned.
+    TimeStamp is the decimal time, azimuth and elevation of each ray, as
+    the rows of a (rays, 3) array rather than the original parse results.
+    """
+    wanted = set(FIELDS if fields is None else fields)
+    if not wanted <= set(FIELDS):
+        raise ValueError(f"Unknown fields {wanted - set(FIELDS)}, can be any of {FIELDS}")
     num_headerlines,gate_number,gate_length,datadate,pulses_per_ray,rays_per_point,focus_range,resolution = getStareFileHeader(input_file)
-    TimeStamp, raw_data = getStareFileData(input_file, num_headerlines, gate_number)
+    DT, AZ, EL, RG, D, I, B, maximum = getStareFileData(input_file, num_headerlines, gate_number, dtype=dtype, fields=wanted | ({'RG'} if 'A' in wanted else set()))
     #print(num_headerlines)
     #print(gate_number)
     #print(gate_length)
     #print(datadate)
-    #print(TimeStamp)
-    #print(raw_data[0].shape)
-    if len(raw_data) > 0:
-        DT, AZ, EL, RG, D, I, B, maximum = stareCellToStruct(TimeStamp, raw_data, gate_number)
-        DD, DP = decTimetoDecDate(datadate, maximum, gate_number, DT)
-        A = gateRangeToAlt(RG, gate_length)
+    TimeStamp = np.hstack([DT, AZ, EL]) if 'TimeStamp' in wanted else None
+    DD = DP = A = None
+    if maximum > 0:
+        if wanted & {'DD', 'DP'}:
+            DD, DP = decTimetoDecDate(datadate, maximum, gate_number, DT)
+        if 'A' in wanted:
+            A = gateRangeToAlt(RG, gate_length)
         #print(A)
-    return {'num_headerlines': num_headerlines, 'gate_number': gate_number, 'gate_length': gate_length, 'datadate': datadate, 'TimeStamp': TimeStamp, 'DT': DT, 'AZ': AZ, 'EL': EL, 'RG': RG, 'D': D, 'I': I, 'B': B, 'maximum': maximum, 'DD': DD, 'DP': DP, 'A': A, 'pulses_per_ray': pulses_per_ray, 'rays_per_point': rays_per_point, 'focus_range': focus_range, 'resolution': resolution}
-    
+    data = {'num_headerlines': num_headerlines, 'gate_number': gate_number, 'gate_length': gate_length, 'datadate': datadate, 'TimeStamp': TimeStamp, 'DT': DT, 'AZ': AZ, 'EL': EL, 'RG': RG, 'D': D, 'I': I, 'B': B, 'maximum': maximum, 'DD': DD, 'DP': DP, 'A': A, 'pulses_per_ray': pulses_per_ray, 'rays_per_point': rays_per_point, 'focus_range': focus_range, 'resolution': resolution}
+    return {key: value for key, value in data.items() if key in wanted or key not in FIELDS}
+
+
+
+class LidarFile:
+    """
+    Random access to the rays of an .hpl file, without parsing the rest of
+    it. The file is memory-mapped, and an index of the byte offset of each
+    ray's timestamp line (and each ray's time) is built with one pass over
+    the file, so read_rays and read_time_range only touch the bytes of the
+    rays asked for.
+
+    input_file - .hpl file
+    index_file - where to save the index, e.g. f'{input_file}.idx.npz', so
+                 it isn't built again. An index for a different version of
+                 the file is built again. None to not save it.
+    dtype - dtype of D, I and B, as in readLidarFile
+
+    Use as a context manager, or call close, to release the memory map.
+    """
+    def __init__(self, input_file, index_file=None, dtype=np.float64):
+        self.input_file = input_file
+        self.dtype = dtype
+        self.num_headerlines,self.gate_number,self.gate_length,self.datadate,self.pulses_per_ray,self.rays_per_point,self.focus_range,self.resolution = getStareFileHeader(input_file)
+        with open(input_file, 'rb') as fid:
+            self._mm = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+        stat = os.stat(input_file)
+        self._state = np.array([stat.st_size, stat.st_mtime_ns, READER_VERSION], dtype=np.int64)
+        if index_file is None or not self._loadIndex(index_file):
+            self._buildIndex()
+            if index_file is not None:
+                self._saveIndex(index_file)
+        self.maximum = len(self.offsets) - 1
+        self.fields = None
+        if self.maximum > 0:
+            self.DD, self.DP = decTimetoDecDate(self.datadate, self.maximum, 1, self.DT)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._mm.close()
+
+    def _buildIndex(self, chunk_size=1 << 24):
+        """
+        offsets - byte offset of the start of each complete ray, and of the
+                  end of the last one
+        DT, AZ, EL - decimal hours, azimuth and elevation of each ray, as
+                     from getStareFileData
+        """
+        ray_lines = self.gate_number + 1
+        size = len(self._mm)
+        starts = []
+        lines = 0
+        for chunk_start in range(0, size, chunk_size):
+            chunk = np.frombuffer(self._mm, dtype=np.uint8, count=min(chunk_size, size - chunk_start), offset=chunk_start)
+            newlines = np.flatnonzero(chunk == ord('\n'))
+            # line after each newline, rays start on lines num_headerlines + k * ray_lines
+            next_lines = lines + 1 + np.arange(len(newlines))
+            is_start = (next_lines >= self.num_headerlines) & ((next_lines - self.num_headerlines) % ray_lines == 0)
+            starts.append(chunk_start + newlines[is_start] + 1)
+            lines += len(newlines)
+        # last line may not end with a newline
+        if size > 0 and self._mm[size-1:size] != b'\n':
+            lines += 1
+        maximum = max(lines - self.num_headerlines, 0) // ray_lines
+        offsets = np.concatenate(starts + [np.array([size])])[:maximum + 1]
+        if len(offsets) < maximum + 1:
+            offsets = np.append(offsets, size)
+        self.offsets = offsets.astype(np.int64)
+        time_lines = '\n'.join(self._mm[offset:self._mm.find(b'\n', offset)].decode() for offset in self.offsets[:-1])
+        times = np.fromstring(time_lines, sep=' ').reshape(maximum, -1) if maximum > 0 else np.empty([0,3])
+        self.DT = times[:,:1]
+        self.AZ = times[:,1:2]
+        self.EL = times[:,2:3]
+
+    def _loadIndex(self, index_file):
+        """
+        Load the index saved by _saveIndex, True if it is for this version of
+        the file.
+        """
+        try:
+            with np.load(index_file, allow_pickle=False) as index:
+                if not np.array_equal(index['state'], self._state):
+                    return False
+                self.offsets = index['offsets']
+                self.DT = index['DT']
+                self.AZ = index['AZ']
+                self.EL = index['EL']
+        except (OSError, KeyError, ValueError, EOFError):
+            return False
+        return True
+
+    def _saveIndex(self, index_file):
+        """
+        Written to a temporary file first, so a partly written index is never
+        loaded.
+        """
+        fid, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_file)), suffix='.tmp')
+        try:
+            with os.fdopen(fid, 'wb') as f:
+                np.savez(f, state=self._state, offsets=self.offsets, DT=self.DT, AZ=self.AZ, EL=self.EL)
+            os.replace(tmp_filename, index_file)
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+
+    def read_rays(self, start, stop):
+        """
+        readLidarFile dict for rays start to stop (as in a slice, so
+        negative values count from the end), with 'maximum' the number of
+        rays read. Times are worked out with the whole file, so rays after
+        midnight are still on the following day.
+        """
+        start, stop, _ = slice(start, stop).indices(self.maximum)
+        stop = max(start, stop)
+        rays = stop - start
+        DT = self.DT[start:stop]
+        if rays > 0:
+            block = self._mm[self.offsets[start]:self.offsets[stop]].decode()
+            times, gates, self.fields = parseRays(block, rays, self.gate_number, self.fields)
+            AZ = times[:,1:2].copy()
+            EL = times[:,2:3].copy()
+            RG = gates[:,:,0].astype(np.int32)
+            D = gates[:,:,1].astype(self.dtype)
+            I = gates[:,:,2].astype(self.dtype)
+            B = gates[:,:,3].astype(self.dtype)
+            DD = np.broadcast_to(self.DD[start:stop], (rays, self.gate_number))
+            DP = self.DP[start:stop]
+        else:
+            AZ = np.empty([0,1])
+            EL = np.empty([0,1])
+            RG = np.empty([0,self.gate_number], dtype=np.int32)
+            D = np.empty([0,self.gate_number], dtype=self.dtype)
+            I = np.empty([0,self.gate_number], dtype=self.dtype)
+            B = np.empty([0,self.gate_number], dtype=self.dtype)
+            DD = np.empty([0,self.gate_number])
+            DP = np.empty(0, dtype='datetime64[us]')
+        A = gateRangeToAlt(RG, self.gate_length)
+        TimeStamp = np.hstack([DT, AZ, EL])
+        return {'num_headerlines': self.num_headerlines, 'gate_number': self.gate_number, 'gate_length': self.gate_length, 'datadate': self.datadate, 'TimeStamp': TimeStamp, 'DT': DT, 'AZ': AZ, 'EL': EL, 'RG': RG, 'D': D, 'I': I, 'B': B, 'maximum': rays, 'DD': DD, 'DP': DP, 'A': A, 'pulses_per_ray': self.pulses_per_ray, 'rays_per_point': self.rays_per_point, 'focus_range': self.focus_range, 'resolution': self.resolution}
+
+    def ray_range(self, t0, t1):
+        """
+        start and stop of the rays with times from t0 up to but not
+        including t1 (anything np.datetime64 takes, e.g. datetime or
+        '2023-06-15T12:00'). None for either means no limit.
+        """
+        if self.maximum == 0:
+            return 0, 0
+        start = 0 if t0 is None else int(np.searchsorted(self.DP, np.datetime64(t0, 'us'), side='left'))
+        stop = self.maximum if t1 is None else int(np.searchsorted(self.DP, np.datetime64(t1, 'us'), side='left'))
+        return start, max(start, stop)
+
+    def read_time_range(self, t0, t1):
+        """
+        read_rays for the rays with times from t0 up to but not including t1,
+        see ray_range.
+        """
+        return self.read_rays(*self.ray_range(t0, t1))
+
 
 if __name__ == "__main__":
     import sys
@@ -1,7 +1,8 @@
 #!/bin/bash
 
 #
-# ./make_netcdf.sh YYYYmmdd
+# ./make_netcdf.sh YYYYmmdd [conda_env] [incremental]
+# incremental - give as 'incremental' to only add files new since the last run
 #
 
 SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
@@ -17,6 +18,12 @@ metadata_file=${SCRIPT_DIR}/../metadata.csv
 
 datadate=$1  # YYYYmmdd
 conda_env=${2:-netcdf}
+if [ "$3" == "incremental" ]
+then
+  incremental=-i
+else
+  incremental=
+fi
 
 conda activate ${conda_env}
 
@@ -29,8 +36,11 @@ no_stare_files=$(ls ${datapath}/${year}/${year}${month}/${datadate}/Stare* | wc
 wp_files=$(ls ${datapath}/${year}/${year}${month}/${datadate}/Wind_Profile*)
 no_wp_files=$(ls ${datapath}/${year}/${year}${month}/${datadate}/Wind_Profile* | wc -l)
 
-python ${SCRIPT_DIR}/../process_lidar_stare.py ${stare_files} -m ${metadata_file} -o ${netcdf_path} -v
-python ${SCRIPT_DIR}/../process_lidar_wind_profile.py ${wp_files} -m ${metadata_file} -o ${netcdf_path} -v
+# time and memory of each processing stage, one JSON line each, added to by every run for the day
+stats_file=${logfilepath}/${year}${month}${day}_stats.jsonl
+
+python ${SCRIPT_DIR}/../process_lidar_stare.py ${stare_files} -m ${metadata_file} -o ${netcdf_path} -v ${incremental} --stats-file ${stats_file}
+python ${SCRIPT_DIR}/../process_lidar_wind_profile.py ${wp_files} -m ${metadata_file} -o ${netcdf_path} -v ${incremental} --stats-file ${stats_file}
 
 
 if [ -f ${netcdf_path}/ncas-lidar-dop-2_iao_${year}${month}${day}_aerosol-backscatter-radial-winds_stare_*.nc ]
@@ -14,4 +14,5 @@ day=$(date +"%d")
 
 SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
 
-${SCRIPT_DIR}/make_netcdf.sh ${year}${month}${day} ${conda_env}
+# today's files are still arriving, so only add new ones to the existing netCDF files
+${SCRIPT_DIR}/make_netcdf.sh ${year}${month}${day} ${conda_env} incremental
@@ -0,0 +1,72 @@
+"""
+A cut-down copy of the AMF_CVs tsv files, with just what create_netcdf needs
+to make the ncas-lidar-dop-2 aerosol-backscatter-radial-winds and
+mean-winds-profile files, so the writers can be tested without a network
+connection. Each product has a variable the writers don't fill, which
+remove_empty_variables takes out of the original files.
+"""
+import os
+
+
+ATTRIBUTE_COLUMNS = ['Name', 'Description', 'Example', 'Fixed Value', 'Compliance checking rules', 'Convention Provenance']
+INSTRUMENT_COLUMNS = ['New Instrument Name', 'Descriptor', 'Data Product(s)', 'Manufacturer', 'Model No.', 'Serial Number', 'Mobile/Fixed (loc)']
+
+
+def write_tsv(filename, columns, rows):
+    os.makedirs(os.path.dirname(filename), exist_ok = True)
+    with open(filename, 'w') as f:
+        f.write('\t'.join(columns) + '\n')
+        for row in rows:
+            f.write('\t'.join(row) + '\n')
+
+
+def variable(name, datatype, dimensions, units):
+    rows = [[name, '', ''], ['', 'type', datatype], ['', 'dimension', dimensions], ['', 'units', units], ['', 'long_name', name.replace('_', ' ')]]
+    if datatype.startswith('float'):
+        rows += [['', '_FillValue', '-1.00E+20'], ['', 'valid_min', '<derived from file>'], ['', 'valid_max', '<derived from file>']]
+    return rows
+
+
+def attributes(names):
+    return [[name, name.replace('_', ' '), '', '', 'String: valid', ''] for name in names]
+
+
+def write_cvs(tsv_location):
+    """
+    Write the tsv files into tsv_location, to use as the local tsv files
+    location (-t) of the processing scripts.
+    """
+    global_attributes = attributes(['source', 'instrument_manufacturer', 'instrument_model', 'instrument_serial_number', 'institution', 'platform', 'history', 'last_revised_date', 'deployment_mode', 'title', 'time_coverage_start', 'time_coverage_end', 'geospatial_bounds', 'creator_name'])
+    global_attributes.insert(0, ['Conventions', 'Conventions', '', 'CF-1.6, NCAS-AMF-2.0.0', 'Exact match: CF-1.6, NCAS-AMF-2.0.0', ''])
+    global_attributes.append(['amf_vocabularies_release', 'release', 'https://github.com/ncasuk/AMF_CVs/releases/tag/v2.0.0', '', 'String: valid', ''])
+    write_tsv(f'{tsv_location}/_common/global-attributes.tsv', ATTRIBUTE_COLUMNS, global_attributes)
+    write_tsv(f'{tsv_location}/_common/dimensions-land.tsv', ['Name', 'Length', 'units'], [['time', '<n>', '1'], ['latitude', '1', '1'], ['longitude', '1', '1']])
+    common = variable('time', 'float64', 'time', 'seconds since 1970-01-01 00:00:00')
+    for name in ['year', 'month', 'day', 'hour', 'minute']:
+        common += variable(name, 'int32', 'time', '1')
+    common += variable('second', 'float32', 'time', '1') + variable('day_of_year', 'float32', 'time', '1')
+    common += variable('latitude', 'float32', 'latitude', 'degree_north') + variable('longitude', 'float32', 'longitude', 'degree_east')
+    write_tsv(f'{tsv_location}/_common/variables-land.tsv', ['Variable', 'Attribute', 'Value'], common)
+
+    write_tsv(f'{tsv_location}/_vocabularies/ncas-instrument-name-and-descriptors.tsv', INSTRUMENT_COLUMNS,
+              [['ncas-lidar-dop-2', 'NCAS Doppler Aerosol Lidar unit 2', 'aerosol-backscatter-radial-winds | mean-winds-profile', 'Halo Photonics', 'StreamLine', '118', 'fixed - iao']])
+    write_tsv(f'{tsv_location}/_vocabularies/community-instrument-name-and-descriptors.tsv', INSTRUMENT_COLUMNS, [])
+    write_tsv(f'{tsv_location}/_vocabularies/data-products.tsv', ['Data Product'], [['aerosol-backscatter-radial-winds'], ['mean-winds-profile']])
+
+    product = f'{tsv_location}/aerosol-backscatter-radial-winds'
+    write_tsv(f'{product}/dimensions-specific.tsv', ['Name', 'Length', 'units'], [['index_of_range', '<n>', '1'], ['index_of_angle', '<n>', '1']])
+    variables = []
+    for name, units in [('range', 'm'), ('radial_velocity_of_scatterers_away_from_instrument', 'm s-1'), ('attenuated_aerosol_backscatter_coefficient', 'm-1 sr-1'), ('signal_to_noise_ratio_plus_1', '1')]:
+        variables += variable(name, 'float32', 'time, index_of_range, index_of_angle', units)
+    for name in ['sensor_azimuth_angle_instrument_frame', 'sensor_view_angle_instrument_frame', 'sensor_azimuth_angle_earth_frame', 'sensor_view_angle_earth_frame']:
+        variables += variable(name, 'float32', 'time, index_of_angle', 'degree')
+    write_tsv(f'{product}/variables-specific.tsv', ['Variable', 'Attribute', 'Value'], variables)
+    write_tsv(f'{product}/global-attributes-specific.tsv', ATTRIBUTE_COLUMNS, attributes(['pulses_per_ray', 'rays_per_point', 'focus', 'velocity_resolution', 'number_of_gates', 'gate_length']))
+
+    product = f'{tsv_location}/mean-winds-profile'
+    write_tsv(f'{product}/dimensions-specific.tsv', ['Name', 'Length', 'units'], [['altitude', '<n>', 'm']])
+    variables = variable('altitude', 'float32', 'time, altitude', 'm')
+    for name in ['eastward_wind', 'northward_wind', 'upward_air_velocity', 'wind_speed', 'wind_from_direction', 'wind_speed_of_gust']:
+        variables += variable(name, 'float32', 'time, altitude', 'm s-1')
+    write_tsv(f'{product}/variables-specific.tsv', ['Variable', 'Attribute', 'Value'], variables)
+    write_tsv(f'{product}/global-attributes-specific.tsv', ATTRIBUTE_COLUMNS, attributes(['comment']))
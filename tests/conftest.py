@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the processing modules are flat files in the repository root, and the
+# reference copies of the original code are in benchmarks
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+sys.path.insert(0, ROOT)
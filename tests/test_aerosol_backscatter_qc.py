@@ -0,0 +1,177 @@
+"""
+aerosol_backscatter_qc.make_flags against the original per-ray QC in
+benchmarks/legacy_aerosol_backscatter_qc.py.
+"""
+import numpy as np
+import pytest
+
+import aerosol_backscatter_qc
+import legacy_aerosol_backscatter_qc
+import synthetic_hpl
+
+
+def qc_inputs(doppler, intensity, backscatter, masked = None, gate_length = 30.0, angles = 2):
+    """
+    (time, gate, angle) masked arrays laid out as the processing scripts
+    make them, with -9999 under the mask. Only the first angle has data.
+    masked - (time, gate) gates to mask at the first angle as well
+    """
+    rays, gates = backscatter.shape
+    ranges = np.broadcast_to((np.arange(gates) + 0.5) * gate_length, (rays, gates))
+    no_mask = np.zeros((rays, gates), dtype = bool)
+    if masked is None:
+        masked = no_mask
+    arrays = []
+    for values, value_mask in [(ranges, no_mask), (doppler, masked), (intensity, masked), (backscatter, masked)]:
+        arr = np.ma.masked_all((rays, gates, angles))
+        arr.data[:] = -9999
+        arr[:,:,0] = np.ma.masked_array(np.where(value_mask, -9999, values), mask = value_mask)
+        arrays.append(arr)
+    return arrays
+
+
+def assert_flags_match(doppler, intensity, backscatter, masked = None, chunk_size = 5000):
+    ranges, velocity, intensity, backscatter = qc_inputs(doppler, intensity, backscatter, masked)
+    new_flags = aerosol_backscatter_qc.make_flags(ranges[0], velocity, intensity, backscatter, chunk_size = chunk_size)
+    with np.errstate(all = 'ignore'):
+        old_flags = legacy_aerosol_backscatter_qc.make_flags(ranges, velocity, intensity, backscatter)
+    assert np.array_equal(np.asarray(new_flags), np.asarray(old_flags))
+    return np.asarray(new_flags)
+
+
+def fitted_rays(backscatter):
+    """
+    Rays the original QC fits a quadratic to (part 2 of flag3).
+    """
+    gates = backscatter.shape[1]
+    rays = []
+    for i, ray in enumerate(backscatter):
+        negative = np.flatnonzero(ray < 0)
+        if np.mean(ray[-21:-1]) > 0 and len(negative) > 0 and (gates - 2) - negative[-1] > 2:
+            rays.append(i)
+    return rays
+
+
+def ray_data(rays, gates, seed = 0):
+    return synthetic_hpl.make_ray_data(np.random.default_rng(seed), rays, gates)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_flags_match_original(seed):
+    doppler, intensity, backscatter = ray_data(1500, 60, seed)
+    assert fitted_rays(backscatter)
+    assert_flags_match(doppler, intensity, backscatter)
+
+
+@pytest.mark.parametrize('rays', [49, 50, 51, 101])
+def test_chunk_boundary(rays):
+    doppler, intensity, backscatter = ray_data(rays, 60)
+    flags = assert_flags_match(doppler, intensity, backscatter, chunk_size = 50)
+    assert np.array_equal(flags, assert_flags_match(doppler, intensity, backscatter, chunk_size = rays))
+
+
+def test_single_ray():
+    doppler, intensity, backscatter = ray_data(200, 60)
+    ray = fitted_rays(backscatter)[0]
+    assert_flags_match(doppler[ray:ray+1], intensity[ray:ray+1], backscatter[ray:ray+1])
+
+
+def test_masked_rays_and_gates():
+    doppler, intensity, backscatter = ray_data(500, 60)
+    rng = np.random.default_rng(3)
+    masked = rng.random(backscatter.shape) < 0.05
+    masked[[0, 5, 6, 7, -1]] = True
+    # masked gates inside the fits, which the original fit as 1.0
+    assert any(masked[ray].any() for ray in fitted_rays(backscatter))
+    assert_flags_match(doppler, intensity, backscatter, masked)
+
+
+def test_rays_without_negative_gate():
+    """
+    The original QC fails on rays with a positive tail and no negative
+    gate, which are now skipped. With the last gate made negative (which
+    is too near the end to fit from) the original gives the flags of the
+    other gates.
+    """
+    doppler, intensity, backscatter = ray_data(300, 60)
+    backscatter = np.abs(backscatter)
+    ranges, velocity, intensity_in, backscatter_in = qc_inputs(doppler, intensity, backscatter)
+    new_flags = aerosol_backscatter_qc.make_flags(ranges[0], velocity, intensity_in, backscatter_in)
+    last_negative = backscatter.copy()
+    last_negative[:,-1] = -1e-7
+    ranges, velocity, intensity_in, backscatter_in = qc_inputs(doppler, intensity, last_negative)
+    with np.errstate(all = 'ignore'):
+        old_flags = legacy_aerosol_backscatter_qc.make_flags(ranges, velocity, intensity_in, backscatter_in)
+    assert np.array_equal(new_flags[:,:-1], old_flags[:,:-1])
+
+
+def test_shortest_fits():
+    doppler, intensity, backscatter = ray_data(300, 60)
+    # 3 gates from the last negative one to the end of the fit
+    backscatter = np.abs(backscatter)
+    backscatter[:,-5] = -1e-7
+    assert len(fitted_rays(backscatter)) == 300
+    assert_flags_match(doppler, intensity, backscatter)
+
+
+def test_long_fits():
+    doppler, intensity, backscatter = ray_data(40, 1000)
+    backscatter = np.abs(backscatter)
+    backscatter[:,3] = -1e-7
+    assert len(fitted_rays(backscatter)) == 40
+    assert_flags_match(doppler, intensity, backscatter)
+
+
+def test_backscatter_at_fitted_threshold():
+    """
+    A fit that extrapolates to about zero from values of about +-5, so the
+    fit rounds to ~1e-16 of those values, with backscatter set to the
+    original fit's threshold and the values either side of it.
+    """
+    gates = 30
+    target = 1e-5
+    backscatter = np.full(gates, 5e-5)
+    backscatter[25] = -1e-6
+    backscatter[26] = 1e-5
+    # the fit from gate 25 (log10 of a negative value, filled with 1.0) is
+    # 1 - 3 * -5 + 3 * y at gate 28, which is target
+    backscatter[27] = 10 ** ((target - 16) / 3)
+    with np.errstate(all = 'ignore'):
+        log_backscatter = np.log10(np.ma.masked_array(backscatter[25:28]))
+    threshold = legacy_aerosol_backscatter_qc.P.polyval(28, legacy_aerosol_backscatter_qc.P.polyfit(range(25, 28), log_backscatter, 2)) * 1.2
+    steps = np.arange(-200, 201)
+    backscatter = np.tile(backscatter, (len(steps), 1))
+    backscatter[:,28] = threshold * (1 + steps * 1e-12)
+    flags = assert_flags_match(np.zeros(backscatter.shape), np.full(backscatter.shape, 1.2), backscatter)
+    # flagged up to the threshold, and not from it on
+    assert np.array_equal(flags[:,28,0] == 3, steps < 0)
+
+
+def test_thresholds_match_original():
+    """
+    Thresholds other than the defaults, against the original flag2 to flag5
+    called with the same thresholds.
+    """
+    doppler, intensity, backscatter = ray_data(300, 60)
+    ranges, velocity, intensity, backscatter = qc_inputs(doppler, intensity, backscatter)
+    new_flags = aerosol_backscatter_qc.make_flags(ranges[0], velocity, intensity, backscatter, range_threshold = 900, min_backscatter = 1e-6, max_backscatter = 5e-6, min_velocity = -10, max_velocity = 12, min_shear = -2, max_shear = 3)
+    old_flags = np.ones_like(ranges)
+    with np.errstate(all = 'ignore'):
+        for i in range(old_flags.shape[2]):
+            old_flags[:,:,i] = legacy_aerosol_backscatter_qc.flag2(ranges[:,:,i], old_flags[:,:,i], threshold = 900)
+            old_flags[:,:,i] = legacy_aerosol_backscatter_qc.flag3(intensity[:,:,i], backscatter[:,:,i], old_flags[:,:,i], min_backscatter = 1e-6, max_backscatter = 5e-6)
+            old_flags[:,:,i] = legacy_aerosol_backscatter_qc.flag4(velocity[:,:,i], old_flags[:,:,i], min_thresh = -10, max_thresh = 12)
+            old_flags[:,:,i] = legacy_aerosol_backscatter_qc.flag5(velocity[:,:,i], old_flags[:,:,i], min_thresh = -2, max_thresh = 3)
+    assert np.array_equal(new_flags, np.asarray(old_flags))
+    # and the thresholds change the flags
+    assert not np.array_equal(new_flags, aerosol_backscatter_qc.make_flags(ranges[0], velocity, intensity, backscatter))
+
+
+@pytest.mark.parametrize('name', ['flag2', 'flag4', 'flag5'])
+def test_single_flags_match_original(name):
+    doppler, intensity, backscatter = ray_data(300, 60)
+    ranges, velocity, _, _ = qc_inputs(doppler, intensity, backscatter)
+    values = ranges[:,:,0] if name == 'flag2' else velocity[:,:,0]
+    new_flags = getattr(aerosol_backscatter_qc, name)(ranges[0,:,0] if name == 'flag2' else values, np.ones(values.shape))
+    old_flags = getattr(legacy_aerosol_backscatter_qc, name)(values, np.ones(values.shape))
+    assert np.array_equal(new_flags, np.asarray(old_flags))
@@ -0,0 +1,69 @@
+"""
+lidar_util.get_times against ncas_amof_netcdf_template.util.get_times.
+"""
+import datetime as dt
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+import lidar_util
+from ncas_amof_netcdf_template import util
+
+
+START = np.datetime64('2023-06-15T00:00:00', 'us')
+
+
+def assert_times_match(dt_times):
+    expected = util.get_times(dt_times.astype('datetime64[us]').astype(dt.datetime).tolist())
+    actual = lidar_util.get_times(dt_times)
+    for name, old, new in zip(['unix_times', 'doy', 'years', 'months', 'days', 'hours', 'minutes', 'seconds'], expected, actual):
+        assert np.array_equal(np.asarray(old), new), name
+        assert np.asarray(old).dtype == new.dtype or name in ['unix_times', 'doy'], name
+    assert expected[8:10] == tuple(actual[8:10]), 'time_coverage'
+    assert expected[10] == actual[10], 'file_date'
+
+
+def test_microsecond_digits():
+    rng = np.random.default_rng(0)
+    # microseconds with 1 to 6 digits, and none
+    fractions = np.concatenate([[0], 10 ** np.arange(6), 10 ** np.arange(1, 7) - 1, rng.integers(0, 1000000, 10000)])
+    times = START + np.sort(rng.integers(0, 86400, len(fractions))) * 1000000 + fractions
+    assert_times_match(np.sort(times))
+
+
+@pytest.mark.parametrize('length', [200 * 86400, 10 * 86400, 86400, 3600, 60, 1])
+def test_file_date_spans(length):
+    """
+    Spans of times within a year, month, day, hour, minute and second.
+    """
+    rng = np.random.default_rng(length)
+    assert_times_match(START + np.sort(rng.integers(0, length * 1000000, 1000)))
+
+
+@pytest.mark.parametrize('microseconds', [[5000, 5000], [5000, 500000]])
+def test_file_date_same_second(microseconds):
+    """
+    The same time, and times whose seconds only differ in their fraction.
+    """
+    assert_times_match(START + np.array(microseconds))
+
+
+@pytest.fixture
+def qc_ncfile():
+    ncfile = Dataset('qc.nc', 'w', diskless = True)
+    ncfile.createDimension('time', 6)
+    qc_flag = ncfile.createVariable('qc_flag_backscatter', 'b', ('time',), fill_value = -127)
+    qc_flag.flag_values = np.array([0, 1, 2, 3], dtype = 'b')
+    yield ncfile
+    ncfile.close()
+
+
+def test_update_variable_slice_qc_flags(qc_ncfile, capsys):
+    lidar_util.update_variable_slice(qc_ncfile, 'qc_flag_backscatter', np.ma.masked_array([1, 3, 9], mask = [0, 0, 1]), 0, 3, {})
+    with pytest.raises(ValueError):
+        lidar_util.update_variable_slice(qc_ncfile, 'qc_flag_backscatter', np.array([1, 4, 2]), 3, 6, {})
+    # nothing is written after the check fails
+    assert qc_ncfile['qc_flag_backscatter'][3:].mask.all()
+    lidar_util.update_variable_slice(qc_ncfile, 'qc_flag_backscatter', np.array([1, 4, 2]), 3, 6, {}, qc_data_error = False)
+    assert '[WARN]: Invalid data being added to QC variable' in capsys.readouterr().out
+    assert qc_ncfile['qc_flag_backscatter'][:].tolist() == [1, 3, None, 1, 4, 2]
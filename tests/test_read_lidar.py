@@ -0,0 +1,102 @@
+"""
+read_lidar.readLidarFile, read_lidar.LidarFile and the cache against the
+original line-by-line reader in benchmarks/legacy_read_lidar.py.
+"""
+import numpy as np
+import pytest
+
+import read_lidar
+import lidar_cache
+import synthetic_hpl
+
+# the original reader parses with the parse module
+legacy_read_lidar = pytest.importorskip('legacy_read_lidar')
+
+
+def assert_outputs_match(new, old, fields = None):
+    """
+    Every key of the readLidarFile dicts is the same. Arrays are compared
+    by value, so e.g. an integer RG matches the original float RG,
+    datetime64 DP matches the original datetimes, and the TimeStamp array
+    matches the values of the original parse results. If new was read with
+    only some fields, just those are compared.
+    """
+    if fields is not None:
+        old = {key: value for key, value in old.items() if key in fields or key not in read_lidar.FIELDS}
+    assert new.keys() == old.keys()
+    for key in new:
+        if key == 'TimeStamp':
+            assert np.array_equal(new[key], [timestamp.fixed for timestamp in old[key]]), key
+        elif key == 'DP':
+            assert np.array_equal(new[key], old[key].astype('datetime64[us]')), key
+        elif isinstance(old[key], np.ndarray):
+            assert np.array_equal(new[key], old[key]), key
+        else:
+            assert new[key] == old[key], key
+
+
+@pytest.fixture(scope = 'module')
+def stare_file(tmp_path_factory):
+    # the last rays are just past midnight
+    lidar_file = str(tmp_path_factory.mktemp('raw') / 'Stare_118_20230615_23.hpl')
+    synthetic_hpl.write_stare_file(lidar_file, rays = 400, gates = 40, start_hour = 23.7)
+    return lidar_file
+
+
+@pytest.fixture(scope = 'module')
+def original(stare_file):
+    return legacy_read_lidar.readLidarFile(stare_file)
+
+
+def test_read_matches_original(stare_file, original):
+    assert_outputs_match(read_lidar.readLidarFile(stare_file), original)
+
+
+@pytest.mark.parametrize('fields', [['D', 'AZ', 'EL', 'DP'], ['TimeStamp'], ['A', 'DD'], []])
+def test_fields_match_original(stare_file, original, fields):
+    assert_outputs_match(read_lidar.readLidarFile(stare_file, fields = fields), original, fields)
+
+
+def test_unknown_field(stare_file):
+    with pytest.raises(ValueError):
+        read_lidar.readLidarFile(stare_file, fields = ['unix_times'])
+
+
+def test_incomplete_last_ray(tmp_path, stare_file, original):
+    """
+    A file still being written is read up to its last complete ray.
+    """
+    lines = open(stare_file).read().split('\n')
+    gate_number, num_headerlines = original['gate_number'], original['num_headerlines']
+    cut_file = tmp_path / 'Stare_118_20230615_23.hpl'
+    cut_file.write_text('\n'.join(lines[:num_headerlines + 10 * (gate_number + 1) + 5]))
+    complete_file = tmp_path / 'complete.hpl'
+    complete_file.write_text('\n'.join(lines[:num_headerlines + 10 * (gate_number + 1)]) + '\n')
+    assert_outputs_match(read_lidar.readLidarFile(str(cut_file)), legacy_read_lidar.readLidarFile(str(complete_file)))
+
+
+def test_no_complete_ray(tmp_path, stare_file, original):
+    header_file = tmp_path / 'Stare_118_20230615_23.hpl'
+    header_file.write_text(''.join(open(stare_file).readlines()[:original['num_headerlines']]))
+    data = read_lidar.readLidarFile(str(header_file))
+    assert data['maximum'] == 0
+    assert data['TimeStamp'].shape == (0, 3)
+    assert data['DD'] is None and data['DP'] is None and data['A'] is None
+
+
+def test_lidar_file_rays(stare_file, original):
+    new = read_lidar.readLidarFile(stare_file)
+    with read_lidar.LidarFile(stare_file) as lidar:
+        rays = lidar.read_rays(100, 250)
+        assert rays.keys() == new.keys()
+        for key in read_lidar.FIELDS:
+            assert np.array_equal(rays[key], new[key][100:250]), key
+        assert lidar.read_rays(5, 5)['TimeStamp'].shape == (0, 3)
+
+
+@pytest.mark.parametrize('fields', [None, ['TimeStamp'], ['A'], ['DD', 'D']])
+def test_cache_matches_original(tmp_path, stare_file, original, fields):
+    cache_dir = str(tmp_path / 'cache')
+    # the first read adds the file to the cache, the second loads it from there
+    for _ in range(2):
+        assert_outputs_match(lidar_cache.readLidarFile(stare_file, cache_dir, fields = fields), original, fields)
@@ -0,0 +1,109 @@
+"""
+netCDF files made by the current writers, with only the variables each
+product fills, against the files of the original writers in
+benchmarks/legacy_process_lidar_*.py, which make every variable and then
+rewrite the file with remove_empty_variables. Uses a synthetic day of Stare
+and Wind_Profile files, and the tsv files in amf_cvs (or the AMF_CVs tsv
+files in $AMF_CVS_TSV_LOCATION), so no network connection is needed.
+"""
+import os
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+import amof_template
+import process_lidar_stare
+import process_lidar_wind_profile
+import synthetic_hpl
+import amf_cvs
+from ncas_amof_netcdf_template import remove_empty_variables, tsv2dict
+
+# the original reader parses with the parse module
+legacy_process_lidar_stare = pytest.importorskip('legacy_process_lidar_stare')
+legacy_process_lidar_wind_profile = pytest.importorskip('legacy_process_lidar_wind_profile')
+
+
+METADATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'metadata.csv')
+# global attributes that depend on when the file was made
+TIME_ATTRIBUTES = ['history', 'last_revised_date']
+
+
+@pytest.fixture(scope = 'module')
+def tsv_location(tmp_path_factory):
+    if os.environ.get('AMF_CVS_TSV_LOCATION'):
+        return os.environ['AMF_CVS_TSV_LOCATION']
+    tsv_location = str(tmp_path_factory.mktemp('AMF_CVs'))
+    amf_cvs.write_cvs(tsv_location)
+    return tsv_location
+
+
+@pytest.fixture(autouse = True)
+def offline(monkeypatch, tsv_location):
+    """
+    remove_empty_variables gets the product variables from the tsv files
+    rather than GitHub, and the AMOF definitions aren't stored in the home
+    directory.
+    """
+    def get_product_variables_metadata(product, skip_check = False):
+        variables = tsv2dict.instrument_dict('ncas-lidar-dop-2', use_local_files = tsv_location)[product]['variables']
+        return variables.keys(), variables
+    load_template = amof_template.load_template
+    monkeypatch.setattr(remove_empty_variables, 'get_product_variables_metadata', get_product_variables_metadata)
+    monkeypatch.setattr(amof_template, 'load_template', lambda *args, **kwargs: load_template(*args, **dict(kwargs, template_dir = None)))
+
+
+@pytest.fixture(scope = 'module')
+def stare_files(tmp_path_factory):
+    return synthetic_hpl.write_stare_day(str(tmp_path_factory.mktemp('stare')), files = 4, rays = 300, gates = 100)
+
+
+@pytest.fixture(scope = 'module')
+def wind_profile_files(tmp_path_factory):
+    return synthetic_hpl.write_wind_profile_day(str(tmp_path_factory.mktemp('wind_profile')), scans = 24, gates = 100)
+
+
+def assert_files_match(new_file, old_file):
+    """
+    The files have the same dimensions, variables, attributes and data.
+    """
+    with Dataset(new_file) as new, Dataset(old_file) as old:
+        assert {key: len(dim) for key, dim in new.dimensions.items()} == {key: len(dim) for key, dim in old.dimensions.items()}
+        assert list(new.variables) == list(old.variables)
+        assert set(new.ncattrs()) == set(old.ncattrs())
+        for key in new.ncattrs():
+            if key not in TIME_ATTRIBUTES:
+                assert np.array_equal(new.getncattr(key), old.getncattr(key)), key
+        for name in new.variables:
+            new_var, old_var = new[name], old[name]
+            assert new_var.dtype == old_var.dtype and new_var.dimensions == old_var.dimensions, name
+            assert new_var.ncattrs() == old_var.ncattrs(), name
+            for key in new_var.ncattrs():
+                assert np.array_equal(new_var.getncattr(key), old_var.getncattr(key)), (name, key)
+            new_data, old_data = new_var[:], old_var[:]
+            assert np.array_equal(np.ma.getmaskarray(new_data), np.ma.getmaskarray(old_data)), name
+            assert np.array_equal(np.ma.filled(new_data, 0), np.ma.filled(old_data, 0)), name
+
+
+def assert_writers_match(tmp_path, new_writer, old_writer, lidar_files, tsv_location, **kwargs):
+    os.makedirs(tmp_path / 'new')
+    os.makedirs(tmp_path / 'old')
+    new_writer(lidar_files, metadata_file = METADATA_FILE, ncfile_location = str(tmp_path / 'new'), local_tsv_file_loc = tsv_location, **kwargs)
+    with np.errstate(all = 'ignore'):
+        old_writer(lidar_files, metadata_file = METADATA_FILE, ncfile_location = str(tmp_path / 'old'), local_tsv_file_loc = tsv_location)
+    ncfiles = sorted(os.listdir(tmp_path / 'old'))
+    assert len(ncfiles) == 1
+    assert sorted(os.listdir(tmp_path / 'new')) == ncfiles
+    assert_files_match(tmp_path / 'new' / ncfiles[0], tmp_path / 'old' / ncfiles[0])
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_stare_matches_original(tmp_path, stare_files, tsv_location, workers):
+    assert_writers_match(tmp_path, process_lidar_stare.make_netcdf_aerosol_backscatter_radial_winds, legacy_process_lidar_stare.make_netcdf_aerosol_backscatter_radial_winds, stare_files, tsv_location, workers = workers)
+
+
+def test_wind_profile_matches_original(tmp_path, wind_profile_files, tsv_location):
+    assert_writers_match(tmp_path, process_lidar_wind_profile.make_netcdf_aerosol_backscatter_radial_winds, legacy_process_lidar_wind_profile.make_netcdf_aerosol_backscatter_radial_winds, wind_profile_files, tsv_location)
+
+
+def test_mean_winds_matches_original(tmp_path, wind_profile_files, tsv_location):
+    assert_writers_match(tmp_path, process_lidar_wind_profile.make_netcdf_mean_winds_profile, legacy_process_lidar_wind_profile.make_netcdf_mean_winds_profile, wind_profile_files, tsv_location)